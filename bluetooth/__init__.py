@@ -34,6 +34,11 @@ discover_devices.__doc__ = \
         When set to True :func:`discover_devices` attempts to look up the class of each detected device.
         (the default is False).
 
+    cache : DeviceCache
+        (BlueZ only) A :class:`DeviceCache` to record the devices found in, and to answer name
+        lookups from.  Names that were resolved, or failed to resolve, recently are not requested
+        again.  (the default is None, no cache).
+
     Returns
     -------
     list
@@ -61,6 +66,10 @@ lookup_name.__doc__ = \
     ----------
     address : str
         The Bluetooth address of the device.
+
+    cache : DeviceCache
+        (BlueZ only) A :class:`DeviceCache` to answer from, and to record the result in.
+        (the default is None, no cache).
     
     Returns
     -------
@@ -192,7 +201,34 @@ find_service.__doc__ = \
         The Bluetooth address of a device or "localhost". 
         If "localhost" is provided the function will search for Bluetooth services on the
         local machine.
-    
+
+    concurrency : int
+        (BlueZ only) The number of devices queried at once when no address is given.
+        (the default is 4).
+
+    timeout : float or None
+        (BlueZ only) The number of seconds after which the query of a device is given up.
+        (the default is None, no limit).
+
+    pool : SDPSessionPool or None
+        (BlueZ only) A :class:`SDPSessionPool` whose SDP sessions are reused across calls.
+        (the default is None, sessions are closed after each query).
+
+    attrs : list or None
+        (BlueZ only) The attribute IDs, and (first, last) ranges of attribute IDs, to fetch
+        from each service record, e.g. ``[SERVICE_NAME_ATTRID, (0x0200, 0x02ff)]``.
+        (the default is None, only the attributes the keys below are made from).
+
+    cache : ServiceCache or None
+        (BlueZ only) A :class:`ServiceCache` to answer from, and to record the results in.
+        Expired results are revalidated with the ServiceDatabaseState of the device.
+        (the default is None, no cache).
+
+    compact : bool
+        (BlueZ only) When set to True the results are :class:`ServiceRecord` objects, which keep
+        the encoded record and decode only the attributes their fields are made from, instead
+        of dictionaries.  (the default is False).
+
     Returns
     -------
     list
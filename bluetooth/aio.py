@@ -0,0 +1,580 @@
+"""asyncio support for Bluetooth sockets.
+
+AsyncBluetoothSocket wraps a BluetoothSocket in non-blocking mode and waits
+for it with the event loop's add_reader and add_writer, so many RFCOMM and
+L2CAP connections can be served from one thread:
+
+    sock = AsyncBluetoothSocket (bluetooth.RFCOMM)
+    await sock.connect ((address, channel))
+    await sock.sendall (b"hello")
+    data = await sock.recv (1024)
+
+create_connection and open_connection attach an asyncio.Protocol or a
+StreamReader / StreamWriter pair to a connection instead.  For L2CAP
+sockets every packet is delivered to data_received separately, and every
+write () is sent as one packet.
+
+AsyncSDPSession does the same for SDP queries, so the services of many
+devices can be looked up at once from one thread:
+
+    session = AsyncSDPSession ()
+    await session.connect (address)
+    records = await session.browse ()
+
+This needs an event loop that implements add_reader, i.e. a selector event
+loop.  The wrapped socket only needs to provide the methods of the standard
+socket API that are used, so a socket.socketpair () end can stand in for a
+BluetoothSocket in tests.
+
+"""
+import asyncio
+import collections
+import socket
+from errno import (EAGAIN, EWOULDBLOCK, EINPROGRESS, EALREADY, EINTR,
+                   EISCONN, EBUSY, ENOTCONN)
+
+from bluetooth import BluetoothSocket, BluetoothError, RFCOMM
+
+_TRY_AGAIN = (EAGAIN, EWOULDBLOCK, EINTR)
+
+def _try_again (e):
+    return e.errno in _TRY_AGAIN or isinstance (e, BlockingIOError)
+
+
+class AsyncBluetoothSocket:
+    """AsyncBluetoothSocket (proto=RFCOMM, sock=None, loop=None)
+
+    A non-blocking Bluetooth socket with coroutine versions of recv, send,
+    sendall, accept and connect.  If sock is given it is wrapped instead of
+    creating a new BluetoothSocket.  Methods that don't block, such as bind,
+    listen, getsockname and setsockopt, are passed on to the wrapped socket.
+
+    """
+    def __init__ (self, proto=RFCOMM, sock=None, loop=None):
+        if sock is None:
+            sock = BluetoothSocket (proto)
+        self._sock = sock
+        self._proto = proto
+        self._loop = loop
+        self._fd = sock.fileno ()
+        sock.setblocking (False)
+
+    @property
+    def loop (self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop ()
+        return self._loop
+
+    @property
+    def socket (self):
+        """The wrapped socket."""
+        return self._sock
+
+    def __getattr__ (self, name):
+        return getattr (self._sock, name)
+
+    def fileno (self):
+        return self._fd
+
+    def close (self):
+        if self._fd >= 0:
+            self.loop.remove_reader (self._fd)
+            self.loop.remove_writer (self._fd)
+            self._fd = -1
+        self._sock.close ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
+
+    def _wait (self, writing):
+        # returns a future that is done once the socket is readable or
+        # writable.  Cancelling it removes the callback.
+        loop = self.loop
+        fut = loop.create_future ()
+        if writing:
+            loop.add_writer (self._fd, _set_done, fut)
+            remove = loop.remove_writer
+        else:
+            loop.add_reader (self._fd, _set_done, fut)
+            remove = loop.remove_reader
+        fd = self._fd
+        fut.add_done_callback (lambda f: remove (fd))
+        return fut
+
+    async def _io (self, writing, method, *args):
+        while True:
+            try:
+                return method (*args)
+            except OSError as e:
+                if not _try_again (e):
+                    raise
+            await self._wait (writing)
+
+    async def recv (self, bufsize):
+        """recv (bufsize) -> data
+
+        Waits until data is available and returns up to bufsize bytes of it.
+        Returns an empty bytes object once the peer has closed the
+        connection.  On an L2CAP socket each call returns one packet.
+
+        """
+        return await self._io (False, self._sock.recv, bufsize)
+
+    async def recvfrom (self, bufsize):
+        return await self._io (False, self._sock.recvfrom, bufsize)
+
+    async def recv_into (self, buffer, nbytes=0):
+        """recv_into (buffer, nbytes=0) -> count
+
+        Like recv, but stores the data in buffer instead of allocating a new
+        bytes object.
+
+        """
+        return await self._io (False, self._sock.recv_into, buffer, nbytes)
+
+    async def send (self, data):
+        """send (data) -> count
+
+        Waits until the socket is writable and sends as much of data as
+        possible.  Returns the number of bytes sent.
+
+        """
+        return await self._io (True, self._sock.send, data)
+
+    async def sendall (self, data):
+        """sendall (data)
+
+        Sends all of data, waiting for the socket to become writable as
+        often as needed.
+
+        """
+        view = memoryview (data).cast ("B")
+        while view:
+            sent = await self._io (True, self._sock.send, view)
+            view = view[sent:]
+
+    async def sendmsg (self, buffers, *args):
+        """sendmsg (buffers[, ancdata[, flags[, address]]]) -> count
+
+        Waits until the socket is writable and sends the concatenation of
+        buffers as one message.
+
+        """
+        return await self._io (True, self._sock.sendmsg, buffers, *args)
+
+    async def send_many (self, packets):
+        """send_many (packets) -> list of counts
+
+        Sends each of packets as a separate message, waiting for the socket
+        to become writable whenever the send buffer is full.  Returns the
+        number of bytes sent for each packet.
+
+        """
+        packets = list (packets)
+        results = []
+        while len (results) < len (packets):
+            results.extend (await self._io (True, self._sock.send_many,
+                                            packets[len (results):]))
+        return results
+
+    async def accept (self):
+        """accept () -> (AsyncBluetoothSocket, address)
+
+        Waits for an incoming connection on a listening socket.
+
+        """
+        client, addr = await self._io (False, self._sock.accept)
+        return AsyncBluetoothSocket (self._proto, client, self._loop), addr
+
+    async def connect (self, addrport):
+        """connect (addrport)
+
+        Starts connecting to addrport and waits until the connection is
+        established.  Raises BluetoothError if it fails.
+
+        """
+        err = self._sock.connect_ex (addrport)
+        if err in (EINPROGRESS, EALREADY) or err in _TRY_AGAIN:
+            await self._wait (True)
+            err = self._sock.getsockopt (socket.SOL_SOCKET, socket.SO_ERROR)
+        if err not in (0, EISCONN):
+            raise BluetoothError (err, "connect to %s failed" % (addrport,))
+
+
+def _set_done (fut):
+    if not fut.done ():
+        fut.set_result (None)
+
+
+class AsyncSDPSession:
+    """AsyncSDPSession (session=None, loop=None)
+
+    An SDP session with coroutine versions of connect, search and browse,
+    built on the search_async, browse_async and process methods of
+    _bluetooth.SDPSession.  If session is given it is used instead of
+    creating a new _bluetooth.SDPSession.  BlueZ only.
+
+    A session runs one query at a time.  If a query is cancelled, e.g. by
+    asyncio.wait_for, the session is closed, as the server may still answer
+    it.
+
+    """
+    def __init__ (self, session=None, loop=None):
+        import bluetooth._bluetooth as _bt
+        if session is None:
+            session = _bt.SDPSession ()
+        self._session = session
+        self._error = _bt.error
+        self._loop = loop
+        self._fd = -1
+        self._busy = False
+
+    @property
+    def loop (self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop ()
+        return self._loop
+
+    @property
+    def session (self):
+        """The wrapped _bluetooth.SDPSession."""
+        return self._session
+
+    def fileno (self):
+        if self._fd < 0:
+            # the session may have been connected before it was wrapped
+            return self._session.fileno ()
+        return self._fd
+
+    def close (self):
+        if self._fd >= 0:
+            self.loop.remove_reader (self._fd)
+            self.loop.remove_writer (self._fd)
+            self._fd = -1
+        self._session.close ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
+
+    async def connect (self, address="localhost"):
+        """connect (address="localhost")
+
+        Starts connecting to the SDP server of address and waits until the
+        connection is established.  If it could not be, the first query
+        raises BluetoothError.
+
+        """
+        self.close ()
+        try:
+            self._session.connect (address, nonblocking=True)
+        except self._error as e:
+            raise BluetoothError (*e.args)
+        self._fd = self._session.fileno ()
+        loop = self.loop
+        fut = loop.create_future ()
+        fd = self._fd
+        loop.add_writer (fd, _set_done, fut)
+        try:
+            await fut
+        finally:
+            loop.remove_writer (fd)
+
+    async def search (self, uuid, attrs=None, raw=False):
+        """search (uuid, attrs=None, raw=False) -> list of service records
+
+        Searches the server for records with uuid, and returns them as
+        _bluetooth.SDPSession.search does.
+
+        """
+        return await self._query (self._session.search_async, uuid,
+                                  attrs=attrs, raw=raw)
+
+    async def browse (self, attrs=None, raw=False):
+        """browse (attrs=None, raw=False) -> list of service records
+
+        Returns the public records of the server, as
+        _bluetooth.SDPSession.browse does.
+
+        """
+        return await self._query (self._session.browse_async, attrs=attrs,
+                                  raw=raw)
+
+    async def _query (self, start, *args, **kwargs):
+        if self._busy:
+            raise BluetoothError (EBUSY, "an SDP query is already in progress")
+        loop = self.loop
+        fut = loop.create_future ()
+
+        def done (records, error):
+            if fut.done ():
+                return
+            if error is None:
+                fut.set_result (records)
+            else:
+                fut.set_exception (BluetoothError (*error.args))
+
+        fd = self.fileno ()
+        if fd < 0:
+            raise BluetoothError (ENOTCONN, "the SDP session is not connected")
+        try:
+            start (*args, callback=done, **kwargs)
+        except self._error as e:
+            raise BluetoothError (*e.args)
+        self._fd = fd
+        self._busy = True
+        loop.add_reader (fd, self._readable, fut)
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            self.close ()
+            raise
+        finally:
+            self._busy = False
+            if self._fd == fd:
+                loop.remove_reader (fd)
+
+    def _readable (self, fut):
+        # the response may come in several parts, each read by a process ()
+        try:
+            self._session.process ()
+        except self._error as e:
+            if not fut.done ():
+                fut.set_exception (BluetoothError (*e.args))
+
+
+class BluetoothTransport (asyncio.Transport):
+    """An asyncio transport on a connected Bluetooth socket.
+
+    It keeps the boundaries of L2CAP packets: each recv () is passed to the
+    protocol's data_received, and each write () is sent with one send ().
+    The extra info keys "socket", "peername" and "sockname" are available.
+
+    """
+    max_size = 65536
+
+    def __init__ (self, loop, sock, protocol, extra=None):
+        super ().__init__ (extra)
+        if isinstance (sock, AsyncBluetoothSocket):
+            sock = sock.socket
+        sock.setblocking (False)
+        self._loop = loop
+        self._sock = sock
+        self._fd = sock.fileno ()
+        self._protocol = protocol
+        self._buffer = collections.deque ()
+        self._buffer_size = 0
+        self._closing = False
+        self._reading = True
+        self._paused = False
+        self._high_water = 64 * 1024
+        self._low_water = 16 * 1024
+        self._extra["socket"] = sock
+        for key, method in (("peername", "getpeername"),
+                            ("sockname", "getsockname")):
+            try:
+                self._extra[key] = getattr (sock, method) ()
+            except OSError:
+                self._extra[key] = None
+
+        loop.call_soon (protocol.connection_made, self)
+        loop.call_soon (self._add_reader)
+
+    def _add_reader (self):
+        if self._reading and not self._closing:
+            self._loop.add_reader (self._fd, self._read_ready)
+
+    def _read_ready (self):
+        try:
+            data = self._sock.recv (self.max_size)
+        except OSError as e:
+            if not _try_again (e):
+                self._fatal_error (e)
+            return
+        if data:
+            self._protocol.data_received (data)
+            return
+        self._loop.remove_reader (self._fd)
+        if not self._protocol.eof_received ():
+            self.close ()
+
+    # ---------------- writing ----------------
+
+    def write (self, data):
+        if self._closing:
+            raise RuntimeError ("write on a closing transport")
+        if not data:
+            return
+        data = bytes (data)
+        if not self._buffer:
+            try:
+                sent = self._sock.send (data)
+            except OSError as e:
+                if not _try_again (e):
+                    self._fatal_error (e)
+                    return
+                sent = 0
+            if sent == len (data):
+                return
+            data = data[sent:]
+            self._loop.add_writer (self._fd, self._write_ready)
+        self._buffer.append (data)
+        self._buffer_size += len (data)
+        self._maybe_pause_protocol ()
+
+    def _write_ready (self):
+        while self._buffer:
+            data = self._buffer[0]
+            try:
+                sent = self._sock.send (data)
+            except OSError as e:
+                if not _try_again (e):
+                    self._fatal_error (e)
+                return
+            self._buffer_size -= sent
+            if sent < len (data):
+                self._buffer[0] = data[sent:]
+                break
+            self._buffer.popleft ()
+        self._maybe_resume_protocol ()
+        if not self._buffer:
+            self._loop.remove_writer (self._fd)
+            if self._closing:
+                self._call_connection_lost (None)
+
+    def get_write_buffer_size (self):
+        return self._buffer_size
+
+    def get_write_buffer_limits (self):
+        return (self._low_water, self._high_water)
+
+    def set_write_buffer_limits (self, high=None, low=None):
+        if high is None:
+            high = 64 * 1024 if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        if not high >= low >= 0:
+            raise ValueError ("high (%r) must be >= low (%r) must be >= 0" %
+                              (high, low))
+        self._high_water = high
+        self._low_water = low
+        self._maybe_pause_protocol ()
+
+    def _maybe_pause_protocol (self):
+        if not self._paused and self._buffer_size > self._high_water:
+            self._paused = True
+            self._protocol.pause_writing ()
+
+    def _maybe_resume_protocol (self):
+        if self._paused and self._buffer_size <= self._low_water:
+            self._paused = False
+            self._protocol.resume_writing ()
+
+    def can_write_eof (self):
+        return False
+
+    # ---------------- reading ----------------
+
+    def is_reading (self):
+        return self._reading and not self._closing
+
+    def pause_reading (self):
+        if self._reading and not self._closing:
+            self._reading = False
+            self._loop.remove_reader (self._fd)
+
+    def resume_reading (self):
+        if not self._reading and not self._closing:
+            self._reading = True
+            self._loop.add_reader (self._fd, self._read_ready)
+
+    # ---------------- closing ----------------
+
+    def is_closing (self):
+        return self._closing
+
+    def close (self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader (self._fd)
+        if not self._buffer:
+            self._loop.call_soon (self._call_connection_lost, None)
+
+    def abort (self):
+        self._force_close (None)
+
+    def _fatal_error (self, exc):
+        self._force_close (exc)
+
+    def _force_close (self, exc):
+        if self._sock is None:
+            return
+        self._buffer.clear ()
+        self._buffer_size = 0
+        self._loop.remove_writer (self._fd)
+        if not self._closing:
+            self._closing = True
+            self._loop.remove_reader (self._fd)
+        self._loop.call_soon (self._call_connection_lost, exc)
+
+    def _call_connection_lost (self, exc):
+        if self._sock is None:
+            return
+        try:
+            self._protocol.connection_lost (exc)
+        finally:
+            self._sock.close ()
+            self._sock = None
+            self._protocol = None
+
+
+async def create_connection (protocol_factory, addrport=None, proto=RFCOMM,
+                             sock=None):
+    """create_connection (protocol_factory, addrport=None, proto=RFCOMM,
+                       sock=None) -> (transport, protocol)
+
+    Connects to addrport with a new socket of type proto and attaches a
+    protocol created by protocol_factory to it.  Alternatively, sock can be
+    an already connected socket, e.g. one returned by accept ().
+
+    """
+    loop = asyncio.get_running_loop ()
+    if sock is None:
+        if addrport is None:
+            raise ValueError ("either addrport or sock must be given")
+        sock = AsyncBluetoothSocket (proto, loop=loop)
+        try:
+            await sock.connect (addrport)
+        except BaseException:
+            sock.close ()
+            raise
+    elif addrport is not None:
+        raise ValueError ("addrport and sock can not both be given")
+
+    protocol = protocol_factory ()
+    transport = BluetoothTransport (loop, sock, protocol)
+    return transport, protocol
+
+
+async def open_connection (addrport=None, proto=RFCOMM, sock=None,
+                           limit=2 ** 16):
+    """open_connection (addrport=None, proto=RFCOMM, sock=None,
+                     limit=2 ** 16) -> (reader, writer)
+
+    Like create_connection, but returns an asyncio StreamReader and
+    StreamWriter for the connection.
+
+    """
+    loop = asyncio.get_running_loop ()
+    reader = asyncio.StreamReader (limit=limit, loop=loop)
+    transport, protocol = await create_connection (
+        lambda: asyncio.StreamReaderProtocol (reader, loop=loop),
+        addrport, proto, sock)
+    writer = asyncio.StreamWriter (transport, protocol, reader, loop)
+    return reader, writer
@@ -1,33 +1,62 @@
 import array
+import collections
+import concurrent.futures
 import fcntl
+import heapq
+import socket
 import sys
 import struct
-from errno import (EADDRINUSE, EBUSY, EINVAL)
+import queue
+import threading
+import time
+from errno import (EADDRINUSE, EBUSY, ECONNRESET, EINVAL, EIO,
+                   ETIMEDOUT)
 
 from bluetooth.btcommon import *
+from bluetooth.cache import DeviceCache, ServiceCache
+from bluetooth.poller import Poller
+from bluetooth.eir import parse_eir
+from bluetooth.hci import decode_inquiry_results
 import bluetooth._bluetooth as _bt
 from bluetooth._bluetooth import HCI, RFCOMM, L2CAP, SCO, SOL_L2CAP, \
                                     SOL_RFCOMM, L2CAP_OPTIONS
 
 get_byte = int
 
+_INQUIRY_OPCODE = _bt.cmd_opcode_pack (_bt.OGF_LINK_CTL, _bt.OCF_INQUIRY)
+_INQUIRY_CANCEL_OPCODE = _bt.cmd_opcode_pack (_bt.OGF_LINK_CTL,
+        _bt.OCF_INQUIRY_CANCEL)
+_REMOTE_NAME_REQ_OPCODE = _bt.cmd_opcode_pack (_bt.OGF_LINK_CTL,
+        _bt.OCF_REMOTE_NAME_REQ)
+
 # ============== SDP service registration and unregistration ============
 
 def discover_devices (duration=8, flush_cache=True, lookup_names=False,
-                      lookup_class=False, device_id=-1, iac=IAC_GIAC):
-    if device_id == -1:
+                      lookup_class=False, device_id=-1, iac=IAC_GIAC,
+                      cache=None):
+    if device_id == -1 and _hci_transport is None:
         device_id = _bt.hci_get_route()
 
     sock = _gethcisock (device_id)
     try:
-        results = _bt.hci_inquiry (sock, duration=duration, flush_cache=True,
-                                   lookup_class=lookup_class, device_id=device_id,
-                                   iac=iac)
-    except _bt.error as e:
+        if _hci_transport is None:
+            results = _bt.hci_inquiry (sock, duration=duration,
+                    flush_cache=True, lookup_class=lookup_class,
+                    device_id=device_id, iac=iac)
+        else:
+            results = _hci_inquiry (sock, duration, lookup_class, iac)
+    except (_bt.error, OSError) as e:
         sock.close ()
         raise BluetoothError (e.args[0], "Error communicating with local "
         "bluetooth adapter: " + e.args[1])
 
+    if cache is not None:
+        for item in results:
+            if lookup_class:
+                cache.seen (item[0], device_class=item[1])
+            else:
+                cache.seen (item)
+
     if lookup_names:
         pairs = []
         for item in results:
@@ -35,23 +64,47 @@ def discover_devices (duration=8, flush_cache=True, lookup_names=False,
                 addr, dev_class = item
             else:
                 addr = item
-            timeoutms = int (10 * 1000)
-            try:
-                name = _bt.hci_read_remote_name (sock, addr, timeoutms)
-            except _bt.error:
-                # name lookup failed.  either a timeout, or I/O error
+            name = _read_remote_name (sock, addr, 10, cache)
+            if name is None:
                 continue
             pairs.append ((addr, name, dev_class) if lookup_class else (addr, name))
         sock.close ()
+        if cache is not None:
+            cache.flush ()
         return pairs
     else:
         sock.close ()
         return results
 
-def read_local_bdaddr():
+def _read_remote_name (sock, address, timeout, cache):
+    if cache is not None:
+        hit, name = cache.lookup_name (address)
+        if hit:
+            return name
+    try:
+        if _hci_transport is None:
+            name = _bt.hci_read_remote_name (sock, address,
+                    int (timeout * 1000))
+        else:
+            name = _hci_read_remote_name (sock, address, timeout)
+    except (_bt.error, OSError):
+        # name lookup failed.  either a timeout, or I/O error
+        name = None
+    if cache is not None:
+        if name is None:
+            cache.name_failed (address)
+        else:
+            cache.set_name (address, name)
+    return name
+
+def read_local_bdaddr(device_id=-1):
+    if device_id == -1 and _hci_transport is None:
+        try:
+            device_id = _bt.hci_get_route ()
+        except _bt.error as e:
+            raise BluetoothError (*e.args)
+    hci_sock = _gethcisock (device_id)
     try:
-        hci_sock = _bt.hci_open_dev(0)
-        old_filter = hci_sock.getsockopt( _bt.SOL_HCI, _bt.HCI_FILTER, 14)
         flt = _bt.hci_filter_new()
         opcode = _bt.cmd_opcode_pack(_bt.OGF_INFO_PARAM,
                 _bt.OCF_READ_BD_ADDR)
@@ -60,9 +113,9 @@ def read_local_bdaddr():
         _bt.hci_filter_set_opcode(flt, opcode)
         hci_sock.setsockopt( _bt.SOL_HCI, _bt.HCI_FILTER, flt )
 
-        _bt.hci_send_cmd(hci_sock, _bt.OGF_INFO_PARAM, _bt.OCF_READ_BD_ADDR )
+        _hci_send_cmd (hci_sock, _bt.OGF_INFO_PARAM, _bt.OCF_READ_BD_ADDR)
 
-        pkt = hci_sock.recv(255)
+        pkt = _hci_recv (hci_sock, 255)
 
         status,raw_bdaddr = struct.unpack("xxxxxxB6s", pkt)
         assert status == 0
@@ -71,26 +124,112 @@ def read_local_bdaddr():
         t.reverse()
         bdaddr = ":".join(t)
 
-        # restore old filter
-        hci_sock.setsockopt( _bt.SOL_HCI, _bt.HCI_FILTER, old_filter )
         return [bdaddr]
     except _bt.error as e:
         raise BluetoothError(*e.args)
+    finally:
+        hci_sock.close ()
 
-def lookup_name (address, timeout=10):
+def lookup_name (address, timeout=10, cache=None):
     if not is_valid_address (address):
         raise BluetoothError (EINVAL, "%s is not a valid Bluetooth address" % address)
 
+    if cache is not None:
+        hit, name = cache.lookup_name (address)
+        if hit:
+            return name
+
     sock = _gethcisock ()
-    timeoutms = int (timeout * 1000)
     try:
-        name = _bt.hci_read_remote_name (sock, address, timeoutms)
-    except _bt.error:
-        # name lookup failed.  either a timeout, or I/O error
-        name = None
-    sock.close ()
+        name = _read_remote_name (sock, address, timeout, cache)
+    finally:
+        sock.close ()
     return name
 
+NameLookupResult = collections.namedtuple ("NameLookupResult",
+        ["address", "name", "elapsed"])
+NameLookupResult.__doc__ = \
+    """The outcome of one name lookup by lookup_names.
+
+    name is None if the lookup failed or timed out.  elapsed is the time the
+    lookup took in seconds, measured from when it was started, and 0 for
+    answers from the cache.
+
+    """
+
+def lookup_names (addresses, concurrency=4, timeout=10, device_id=-1,
+                  cache=None):
+    """lookup_names (addresses, concurrency=4, timeout=10, device_id=-1,
+                  cache=None) -> iterator of NameLookupResult
+
+    Looks up the names of many devices, running up to concurrency remote
+    name requests at once.  Results are yielded as the lookups complete,
+    so the order is not that of addresses.  timeout is the time in seconds
+    allowed for each lookup.
+
+    Each worker keeps one HCI socket open and reuses it for all of its
+    lookups; the sockets are closed when the iterator is exhausted or
+    closed.  Controllers only page a limited number of devices at once,
+    so values of concurrency beyond 3 or 4 rarely help.  lookup_names
+    may be used from several threads at once.
+
+    If cache is a DeviceCache, names it knows are yielded first without
+    paging the device, and the results of the lookups are stored in it.
+
+    """
+    addresses = list (dict.fromkeys (addresses))
+    for address in addresses:
+        if not is_valid_address (address):
+            raise BluetoothError (EINVAL,
+                    "%s is not a valid Bluetooth address" % address)
+    return _lookup_names (addresses, max (1, concurrency), timeout,
+                          device_id, cache)
+
+def _lookup_names (addresses, concurrency, timeout, device_id, cache):
+    pending = []
+    for address in addresses:
+        hit = False
+        if cache is not None:
+            hit, name = cache.lookup_name (address)
+        if hit:
+            yield NameLookupResult (address, name, 0.0)
+        else:
+            pending.append (address)
+    if not pending:
+        return
+
+    # idle HCI sockets, at most one per worker
+    socks = []
+    socks_lock = threading.Lock ()
+
+    def lookup (address):
+        with socks_lock:
+            sock = socks.pop () if socks else None
+        if sock is None:
+            sock = _gethcisock (device_id)
+        start = time.monotonic ()
+        try:
+            name = _read_remote_name (sock, address, timeout, cache)
+        finally:
+            with socks_lock:
+                socks.append (sock)
+        return NameLookupResult (address, name, time.monotonic () - start)
+
+    executor = concurrent.futures.ThreadPoolExecutor (
+            min (concurrency, len (pending)))
+    futures = [executor.submit (lookup, address) for address in pending]
+    try:
+        for future in concurrent.futures.as_completed (futures):
+            yield future.result ()
+    finally:
+        for future in futures:
+            future.cancel ()
+        executor.shutdown (wait=True)
+        for sock in socks:
+            sock.close ()
+        if cache is not None:
+            cache.flush ()
+
 def set_packet_timeout (address, timeout):
     """
     Adjusts the ACL flush timeout for the ACL connection to the specified
@@ -239,9 +378,10 @@ class BluetoothSocket:
     %s.__doc__ = _bt.btsocket.%s.__doc__\n""")
     for _m in ( 'connect', 'connect_ex', 'close',
         'fileno', 'getpeername', 'getsockname', 'gettimeout',
-        'getsockopt', 'listen', 'makefile', 'recv', 'recvfrom', 'sendall',
-        'send', 'sendto', 'setblocking', 'setsockopt', 'settimeout',
-        'shutdown', 'setl2capsecurity'):
+        'getsockopt', 'listen', 'makefile', 'recv', 'recvfrom', 'recv_into',
+        'recvfrom_into', 'recvmsg_into', 'sendall', 'send', 'sendto',
+        'sendmsg', 'send_many', 'setblocking', 'setsockopt', 'settimeout', 'shutdown',
+        'setl2capsecurity'):
         exec( _s % (_m, _m, _m, _m))
     del _m, _s
 
@@ -280,51 +420,616 @@ def stop_advertising (sock):
     except _bt.error as e:
         raise BluetoothError (*e.args)
 
-def find_service (name = None, uuid = None, address = None):
-    if not address:
-        devices = discover_devices ()
-    else:
-        devices = [ address ]
+class ServiceRegistry:
+    """ServiceRegistry ()
 
-    results = []
+    Registers service records with the local SDP server over one session
+    that stays open, rather than opening a session for every record as
+    advertise_service does.  Many records can be registered at once, and a
+    registered record can be changed in place, without a moment in which it
+    is not advertised.
+
+    Records are ServiceRecord objects, which are encoded with to_raw (),
+    or encoded records.  They stay registered until they are unregistered
+    or the registry is closed, which unregisters all of them.  The SDP
+    server also drops them when the process exits.
+
+    """
+    def __init__ (self):
+        self._session = _bt.SDPSession ()
+        try:
+            self._session.connect ()
+        except _bt.error as e:
+            raise BluetoothError (*e.args)
+        self._handles = {}  # handle -> None, in the order of registration
+        self._lock = threading.Lock ()
+
+    @staticmethod
+    def _encode (record):
+        if isinstance (record, ServiceRecord):
+            return record.to_raw ()
+        return bytes (record)
+
+    def _call (self, name, *args):
+        # called with the lock held
+        if self._session is None:
+            raise BluetoothError (EINVAL, "the service registry is closed")
+        try:
+            return getattr (self._session, name) (*args)
+        except _bt.error as e:
+            raise BluetoothError (*e.args)
+
+    def register (self, record):
+        """register (record) -> handle
+
+        Registers a record and returns its handle.
+
+        """
+        return self.register_many ([record])[0]
+
+    def register_many (self, records):
+        """register_many (records) -> list of handles
+
+        Registers all of records, or none of them if one fails, and returns
+        their handles.
 
+        """
+        records = [self._encode (r) for r in records]
+        with self._lock:
+            handles = self._call ("register", records)
+            self._handles.update (dict.fromkeys (handles))
+        return handles
+
+    def update (self, handle, record):
+        """update (handle, record)
+
+        Replaces the registered record with the given handle by record.
+        The handle stays the same.
+
+        """
+        if handle not in self._handles:
+            raise KeyError (handle)
+        record = self._encode (record)
+        with self._lock:
+            self._call ("update", handle, record)
+
+    def unregister (self, *handles):
+        """unregister (*handles)
+
+        Unregisters the records with the given handles.
+
+        """
+        with self._lock:
+            for handle in handles:
+                if handle not in self._handles:
+                    raise KeyError (handle)
+            for handle in handles:
+                del self._handles[handle]
+            self._call ("unregister", handles)
+
+    def unregister_all (self):
+        """Unregisters all records registered through the registry."""
+        with self._lock:
+            handles = list (self._handles)
+            self._handles.clear ()
+            if handles:
+                self._call ("unregister", handles)
+
+    @property
+    def handles (self):
+        """The handles of the registered records."""
+        return list (self._handles)
+
+    def close (self):
+        """Unregisters all records and closes the session."""
+        if self._session is None:
+            return
+        try:
+            self.unregister_all ()
+        finally:
+            with self._lock:
+                self._session.close ()
+                self._session = None
+
+    def __contains__ (self, handle):
+        return handle in self._handles
+
+    def __len__ (self):
+        return len (self._handles)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
+
+def find_service (name = None, uuid = None, address = None, concurrency=4,
+                  timeout=None, pool=None, attrs=None, cache=None,
+                  compact=False):
     if uuid is not None and not is_valid_uuid (uuid):
         raise ValueError ("invalid UUID")
 
-    try:
-        for addr in devices:
+    results = []
+    for result in find_services ([ address ] if address else None, uuid, name,
+                                 concurrency, timeout, pool, attrs=attrs,
+                                 cache=cache, compact=compact):
+        results.extend (result.services)
+    return results
+
+ServiceDiscoveryResult = collections.namedtuple ("ServiceDiscoveryResult",
+        ["address", "services", "error", "elapsed"])
+ServiceDiscoveryResult.__doc__ = \
+    """The outcome of the service discovery of one device by find_services.
+
+    services is the list of matching service records, as returned by
+    find_service: dictionaries, or ServiceRecord objects if compact was
+    given.  error is None, or the BluetoothError that ended the
+    query, in which case services is empty.  elapsed is the time the query
+    took in seconds.
+
+    """
+
+def _sdp_search (session, uuid, attrs, raw=False):
+    if uuid is not None:
+        return session.search (uuid, attrs, raw)
+    return session.browse (attrs, raw)
+
+def _cached_search (pool, cache, address, uuid, attrs, raw=False):
+    records, fresh, state = cache.lookup (address, uuid, attrs, raw)
+    if fresh:
+        return records
+
+    def fetch (session):
+        if cache.validate:
+            # the state is read before the records, so a change made in
+            # between is noticed next time
+            current = session.database_state ()
+            if records is not None and cache.revalidate (address, current):
+                return records
+        else:
+            current = None
+        found = _sdp_search (session, uuid, attrs, raw)
+        cache.put (address, uuid, attrs, found, current, raw)
+        return found
+
+    return pool.call (address, fetch)
+
+class SDPSessionPool:
+    """SDPSessionPool (idle_timeout=10, max_idle=16)
+
+    Keeps SDP sessions to remote devices open for idle_timeout seconds
+    after a query, so that further queries of the same device skip paging
+    it and setting up the L2CAP connection.  Each open session holds a
+    baseband connection to its device, so at most max_idle sessions are
+    kept; the least recently used ones are closed first.
+
+    A pool may be used from several threads at once.  Sessions are only
+    shared between queries that follow each other, never used by two at
+    the same time.
+
+    """
+    def __init__ (self, idle_timeout=10, max_idle=16):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self._idle = collections.OrderedDict ()  # (address, id) -> (session, expiry)
+        self._lock = threading.Lock ()
+        self._closed = False
+
+    def _take (self, address):
+        with self._lock:
+            self._prune ()
+            for key in reversed (self._idle):
+                if key[0] == address:
+                    return self._idle.pop (key)[0]
+        return None
+
+    def _prune (self):
+        # called with the lock held
+        now = time.monotonic ()
+        while self._idle:
+            key, (session, expiry) = next (iter (self._idle.items ()))
+            if expiry > now and len (self._idle) <= self.max_idle:
+                break
+            del self._idle[key]
+            session.close ()
+
+    def _connect (self, address):
+        session = _bt.SDPSession ()
+        try:
+            session.connect (address)
+        except _bt.error as e:
+            raise BluetoothError (*e.args)
+        return session
+
+    def release (self, address, session):
+        """release (address, session)
+
+        Returns a session to address to the pool, to be reused by later
+        queries.
+
+        """
+        with self._lock:
+            if self._closed or self.idle_timeout <= 0:
+                session.close ()
+                return
+            self._idle[(address, id (session))] = (session,
+                    time.monotonic () + self.idle_timeout)
+            self._prune ()
+
+    def acquire (self, address):
+        """acquire (address) -> (_bluetooth.SDPSession, reused)
+
+        Returns an idle session to address, or connects a new one.  reused
+        tells which.  Pass the session to release () when done with it, or
+        close it if it failed.
+
+        """
+        session = self._take (address)
+        if session is not None:
+            return session, True
+        return self._connect (address), False
+
+    def call (self, address, func):
+        """call (address, func) -> the result of func (session)
+
+        Calls func with a pooled session to address, and returns the session
+        to the pool afterwards.  If func raises _bluetooth.error with a
+        pooled session, which the device may have closed in the meantime,
+        it is called again with a new one.
+
+        """
+        session, reused = self.acquire (address)
+        while True:
             try:
-                s = _bt.SDPSession ()
-                s.connect (addr)
-                matches = []
-                if uuid is not None:
-                    matches = s.search (uuid)
-                else:
-                    matches = s.browse ()
-            except _bt.error:
-                continue
+                result = func (session)
+                break
+            except _bt.error as e:
+                session.close ()
+                if not reused:
+                    raise BluetoothError (*e.args)
+            session, reused = self._connect (address), False
+        self.release (address, session)
+        return result
 
-            if name is not None:
-                matches = [s for s in matches if s.get ("name", "") == name]
+    def search (self, address, uuid=None, attrs=None, raw=False):
+        """search (address, uuid=None, attrs=None, raw=False) -> list of service records
 
-            for m in matches:
-                m["host"] = addr
+        Searches the SDP server of address for records with uuid, or
+        browses all of its public records if uuid is None, with a pooled
+        session.  attrs and raw select the attributes to request and the
+        form of the records, as for _bluetooth.SDPSession.search.
 
-            results.extend (matches)
-    except _bt.error as e:
-        raise BluetoothError (*e.args)
+        """
+        return self.call (address, lambda session:
+                          _sdp_search (session, uuid, attrs, raw))
+
+    def prune (self):
+        """Closes the sessions that have been idle for too long."""
+        with self._lock:
+            self._prune ()
+
+    def close (self):
+        """Closes all idle sessions.  Sessions in use are closed when they
+        are released."""
+        with self._lock:
+            self._closed = True
+            while self._idle:
+                self._idle.popitem ()[1][0].close ()
+
+    def __len__ (self):
+        return len (self._idle)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
+
+def find_services (addresses=None, uuid=None, name=None, concurrency=8,
+                   timeout=None, pool=None, device_id=-1, duration=8,
+                   attrs=None, cache=None, compact=False):
+    """find_services (addresses=None, uuid=None, name=None, concurrency=8,
+                   timeout=None, pool=None, device_id=-1, duration=8,
+                   attrs=None, cache=None, compact=False) -> iterator of ServiceDiscoveryResult
+
+    Queries the SDP servers of many devices, up to concurrency at once,
+    for the services find_service would return, and yields the result of
+    each device as soon as its query ends.  If addresses is None, the
+    devices are found with an inquiry of the given duration on device_id,
+    and each device is queried as soon as it is discovered.
+
+    If timeout is given, the query of a device that takes longer than
+    timeout seconds is given up: its result is yielded with a timeout
+    error, and anything it finds later is dropped.
+
+    pool is the SDPSessionPool whose sessions are reused; by default
+    sessions are closed after one query.  The iterator must be exhausted
+    or closed to release the worker threads.
+
+    attrs is a list of the attribute IDs, and (first, last) ranges of
+    attribute IDs, to fetch from each record.  By default only the
+    attributes the fields of the results are made from are fetched.
+
+    If cache is a ServiceCache, devices whose records it holds are not
+    queried again until the records expire, and then only the
+    ServiceDatabaseState of the device is read if it validates them.
+
+    With compact, the records are fetched in their encoded form and
+    returned as ServiceRecord objects, which decode only the attributes
+    their fields are made from and keep the rest encoded; a cache then
+    holds the encoded records.
 
-    return results
+    """
+    if uuid is not None and not is_valid_uuid (uuid):
+        raise ValueError ("invalid UUID")
+    if addresses is not None:
+        addresses = list (dict.fromkeys (addresses))
+    return _find_services (addresses, uuid, name, max (1, concurrency),
+                           timeout, pool, device_id, duration, attrs, cache,
+                           compact)
+
+def _find_services (addresses, uuid, name, concurrency, timeout, pool,
+                    device_id, duration, attrs, cache, compact):
+    if pool is None:
+        pool = SDPSessionPool (idle_timeout=0)
+    results = queue.Queue ()
+    stop = threading.Event ()
+    submitted = set ()
+    executor = concurrent.futures.ThreadPoolExecutor (concurrency)
+
+    def query (address):
+        if stop.is_set ():
+            return
+        start = time.monotonic ()
+        results.put ((address, start, None))
+        try:
+            if cache is None:
+                services = pool.search (address, uuid, attrs, compact)
+            else:
+                services = _cached_search (pool, cache, address, uuid, attrs,
+                                           compact)
+            error = None
+        except BluetoothError as e:
+            services, error = [], e
+        if compact:
+            services = [ServiceRecord.from_raw (r, address) for r in services]
+        if name is not None:
+            services = [s for s in services if s.get ("name", "") == name]
+        for s in services:
+            s["host"] = address
+        results.put ((address, start, ServiceDiscoveryResult (address,
+                services, error, time.monotonic () - start)))
+
+    def submit (address):
+        if stop.is_set () or address in submitted:
+            return
+        submitted.add (address)
+        try:
+            executor.submit (query, address)
+        except RuntimeError:
+            # the executor was shut down since stop was checked
+            pass
+
+    def feed ():
+        # the inquiry runs in a thread of its own, and ends with None
+        try:
+            _AddressFeeder (device_id, submit, stop).run (duration)
+        except BluetoothError as e:
+            results.put (e)
+        finally:
+            results.put (None)
+
+    feeding = addresses is None
+    if feeding:
+        threading.Thread (target=feed, name="find_services inquiry",
+                          daemon=True).start ()
+    else:
+        for address in addresses:
+            submit (address)
+
+    deadlines = {}      # address -> deadline, for running queries
+    finished = 0
+    try:
+        while feeding or finished < len (submitted):
+            wait = None
+            if deadlines:
+                wait = max (0, min (deadlines.values ()) - time.monotonic ())
+            try:
+                item = results.get (timeout=wait)
+            except queue.Empty:
+                now = time.monotonic ()
+                for address, deadline in list (deadlines.items ()):
+                    if deadline <= now:
+                        del deadlines[address]
+                        finished += 1
+                        yield ServiceDiscoveryResult (address, [],
+                                BluetoothError (ETIMEDOUT, "SDP query of %s "
+                                                "timed out" % address),
+                                now - deadline + timeout)
+                continue
+            if item is None:
+                feeding = False
+            elif isinstance (item, BluetoothError):
+                raise item
+            else:
+                address, start, result = item
+                if result is None:
+                    if timeout is not None:
+                        deadlines[address] = start + timeout
+                elif timeout is None or address in deadlines:
+                    deadlines.pop (address, None)
+                    finished += 1
+                    yield result
+    finally:
+        stop.set ()
+        executor.shutdown (wait=False)
+        if pool is not None and pool.idle_timeout <= 0:
+            pool.close ()
 
 # ================ BlueZ internal methods ================
 def _gethcisock (device_id = -1):
     try:
-        sock = _bt.hci_open_dev (device_id)
-    except _bt.error as e:
+        if _hci_transport is None:
+            sock = _bt.hci_open_dev (device_id)
+        else:
+            sock = _hci_transport (device_id)
+    except (_bt.error, OSError) as e:
         raise BluetoothError (e.args[0], "error accessing bluetooth device: " +
                               e.args[1])
+    if _capture is not None:
+        # have the kernel timestamp the events we record
+        try:
+            sock.setsockopt (_bt.SOL_HCI, _bt.HCI_TIME_STAMP, 1)
+        except _bt.error:
+            pass
     return sock
 
+# ============== HCI transport ==============
+
+_hci_transport = None
+
+def set_hci_transport (transport):
+    """set_hci_transport (transport) -> the previous transport
+
+    Makes the BlueZ backend get its HCI sockets from transport (device_id)
+    instead of opening adapters, e.g. from the open method of a
+    bluetooth.emulator.VirtualController.  The returned objects must behave
+    like raw HCI sockets carrying H4 packets.  None goes back to the
+    adapters.
+
+    While a transport is set, discover_devices, lookup_name and
+    lookup_names run inquiries and name requests with HCI commands and
+    events of their own, instead of leaving them to the kernel and
+    libbluetooth, which only work on real HCI sockets.
+
+    """
+    global _hci_transport
+    previous, _hci_transport = _hci_transport, transport
+    return previous
+
+def _hci_inquiry (sock, duration, lookup_class, iac):
+    # what hci_inquiry has the kernel do, for sockets from a transport
+    lap = struct.pack ("<I", iac)[:3]
+    _hci_send_cmd (sock, _bt.OGF_LINK_CTL, _bt.OCF_INQUIRY,
+            lap + struct.pack ("BB", duration, 250))
+    found = {}
+    while True:
+        pkt = _hci_recv (sock)
+        event = get_byte (pkt[1])
+        if event == _bt.EVT_INQUIRY_RESULT or \
+                event == _bt.EVT_INQUIRY_RESULT_WITH_RSSI or \
+                (_bt.HAVE_EVT_EXTENDED_INQUIRY_RESULT and \
+                 event == _bt.EVT_EXTENDED_INQUIRY_RESULT):
+            results = decode_inquiry_results (event, pkt[3:])
+            for addr, device_class in zip (results.addresses,
+                                           results.classes):
+                found.setdefault (addr, device_class)
+        elif event == _bt.EVT_INQUIRY_COMPLETE:
+            break
+        elif event == _bt.EVT_CMD_STATUS:
+            status, ncmd, opcode = struct.unpack ("<BBH", pkt[3:7])
+            if opcode == _INQUIRY_OPCODE and status != 0:
+                raise BluetoothError (EIO,
+                        "inquiry failed with status 0x%02X" % status)
+    if lookup_class:
+        return list (found.items ())
+    return list (found)
+
+def _hci_read_remote_name (sock, address, timeout):
+    # what hci_read_remote_name does, for sockets from a transport
+    bdaddr = _bt.str2ba (address)
+    deadline = time.monotonic () + timeout
+    _hci_send_cmd (sock, _bt.OGF_LINK_CTL, _bt.OCF_REMOTE_NAME_REQ,
+            struct.pack ("<6sBBH", bdaddr, 0x02, 0, 0))
+    try:
+        while True:
+            remaining = deadline - time.monotonic ()
+            if remaining <= 0:
+                return None
+            sock.settimeout (remaining)
+            pkt = _hci_recv (sock)
+            event = get_byte (pkt[1])
+            if event == _bt.EVT_CMD_STATUS:
+                status, ncmd, opcode = struct.unpack ("<BBH", pkt[3:7])
+                if opcode == _REMOTE_NAME_REQ_OPCODE and status != 0:
+                    return None
+            elif event == _bt.EVT_REMOTE_NAME_REQ_COMPLETE and \
+                    pkt[4:10] == bdaddr:
+                if get_byte (pkt[3]) != 0:
+                    return None
+                return pkt[10:].split (b"\0")[0].decode ("utf-8", "replace")
+    finally:
+        sock.settimeout (None)
+
+# ============== HCI capture ==============
+
+_capture = None
+
+def set_capture (writer):
+    """set_capture (writer) -> the previous writer
+
+    Records every HCI command the BlueZ backend sends, and every event it
+    receives, to writer: a bluetooth.capture.CaptureWriter, or any object
+    with a write (packet, received, timestamp=None) method.  None stops
+    recording.
+
+    This covers DeviceDiscoverer, read_local_bdaddr and the functions that
+    use hci_send_req, whose response events are reconstructed from the
+    returned parameters.  The name lookups and inquiries that libbluetooth
+    performs itself, in lookup_name and discover_devices, are not seen.
+    HCI sockets opened while recording ask the kernel for timestamps, which
+    are used instead of the time the events were read.
+
+    """
+    global _capture
+    previous, _capture = _capture, writer
+    return previous
+
+_timeval = struct.Struct ("@ll")
+
+def _hci_send_cmd (sock, ogf, ocf, params=b""):
+    # the same packet libbluetooth's hci_send_cmd writes
+    pkt = struct.pack ("<BHB", _bt.HCI_COMMAND_PKT,
+            _bt.cmd_opcode_pack (ogf, ocf), len (params)) + params
+    capture = _capture
+    if capture is not None:
+        capture.write (pkt, False)
+    sock.send (pkt)
+
+def _hci_recv (sock, bufsize=258):
+    capture = _capture
+    if capture is None:
+        return sock.recv (bufsize)
+    buf = bytearray (bufsize)
+    n, ancdata, flags, addr = sock.recvmsg_into ([buf], 64)
+    timestamp = None
+    for level, ctype, data in ancdata:
+        if level == _bt.SOL_HCI and ctype == _bt.HCI_CMSG_TSTAMP and \
+                len (data) >= _timeval.size:
+            sec, usec = _timeval.unpack_from (data)
+            timestamp = sec + usec * 1e-6
+    pkt = bytes (buf[:n])
+    capture.write (pkt, True, timestamp)
+    return pkt
+
+def _hci_send_req (sock, ogf, ocf, event, rlen, params=b"", timeout=0):
+    capture = _capture
+    opcode = _bt.cmd_opcode_pack (ogf, ocf)
+    if capture is not None:
+        capture.write (struct.pack ("<BHB", _bt.HCI_COMMAND_PKT, opcode,
+                len (params)) + params, False)
+    response = _bt.hci_send_req (sock, ogf, ocf, event, rlen, params,
+            timeout)
+    if capture is not None:
+        if event == _bt.EVT_CMD_COMPLETE:
+            # hci_send_req strips Num_HCI_Command_Packets and the opcode
+            evt = struct.pack ("<BH", 1, opcode) + response
+        else:
+            evt = response
+        capture.write (struct.pack ("BBB", _bt.HCI_EVENT_PKT, event,
+                len (evt)) + evt, True)
+    return response
+
 def get_acl_conn_handle (hci_sock, addr):
     hci_fd = hci_sock.fileno ()
     reqstr = struct.pack ("6sB17s", _bt.str2ba (addr),
@@ -336,17 +1041,20 @@ def get_acl_conn_handle (hci_sock, addr):
         raise BluetoothError (e.args[0], "There is no ACL connection to %s" % addr)
 
     # XXX should this be "<8xH14x"?
-    handle = struct.unpack ("8xH14x", request.tostring ())[0]
+    handle = struct.unpack ("8xH14x", request.tobytes ())[0]
     return handle
 
 def write_flush_timeout (addr, timeout):
     hci_sock = _bt.hci_open_dev ()
-    # get the ACL connection handle to the remote device
-    handle = get_acl_conn_handle (hci_sock, addr)
-    # XXX should this be "<HH"
-    pkt = struct.pack ("HH", handle, _bt.htobs (timeout))
-    response = _bt.hci_send_req (hci_sock, _bt.OGF_HOST_CTL,
-        0x0028, _bt.EVT_CMD_COMPLETE, 3, pkt)
+    try:
+        # get the ACL connection handle to the remote device
+        handle = get_acl_conn_handle (hci_sock, addr)
+        # XXX should this be "<HH"
+        pkt = struct.pack ("HH", handle, _bt.htobs (timeout))
+        response = _hci_send_req (hci_sock, _bt.OGF_HOST_CTL,
+            _WRITE_FLUSH_TIMEOUT_OCF, _bt.EVT_CMD_COMPLETE, 3, pkt)
+    finally:
+        hci_sock.close ()
     status = get_byte(response[0])
     rhandle = struct.unpack ("H", response[1:3])[0]
     assert rhandle == handle
@@ -354,12 +1062,15 @@ def write_flush_timeout (addr, timeout):
 
 def read_flush_timeout (addr):
     hci_sock = _bt.hci_open_dev ()
-    # get the ACL connection handle to the remote device
-    handle = get_acl_conn_handle (hci_sock, addr)
-    # XXX should this be "<H"?
-    pkt = struct.pack ("H", handle)
-    response = _bt.hci_send_req (hci_sock, _bt.OGF_HOST_CTL,
-        0x0027, _bt.EVT_CMD_COMPLETE, 5, pkt)
+    try:
+        # get the ACL connection handle to the remote device
+        handle = get_acl_conn_handle (hci_sock, addr)
+        # XXX should this be "<H"?
+        pkt = struct.pack ("H", handle)
+        response = _hci_send_req (hci_sock, _bt.OGF_HOST_CTL,
+            _READ_FLUSH_TIMEOUT_OCF, _bt.EVT_CMD_COMPLETE, 5, pkt)
+    finally:
+        hci_sock.close ()
     status = get_byte(response[0])
     rhandle = struct.unpack ("H", response[1:3])[0]
     assert rhandle == handle
@@ -367,6 +1078,618 @@ def read_flush_timeout (addr):
     fto = struct.unpack ("H", response[3:5])[0]
     return fto
 
+# =============== HCIDevice ==================
+
+# Read and Write Automatic Flush Timeout, which libbluetooth has no names for
+_READ_FLUSH_TIMEOUT_OCF = 0x0027
+_WRITE_FLUSH_TIMEOUT_OCF = 0x0028
+
+# status of commands naming a connection handle that no longer exists
+_HCI_NO_CONNECTION = 0x02
+
+class HCIDevice:
+    """HCIDevice (device_id=-1, timeout=2.0)
+
+    A Bluetooth adapter, with one HCI socket that stays open until close ()
+    and is used for all of its commands.  read_flush_timeout,
+    write_flush_timeout and read_local_bdaddr open a socket of their own
+    for every call.
+
+    The ACL connection handles of remote devices are kept in a table.  A
+    handle is asked from the kernel the first time it is needed, and the
+    table follows the Connection Complete and Disconnection Complete events
+    the adapter reports from then on, so connections that come and go are
+    tracked without asking again.  Those events are read while commands
+    wait for their responses, and before every connection handle is
+    looked up; process_events () reads them in between, e.g. when
+    fileno () is readable.
+
+    timeout is the number of seconds to wait for the response to a
+    command.  Commands that fail raise BluetoothError.  An HCIDevice can
+    be used from several threads; its commands are run one at a time.
+
+    """
+    def __init__ (self, device_id=-1, timeout=2.0):
+        if device_id == -1 and _hci_transport is None:
+            try:
+                device_id = _bt.hci_get_route ()
+            except _bt.error as e:
+                raise BluetoothError (*e.args)
+        self.device_id = device_id
+        self.timeout = timeout
+        self._handles = {}      # address -> ACL connection handle
+        self._addresses = {}    # ACL connection handle -> address
+        self._lock = threading.Lock ()
+        self._sock = _gethcisock (device_id)
+        try:
+            flt = _bt.hci_filter_new ()
+            _bt.hci_filter_set_ptype (flt, _bt.HCI_EVENT_PKT)
+            for event in (_bt.EVT_CMD_COMPLETE, _bt.EVT_CMD_STATUS,
+                          _bt.EVT_CONN_COMPLETE, _bt.EVT_DISCONN_COMPLETE):
+                _bt.hci_filter_set_event (flt, event)
+            self._sock.setsockopt (_bt.SOL_HCI, _bt.HCI_FILTER, flt)
+        except _bt.error as e:
+            self._sock.close ()
+            raise BluetoothError (*e.args)
+
+    def _check (self):
+        if self._sock is None:
+            raise BluetoothError (EINVAL, "the HCI device is closed")
+
+    def _track (self, address, handle):
+        old = self._handles.pop (address, None)
+        if old is not None:
+            self._addresses.pop (old, None)
+        old = self._addresses.pop (handle, None)
+        if old is not None:
+            self._handles.pop (old, None)
+        self._handles[address] = handle
+        self._addresses[handle] = address
+
+    def _forget (self, handle):
+        address = self._addresses.pop (handle, None)
+        if address is not None:
+            del self._handles[address]
+
+    def _handle_event (self, pkt):
+        # called with the lock held, for events other than responses
+        event = get_byte (pkt[1])
+        if event == _bt.EVT_CONN_COMPLETE:
+            status, handle, bdaddr, link_type = \
+                    struct.unpack_from ("<BH6sB", pkt, 3)
+            if status == 0 and link_type == _bt.ACL_LINK:
+                self._track (_bt.ba2str (bdaddr), handle)
+        elif event == _bt.EVT_DISCONN_COMPLETE:
+            status, handle = struct.unpack_from ("<BH", pkt, 3)
+            if status == 0:
+                self._forget (handle)
+
+    def _drain (self):
+        # called with the lock held.  Reads the events that are waiting.
+        sock = self._sock
+        sock.settimeout (0)
+        while True:
+            try:
+                pkt = _hci_recv (sock)
+            except (_bt.error, OSError):
+                return
+            self._handle_event (pkt)
+
+    def _command (self, ogf, ocf, params=b""):
+        # called with the lock held.  Returns the return parameters of the
+        # Command Complete event, which start with the status.
+        self._check ()
+        sock = self._sock
+        opcode = _bt.cmd_opcode_pack (ogf, ocf)
+        deadline = time.monotonic () + self.timeout
+        try:
+            _hci_send_cmd (sock, ogf, ocf, params)
+            while True:
+                remaining = deadline - time.monotonic ()
+                if remaining <= 0:
+                    raise BluetoothError (ETIMEDOUT,
+                            "no response to HCI command 0x%04X" % opcode)
+                sock.settimeout (remaining)
+                pkt = _hci_recv (sock)
+                event = get_byte (pkt[1])
+                if event == _bt.EVT_CMD_COMPLETE and \
+                        struct.unpack_from ("<H", pkt, 4)[0] == opcode:
+                    return pkt[6:]
+                elif event == _bt.EVT_CMD_STATUS and get_byte (pkt[3]) and \
+                        struct.unpack_from ("<H", pkt, 5)[0] == opcode:
+                    # the command was refused
+                    return pkt[3:4]
+                self._handle_event (pkt)
+        except (_bt.timeout, socket.timeout):
+            raise BluetoothError (ETIMEDOUT,
+                    "no response to HCI command 0x%04X" % opcode)
+        except (_bt.error, OSError) as e:
+            raise BluetoothError (*e.args)
+
+    def _conn_handle (self, address):
+        # called with the lock held
+        self._check ()
+        self._drain ()
+        handle = self._handles.get (address)
+        if handle is None:
+            handle = get_acl_conn_handle (self._sock, address)
+            self._track (address, handle)
+        return handle
+
+    def _conn_command (self, address, ogf, ocf, params, fmt):
+        # runs a command whose parameters start with the connection handle
+        # of address, and returns its return parameters unpacked with fmt,
+        # without the status and the handle
+        address = address.upper ()
+        with self._lock:
+            handle = self._conn_handle (address)
+            response = self._command (ogf, ocf,
+                    struct.pack ("<H", handle) + params)
+            status = get_byte (response[0])
+            if status == _HCI_NO_CONNECTION:
+                self._forget (handle)
+        if status != 0:
+            raise BluetoothError (EIO, "HCI command 0x%04X failed with "
+                    "status 0x%02X" % (_bt.cmd_opcode_pack (ogf, ocf),
+                    status))
+        return struct.unpack_from ("<3x" + fmt, response)
+
+    def conn_handle (self, address):
+        """conn_handle (address) -> int
+
+        Returns the handle of the ACL connection to the device with the
+        given address.
+
+        """
+        with self._lock:
+            return self._conn_handle (address.upper ())
+
+    @property
+    def connections (self):
+        """A dictionary of the ACL connection handles known, by address."""
+        with self._lock:
+            if self._sock is not None:
+                self._drain ()
+            return dict (self._handles)
+
+    def process_events (self):
+        """process_events ()
+
+        Updates the connection handles from the events that are waiting,
+        without blocking.
+
+        """
+        with self._lock:
+            self._check ()
+            self._drain ()
+
+    def read_flush_timeout (self, address):
+        """read_flush_timeout (address) -> int
+
+        Returns the automatic flush timeout of the connection to address,
+        in units of 0.625 ms.  0 means packets are never flushed.
+
+        """
+        return self._conn_command (address, _bt.OGF_HOST_CTL,
+                _READ_FLUSH_TIMEOUT_OCF, b"", "H")[0]
+
+    def write_flush_timeout (self, address, timeout):
+        """write_flush_timeout (address, timeout)
+
+        Sets the automatic flush timeout of the connection to address, in
+        units of 0.625 ms.
+
+        """
+        self._conn_command (address, _bt.OGF_HOST_CTL,
+                _WRITE_FLUSH_TIMEOUT_OCF, struct.pack ("<H", timeout), "")
+
+    def read_rssi (self, address):
+        """read_rssi (address) -> int
+
+        Returns the RSSI of the connection to address, in dB.
+
+        """
+        return self._conn_command (address, _bt.OGF_STATUS_PARAM,
+                _bt.OCF_READ_RSSI, b"", "b")[0]
+
+    def read_link_quality (self, address):
+        """read_link_quality (address) -> int
+
+        Returns the link quality of the connection to address, from 0 to
+        255.  How it is measured depends on the adapter.
+
+        """
+        return self._conn_command (address, _bt.OGF_STATUS_PARAM,
+                _bt.OCF_READ_LINK_QUALITY, b"", "B")[0]
+
+    def read_clock (self, address=None):
+        """read_clock (address=None) -> (clock, accuracy)
+
+        Returns the native clock of the adapter, or the piconet clock of the
+        connection to address, in units of 312.5 us, and its accuracy, in
+        the same units.  The accuracy of the native clock is 0.
+
+        """
+        if address is not None:
+            return self._conn_command (address, _bt.OGF_STATUS_PARAM,
+                    _bt.OCF_READ_CLOCK, b"\x01", "IH")
+        with self._lock:
+            response = self._command (_bt.OGF_STATUS_PARAM,
+                    _bt.OCF_READ_CLOCK, b"\0\0\0")
+        status = get_byte (response[0])
+        if status != 0:
+            raise BluetoothError (EIO, "Read Clock failed with status "
+                    "0x%02X" % status)
+        return struct.unpack_from ("<3xIH", response)
+
+    def read_local_bdaddr (self):
+        """read_local_bdaddr () -> address
+
+        Returns the address of the adapter.
+
+        """
+        with self._lock:
+            response = self._command (_bt.OGF_INFO_PARAM,
+                    _bt.OCF_READ_BD_ADDR)
+        status = get_byte (response[0])
+        if status != 0:
+            raise BluetoothError (EIO, "Read BD_ADDR failed with status "
+                    "0x%02X" % status)
+        return _bt.ba2str (response[1:7])
+
+    def fileno (self):
+        """fileno () -> int
+
+        Returns the descriptor of the HCI socket, which is readable when
+        there are events for process_events ().
+
+        """
+        self._check ()
+        return self._sock.fileno ()
+
+    def close (self):
+        """Closes the HCI socket."""
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close ()
+                self._sock = None
+            self._handles.clear ()
+            self._addresses.clear ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
+
+# =============== HCICommandScheduler ==================
+
+HCICommandStats = collections.namedtuple ("HCICommandStats",
+        ["count", "timeouts", "mean_latency", "max_latency"])
+HCICommandStats.__doc__ = \
+    """The commands with one opcode that an HCICommandScheduler has sent:
+    how many were answered, how many were not answered in time, and the
+    mean and longest time to their answers, in seconds."""
+
+class HCICommand (concurrent.futures.Future):
+    """A command submitted to an HCICommandScheduler, as a future.
+
+    Its result is the return parameters of the Command Complete event that
+    answers it, which start with the status, or the status alone if it is
+    answered by a Command Status event.  A command that is not answered in
+    time, or not sent at all, fails with BluetoothError.  Commands that are
+    still waiting for their turn can be cancelled.
+
+    queued and sent are the time.monotonic () times at which the command
+    was submitted and sent, and latency is the number of seconds it took
+    to be answered once sent.
+
+    """
+    def __init__ (self, opcode, params):
+        super ().__init__ ()
+        self.opcode = opcode
+        self.params = params
+        self.queued = time.monotonic ()
+        self.sent = None
+        self.latency = None
+
+class HCICommandScheduler:
+    """HCICommandScheduler (device_id=-1, timeout=2.0, sock=None)
+
+    Sends HCI commands to an adapter without waiting for the answer to one
+    before sending the next.  The controller tells in every Command
+    Complete and Command Status event how many commands it accepts,
+    Num_HCI_Command_Packets; commands are sent as long as it accepts more,
+    and wait in a queue otherwise.  Answers are matched to the commands
+    sent by their opcode, in the order the commands were sent.
+
+    submit () returns an HCICommand, a concurrent.futures.Future, at once.
+    The other events of the adapter are passed to the callbacks given to
+    subscribe ().  Events are read by a thread of the scheduler, which
+    also runs the callbacks of the subscribers and of the futures, so they
+    must not block.
+
+    timeout is the number of seconds after which a command that was sent
+    but not answered fails.  sock is an object to use instead of an HCI
+    socket of device_id, like the one of DeviceDiscoverer.find_devices;
+    it also needs a fileno () method.
+
+    """
+    def __init__ (self, device_id=-1, timeout=2.0, sock=None):
+        if sock is None:
+            if device_id == -1 and _hci_transport is None:
+                try:
+                    device_id = _bt.hci_get_route ()
+                except _bt.error as e:
+                    raise BluetoothError (*e.args)
+            sock = _gethcisock (device_id)
+            try:
+                flt = _bt.hci_filter_new ()
+                _bt.hci_filter_all_events (flt)
+                _bt.hci_filter_set_ptype (flt, _bt.HCI_EVENT_PKT)
+                sock.setsockopt (_bt.SOL_HCI, _bt.HCI_FILTER, flt)
+            except _bt.error as e:
+                sock.close ()
+                raise BluetoothError (*e.args)
+        self.timeout = timeout
+        self.max_queue_depth = 0
+        self._sock = sock
+        self._lock = threading.Lock ()
+        self._credits = 1           # the controller starts with one
+        self._queue = collections.deque ()  # HCICommands not sent yet
+        self._sent = {}             # opcode -> deque of HCICommands sent
+        self._subscribers = {}      # event code -> list of callbacks
+        self._stats = {}            # opcode -> [count, timeouts, total, max]
+        self._closed = False
+        self._wake_r, self._wake_w = socket.socketpair ()
+        self._poller = Poller ()
+        self._poller.register (sock)
+        self._poller.register (self._wake_r)
+        self._thread = threading.Thread (target=self._run,
+                name="HCICommandScheduler", daemon=True)
+        self._thread.start ()
+
+    def submit (self, ogf, ocf, params=b""):
+        """submit (ogf, ocf, params=b"") -> HCICommand
+
+        Sends a command as soon as the controller accepts it.
+
+        """
+        return self.submit_many ([(ogf, ocf, params)])[0]
+
+    def submit_many (self, commands):
+        """submit_many (commands) -> list of HCICommand
+
+        Submits a sequence of (ogf, ocf, params) tuples, which are sent in
+        that order.
+
+        """
+        futures = [HCICommand (_bt.cmd_opcode_pack (ogf, ocf), bytes (params))
+                   for ogf, ocf, params in commands]
+        with self._lock:
+            if self._closed:
+                raise BluetoothError (EINVAL,
+                        "the command scheduler is closed")
+            self._queue.extend (futures)
+            self.max_queue_depth = max (self.max_queue_depth,
+                                        len (self._queue))
+            failed = self._pump ()
+        self._fail (failed)
+        return futures
+
+    def subscribe (self, event, callback):
+        """subscribe (event, callback)
+
+        Has callback (event, params) called for every event with the given
+        code, without its header.  Command Complete and Command Status
+        events are only passed on when they answer none of the commands of
+        the scheduler, e.g. when another program sent the command.
+
+        """
+        with self._lock:
+            self._subscribers.setdefault (event, []).append (callback)
+
+    def unsubscribe (self, event, callback):
+        """unsubscribe (event, callback)
+
+        Stops calling a callback given to subscribe ().
+
+        """
+        with self._lock:
+            callbacks = self._subscribers.get (event, [])
+            if callback in callbacks:
+                callbacks.remove (callback)
+
+    @property
+    def credits (self):
+        """The number of commands the controller accepts now."""
+        return self._credits
+
+    @property
+    def queue_depth (self):
+        """The number of commands waiting for the controller to accept
+        them."""
+        return len (self._queue)
+
+    @property
+    def in_flight (self):
+        """The number of commands sent and not answered yet."""
+        with self._lock:
+            return sum (len (sent) for sent in self._sent.values ())
+
+    def stats (self):
+        """stats () -> dict
+
+        Returns an HCICommandStats for every opcode sent, by opcode.
+
+        """
+        stats = {}
+        with self._lock:
+            for opcode, (count, timeouts, total, longest) in \
+                    self._stats.items ():
+                mean = total / count if count else 0.0
+                stats[opcode] = HCICommandStats (count, timeouts, mean,
+                                                 longest)
+        return stats
+
+    def _pump (self):
+        # called with the lock held.  Sends the commands the controller
+        # accepts, and returns those that could not be sent.
+        failed = []
+        was_idle = not any (self._sent.values ())
+        while self._queue and self._credits > 0:
+            command = self._queue.popleft ()
+            if not command.set_running_or_notify_cancel ():
+                continue
+            try:
+                _hci_send_cmd (self._sock, command.opcode >> 10,
+                               command.opcode & 0x03ff, command.params)
+            except (_bt.error, OSError) as e:
+                failed.append ((command, BluetoothError (*e.args)))
+                continue
+            command.sent = time.monotonic ()
+            self._credits -= 1
+            self._sent.setdefault (command.opcode,
+                                   collections.deque ()).append (command)
+        if was_idle and any (self._sent.values ()):
+            # the reader waits without a timeout while nothing is sent
+            self._wake_w.send (b"\0")
+        return failed
+
+    @staticmethod
+    def _fail (failed):
+        for command, error in failed:
+            command.set_exception (error)
+
+    def _answer (self, opcode):
+        # called with the lock held
+        sent = self._sent.get (opcode)
+        if not sent:
+            return None
+        command = sent.popleft ()
+        command.latency = time.monotonic () - command.sent
+        stats = self._stats.setdefault (opcode, [0, 0, 0.0, 0.0])
+        stats[0] += 1
+        stats[2] += command.latency
+        stats[3] = max (stats[3], command.latency)
+        return command
+
+    def _expire (self):
+        # called with the lock held.  Returns the commands that timed out,
+        # and the time the next one does.
+        now = time.monotonic ()
+        expired = []
+        deadline = None
+        for opcode, sent in self._sent.items ():
+            while sent and sent[0].sent + self.timeout <= now:
+                command = sent.popleft ()
+                self._stats.setdefault (opcode, [0, 0, 0.0, 0.0])[1] += 1
+                expired.append ((command, BluetoothError (ETIMEDOUT,
+                        "no response to HCI command 0x%04X" % opcode)))
+            if sent and (deadline is None or
+                         sent[0].sent + self.timeout < deadline):
+                deadline = sent[0].sent + self.timeout
+        if expired:
+            # the answer is lost, and with it the credit it would return
+            self._credits = max (self._credits, 1)
+        return expired, deadline
+
+    def _event (self, pkt):
+        if len (pkt) < 3 or get_byte (pkt[0]) != _bt.HCI_EVENT_PKT:
+            return
+        event = get_byte (pkt[1])
+        params = pkt[3:]
+        command = None
+        failed = []
+        with self._lock:
+            opcode = None
+            if event == _bt.EVT_CMD_COMPLETE and len (params) >= 3:
+                ncmd, opcode = struct.unpack_from ("<BH", params)
+                result = params[3:]
+            elif event == _bt.EVT_CMD_STATUS and len (params) >= 4:
+                status, ncmd, opcode = struct.unpack_from ("<BBH", params)
+                result = params[:1]
+            if opcode is not None:
+                self._credits = ncmd
+                command = self._answer (opcode)
+                failed = self._pump ()
+            if command is None:
+                callbacks = list (self._subscribers.get (event, ()))
+        self._fail (failed)
+        if command is not None:
+            command.set_result (result)
+            return
+        for callback in callbacks:
+            try:
+                callback (event, params)
+            except Exception:
+                sys.excepthook (*sys.exc_info ())
+
+    def _run (self):
+        sock = self._sock
+        error = None
+        while True:
+            with self._lock:
+                if self._closed:
+                    break
+                expired, deadline = self._expire ()
+                failed = self._pump () if expired else []
+            self._fail (expired + failed)
+            timeout = None
+            if deadline is not None:
+                timeout = max (0.0, deadline - time.monotonic ())
+            for obj, events in self._poller.poll (timeout):
+                if obj is self._wake_r:
+                    self._wake_r.recv (64)
+                    continue
+                try:
+                    pkt = _hci_recv (sock)
+                except (_bt.error, OSError) as e:
+                    error = BluetoothError (*e.args)
+                    break
+                self._event (pkt)
+            if error is not None:
+                break
+        self._shutdown (error or BluetoothError (ECONNRESET,
+                "the command scheduler is closed"))
+
+    def _shutdown (self, error):
+        # called by the thread as it ends
+        with self._lock:
+            self._closed = True
+            queued = list (self._queue)
+            self._queue.clear ()
+            sent = []
+            for commands in self._sent.values ():
+                sent.extend (commands)
+            self._sent.clear ()
+        for command in queued:
+            if command.set_running_or_notify_cancel ():
+                command.set_exception (error)
+        for command in sent:
+            command.set_exception (error)
+        self._poller.close ()
+        self._sock.close ()
+        self._wake_r.close ()
+        self._wake_w.close ()
+
+    def close (self):
+        """Stops the scheduler, failing the commands that are not answered,
+        and closes its socket."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wake_w.send (b"\0")
+        if threading.current_thread () is not self._thread:
+            self._thread.join ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
+
 # =============== DeviceDiscoverer ==================
 def byte_to_signed_int(byte_):
     if byte_ > 127:
@@ -383,27 +1706,58 @@ class DeviceDiscoverer:
     DeviceDiscoverer and override device_discovered () and
     inquiry_complete ()
     """
-    def __init__ (self, device_id=-1):
+    def __init__ (self, device_id=-1, max_name_requests=3,
+            name_cache_ttl=300, cache=None):
         """
-        __init__ (device_id=-1)
+        __init__ (device_id=-1, max_name_requests=3, name_cache_ttl=300,
+                  cache=None)
 
         device_id - The ID of the Bluetooth adapter that will be used
                     for discovery.
+
+        max_name_requests - the maximum number of remote name requests
+                    to keep in flight at once.  If the controller rejects a
+                    request because it is busy, the limit is lowered to
+                    what the controller accepts.
+
+        name_cache_ttl - the number of seconds a resolved name is reused
+                    for by later inquiries with this DeviceDiscoverer
+                    instead of being requested again.  0 disables the
+                    cache.  Ignored if cache is given.
+
+        cache - a DeviceCache to use instead of a private one.  It can be
+                    shared with other DeviceDiscoverers, lookup_name and
+                    discover_devices, or kept on disk.  Every device seen is
+                    recorded in it, and devices whose name lookup failed
+                    recently are not asked again.
         """
         self.sock = None
         self.is_inquiring = False
         self.lookup_names = False
         self.device_id = device_id
+        self.max_name_requests = max_name_requests
+        self.name_cache_ttl = name_cache_ttl
 
         self.names_to_find = {}
         self.names_found = {}
+        if cache is None and name_cache_ttl:
+            cache = DeviceCache (ttl=name_cache_ttl, negative_ttl=0)
+        self.cache = cache
+        self._reset_name_requests ()
+
+    def _reset_name_requests (self):
+        self._name_queue = []
+        self._names_in_flight = {}
+        self._name_status_pending = collections.deque ()
+        self._name_req_limit = max (1, self.max_name_requests)
+        self._name_req_seq = 0
 
     def find_devices (self, lookup_names=True,
             duration=8,
-            flush_cache=True):
+            flush_cache=True, sock=None):
         """
         find_devices (lookup_names=True, service_name=None,
-                       duration=8, flush_cache=True)
+                       duration=8, flush_cache=True, sock=None)
 
         Call this method to initiate the device discovery process
 
@@ -423,21 +1777,29 @@ class DeviceDiscoverer:
                    inquiry process can take a lot longer.
 
         flush_cache - return devices discovered in previous inquiries
+
+        sock - an object to use instead of an HCI socket of device_id.  It
+                   needs send (), recv () and close () methods that take
+                   and return H4 packets, like those of a raw HCI socket.
+                   See bluetooth.replay and bluetooth.emulator.
         """
         if self.is_inquiring:
             raise BluetoothError (EBUSY, "Already inquiring!")
 
         self.lookup_names = lookup_names
 
-        self.sock = _gethcisock (self.device_id)
-        flt = _bt.hci_filter_new ()
-        _bt.hci_filter_all_events (flt)
-        _bt.hci_filter_set_ptype (flt, _bt.HCI_EVENT_PKT)
+        if sock is not None:
+            self.sock = sock
+        else:
+            self.sock = _gethcisock (self.device_id)
+            flt = _bt.hci_filter_new ()
+            _bt.hci_filter_all_events (flt)
+            _bt.hci_filter_set_ptype (flt, _bt.HCI_EVENT_PKT)
 
-        try:
-            self.sock.setsockopt (_bt.SOL_HCI, _bt.HCI_FILTER, flt)
-        except _bt.error as e:
-            raise BluetoothError (*e.args)
+            try:
+                self.sock.setsockopt (_bt.SOL_HCI, _bt.HCI_FILTER, flt)
+            except _bt.error as e:
+                raise BluetoothError (*e.args)
 
         # send the inquiry command
         max_responses = 255
@@ -447,7 +1809,7 @@ class DeviceDiscoverer:
         self.pre_inquiry ()
 
         try:
-            _bt.hci_send_cmd (self.sock, _bt.OGF_LINK_CTL, \
+            _hci_send_cmd (self.sock, _bt.OGF_LINK_CTL, \
                     _bt.OCF_INQUIRY, cmd_pkt)
         except _bt.error as e:
             raise BluetoothError (*e.args)
@@ -456,6 +1818,7 @@ class DeviceDiscoverer:
 
         self.names_to_find = {}
         self.names_found = {}
+        self._reset_name_requests ()
 
     def cancel_inquiry (self):
         """
@@ -463,10 +1826,11 @@ class DeviceDiscoverer:
         will still be called.
         """
         self.names_to_find = {}
+        self._reset_name_requests ()
 
         if self.is_inquiring:
             try:
-                _bt.hci_send_cmd (self.sock, _bt.OGF_LINK_CTL, \
+                _hci_send_cmd (self.sock, _bt.OGF_LINK_CTL, \
                         _bt.OCF_INQUIRY_CANCEL)
             except _bt.error as e:
                 self.sock.close ()
@@ -495,150 +1859,171 @@ class DeviceDiscoverer:
         # FIXME may not wrap _bluetooth.error properly
         if self.sock is None: return
         # voodoo magic!!!
-        pkt = self.sock.recv (258)
+        pkt = _hci_recv (self.sock)
         ptype, event, plen = struct.unpack ("BBB", pkt[:3])
         pkt = pkt[3:]
-        if event == _bt.EVT_INQUIRY_RESULT:
-            nrsp = get_byte(pkt[0])
-            for i in range (nrsp):
-                addr = _bt.ba2str (pkt[1+6*i:1+6*i+6])
-                psrm = pkt[ 1+6*nrsp+i ]
-                pspm = pkt[ 1+7*nrsp+i ]
-                devclass_raw = struct.unpack ("BBB",
-                        pkt[1+9*nrsp+3*i:1+9*nrsp+3*i+3])
-                devclass = (devclass_raw[2] << 16) | \
-                        (devclass_raw[1] << 8) | \
-                        devclass_raw[0]
-                clockoff = pkt[1+12*nrsp+2*i:1+12*nrsp+2*i+2]
-
-                self._device_discovered (addr, devclass,
-                        psrm, pspm, clockoff, None, None)
-        elif event == _bt.EVT_INQUIRY_RESULT_WITH_RSSI:
-            nrsp = get_byte(pkt[0])
-            for i in range (nrsp):
-                addr = _bt.ba2str (pkt[1+6*i:1+6*i+6])
-                psrm = pkt[ 1+6*nrsp+i ]
-                pspm = pkt[ 1+7*nrsp+i ]
-#                devclass_raw = pkt[1+8*nrsp+3*i:1+8*nrsp+3*i+3]
-#                devclass = struct.unpack ("I", "%s\0" % devclass_raw)[0]
-                devclass_raw = struct.unpack ("BBB",
-                        pkt[1+8*nrsp+3*i:1+8*nrsp+3*i+3])
-                devclass = (devclass_raw[2] << 16) | \
-                        (devclass_raw[1] << 8) | \
-                        devclass_raw[0]
-                clockoff = pkt[1+11*nrsp+2*i:1+11*nrsp+2*i+2]
-                rssi = byte_to_signed_int(get_byte(pkt[1+13*nrsp+i]))
-
-                self._device_discovered (addr, devclass,
-                        psrm, pspm, clockoff, rssi, None)
-        elif _bt.HAVE_EVT_EXTENDED_INQUIRY_RESULT and event == _bt.EVT_EXTENDED_INQUIRY_RESULT:
-            nrsp = get_byte(pkt[0])
-            for i in range (nrsp):
-                addr = _bt.ba2str (pkt[1+6*i:1+6*i+6])
-                psrm = pkt[ 1+6*nrsp+i ]
-                pspm = pkt[ 1+7*nrsp+i ]
-                devclass_raw = struct.unpack ("BBB",
-                        pkt[1+8*nrsp+3*i:1+8*nrsp+3*i+3])
-                devclass = (devclass_raw[2] << 16) | \
-                        (devclass_raw[1] << 8) | \
-                        devclass_raw[0]
-                clockoff = pkt[1+11*nrsp+2*i:1+11*nrsp+2*i+2]
-                rssi = byte_to_signed_int(get_byte(pkt[1+13*nrsp+i]))
-
-                data_len = _bt.EXTENDED_INQUIRY_INFO_SIZE - _bt.INQUIRY_INFO_WITH_RSSI_SIZE
-                data = pkt[1+14*nrsp+i:1+14*nrsp+i+data_len]
+        if event == _bt.EVT_INQUIRY_RESULT or \
+                event == _bt.EVT_INQUIRY_RESULT_WITH_RSSI or \
+                (_bt.HAVE_EVT_EXTENDED_INQUIRY_RESULT and \
+                 event == _bt.EVT_EXTENDED_INQUIRY_RESULT):
+            results = decode_inquiry_results (event, pkt)
+            rssi = results.rssi or [None] * len (results.addresses)
+            for i, addr in enumerate (results.addresses):
                 name = None
-                pos = 0
-                while(pos <= len(data)):
-                    struct_len = get_byte(data[pos])
-                    if struct_len == 0:
-                        break
-                    eir_type = get_byte(data[pos+1])
-                    if eir_type == 0x09: # Complete local name
-                        name = data[pos+2:pos+struct_len+1]
-                    pos += struct_len + 2
-
-                self._device_discovered (addr, devclass,
-                        psrm, pspm, clockoff, rssi, name)
-        elif event == _bt.EVT_INQUIRY_COMPLETE or event == _bt.EVT_CMD_COMPLETE:
+                if results.eir is not None:
+                    eir = parse_eir (results.eir[i])
+                    self.eir_received (addr, eir)
+                    if eir.name_complete:
+                        name = eir.name
+
+                self._device_discovered (addr, results.classes[i],
+                        results.pscan_rep_modes[i],
+                        results.pscan_period_modes[i],
+                        results.clock_offsets[i], rssi[i], name)
+        elif event == _bt.EVT_INQUIRY_COMPLETE or \
+                (event == _bt.EVT_CMD_COMPLETE and
+                 struct.unpack ("<xH", pkt[:3])[0] == _INQUIRY_CANCEL_OPCODE):
             self.is_inquiring = False
             if len (self.names_to_find) == 0:
-#                print "inquiry complete (evt_inquiry_complete)"
-                self.sock.close ()
                 self._inquiry_complete ()
             else:
-                self._send_next_name_req ()
+                self._send_name_requests ()
 
         elif event == _bt.EVT_CMD_STATUS:
-            # XXX shold this be "<BBH"
-            status, ncmd, opcode = struct.unpack ("BBH", pkt[:4])
-            if status != 0:
+            status, ncmd, opcode = struct.unpack ("<BBH", pkt[:4])
+            if opcode == _REMOTE_NAME_REQ_OPCODE:
+                self._name_request_status (status)
+            elif status != 0 and opcode == _INQUIRY_OPCODE:
                 self.is_inquiring = False
-                self.sock.close ()
-
-#                print "inquiry complete (bad status 0x%X 0x%X 0x%X)" % \
-#                        (status, ncmd, opcode)
                 self.names_to_find = {}
+                self._reset_name_requests ()
                 self._inquiry_complete ()
         elif event == _bt.EVT_REMOTE_NAME_REQ_COMPLETE:
             status = get_byte(pkt[0])
             addr = _bt.ba2str (pkt[1:7])
+            if addr not in self._names_in_flight:
+                # not one of ours
+                return
+            del self._names_in_flight[addr]
             if status == 0:
-                try:
-                    name = pkt[7:].split ('\0')[0]
-                except IndexError:
-                    name = ''
-                if addr in self.names_to_find:
-                    device_class, rssi = self.names_to_find[addr][:2]
-                    self.device_discovered (addr, device_class, rssi, name)
-                    del self.names_to_find[addr]
-                    self.names_found[addr] = ( device_class, rssi, name)
-                else:
-                    pass
+                name = pkt[7:].split (b'\0')[0].decode ("utf-8", "replace")
+                device_class, rssi = self.names_to_find.pop (addr)[:2]
+                if self.cache is not None:
+                    self.cache.set_name (addr, name)
+                self.names_found[addr] = ( device_class, rssi, name)
+                self.device_discovered (addr, device_class, rssi, name)
             else:
-                if addr in self.names_to_find: del self.names_to_find[addr]
-                # XXX should we do something when a name lookup fails?
-#                print "name req unsuccessful %s - %s" % (addr, status)
+                self._name_failed (addr)
 
-            if len (self.names_to_find) == 0:
-                self.is_inquiring = False
-                self.sock.close ()
-                self.inquiry_complete ()
-#                print "inquiry complete (name req complete)"
-            else:
-                self._send_next_name_req ()
+            self._names_progress ()
         else:
             pass
 #            print "unrecognized packet type 0x%02x" % ptype
 
+    def _names_progress (self):
+        if self.is_inquiring:
+            return
+        if len (self.names_to_find) == 0:
+            self._inquiry_complete ()
+        else:
+            self._send_name_requests ()
+
     def _device_discovered (self, address, device_class,
             psrm, pspm, clockoff, rssi, name):
+        if self.cache is not None:
+            self.cache.seen (address, device_class, rssi)
+            if name is not None:
+                self.cache.set_name (address, name)
         if self.lookup_names:
+            failed = False
+            if name is None and self.cache is not None:
+                failed, name = self.cache.lookup_name (address)
             if name is not None:
                 self.device_discovered (address, device_class, rssi, name)
+            elif failed:
+                # the name lookup failed recently, don't wait for it again
+                pass
             elif address not in self.names_found and \
                 address not in self.names_to_find:
 
                 self.names_to_find[address] = \
                     (device_class, rssi, psrm, pspm, clockoff)
+                priority = self.name_request_priority (address,
+                        device_class, rssi)
+                self._name_req_seq += 1
+                heapq.heappush (self._name_queue,
+                        (priority, self._name_req_seq, address))
         else:
             self.device_discovered (address, device_class, rssi, None)
 
-    def _send_next_name_req (self):
-        assert len (self.names_to_find) > 0
-        address = list(self.names_to_find.keys ())[0]
+    def _name_failed (self, address):
+        # XXX should we do something else when a name lookup fails?
+        self.names_to_find.pop (address, None)
+        if self.cache is not None:
+            self.cache.name_failed (address)
+
+    def _send_name_requests (self):
+        while self._name_queue and \
+                len (self._names_in_flight) < self._name_req_limit:
+            address = heapq.heappop (self._name_queue)[2]
+            if address in self.names_to_find:
+                self._send_name_req (address)
+
+    def _send_name_req (self, address):
         device_class, rssi, psrm, pspm, clockoff = self.names_to_find[address]
-        bdaddr = _bt.str2ba (address) #TODO not supported in python3
+        bdaddr = _bt.str2ba (address)
 
-        cmd_pkt = "{}{}\0{}".format(bdaddr, psrm, clockoff)
+        # reuse the page scan repetition mode and clock offset reported in
+        # the inquiry result, so the controller doesn't have to page blind.
+        # Bit 15 marks the clock offset as valid.
+        cmd_pkt = struct.pack ("<6sBBH", bdaddr, psrm, 0, clockoff | 0x8000)
 
         try:
-            _bt.hci_send_cmd (self.sock, _bt.OGF_LINK_CTL, \
+            _hci_send_cmd (self.sock, _bt.OGF_LINK_CTL, \
                     _bt.OCF_REMOTE_NAME_REQ, cmd_pkt)
         except _bt.error as e:
             raise BluetoothError (e.args[0],
                                   "error request name of %s - %s:" %
                     (address, e.args[1]))
+        self._names_in_flight[address] = time.monotonic ()
+        self._name_status_pending.append (address)
+
+    def _name_request_status (self, status):
+        if not self._name_status_pending:
+            # not one of ours
+            return
+        address = self._name_status_pending.popleft ()
+        if status == 0:
+            return
+
+        # the controller refused the request.  If other requests are still
+        # running it is probably busy, so retry once they finish and keep
+        # fewer requests in flight from now on.  Otherwise give up on this
+        # device.
+        self._names_in_flight.pop (address, None)
+        if self._names_in_flight:
+            self._name_req_limit = max (1, len (self._names_in_flight))
+            priority = self.name_request_priority (address,
+                    *self.names_to_find[address][:2])
+            self._name_req_seq += 1
+            heapq.heappush (self._name_queue,
+                    (priority, self._name_req_seq, address))
+        else:
+            self._name_failed (address)
+            self._names_progress ()
+
+    def name_request_priority (self, address, device_class, rssi):
+        """
+        Returns the priority with which the name of a device is requested.
+        Devices with lower values are asked first.  The default asks the
+        devices with the strongest signal first, since they are the most
+        likely to answer quickly.
+
+        This method exists to be overriden.
+        """
+        if rssi is None:
+            return 0
+        return -rssi
 
     def fileno (self):
         if not self.sock: return None
@@ -652,6 +2037,19 @@ class DeviceDiscoverer:
         This method exists to be overriden
         """
 
+    def eir_received (self, address, eir):
+        """
+        Called when an extended inquiry response is received from a device,
+        just before device_discovered.
+
+        address is the bluetooth address of the device
+
+        eir is a bluetooth.eir.EIRData record with the decoded response,
+        including the advertised service UUIDs and manufacturer data.
+
+        This method exists to be overriden.
+        """
+
     def device_discovered (self, address, device_class, rssi, name):
         """
         Called when a bluetooth device is discovered.
@@ -689,3 +2087,30 @@ class DeviceDiscoverer:
         Called when an inquiry started by find_devices has completed.
         """
         print("inquiry complete")
+
+class _AddressFeeder (DeviceDiscoverer):
+    # passes the devices found by an inquiry to submit as they are found
+    def __init__ (self, device_id, submit, stop):
+        DeviceDiscoverer.__init__ (self, device_id)
+        self._submit = submit
+        self._stop = stop
+
+    def run (self, duration):
+        self.find_devices (lookup_names=False, duration=duration)
+        while self.is_inquiring:
+            if self._stop.is_set ():
+                self.cancel_inquiry ()
+                break
+            self.process_event ()
+        if self.sock is not None:
+            self.sock.close ()
+            self.sock = None
+
+    def pre_inquiry (self):
+        pass
+
+    def device_discovered (self, address, device_class, rssi, name):
+        self._submit (address)
+
+    def inquiry_complete (self):
+        pass
@@ -1,6 +1,7 @@
 import sys
 import struct
 import binascii
+from collections.abc import Mapping
 
 L2CAP=0
 RFCOMM=3
@@ -279,125 +280,507 @@ def sdp_parse_uuid (data, size):
     elif size == 4:
         return binascii.hexlify (data)
     elif size == 16:
-        return "%08X-%04X-%04X-%04X-%04X%08X" % struct.unpack ("!IHHHHI", data)
-    else: return ValueError ("invalid UUID size")
+        return "%08X-%04X-%04X-%04X-%04X%08X" % _sdp_uuid128.unpack (data)
+    else: raise ValueError ("invalid UUID size")
 
 def sdp_parse_int (data, size, signed):
-    fmts = { 1 : "!b" , 2 : "!h" , 4 : "!i" , 8 : "!q" , 16 : "!qq" }
-    fmt = fmts[size]
-    if not signed: fmt = fmt.upper ()
-    if fmt in [ "!qq", "!QQ" ]:
-        upp, low = struct.unpack ("!QQ", data)
-        result = ( upp << 64) | low
-        if signed:
-            result=- ((~ (result-1))&0x7FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF)
-        return result
+    return int.from_bytes (data, "big", signed=signed)
+
+# The decoder below works on offsets into a single memoryview so that a
+# record is walked exactly once, without re-slicing the remaining data for
+# every element.  Only leaf values (strings, URLs) are copied out.
+
+_sdp_uuid128 = struct.Struct ("!IHHHHI")
+_sdp_fixed_sizes = (1, 2, 4, 8, 16)
+_sdp_int_structs = {
+    (1, False) : struct.Struct ("!B"), (1, True) : struct.Struct ("!b"),
+    (2, False) : struct.Struct ("!H"), (2, True) : struct.Struct ("!h"),
+    (4, False) : struct.Struct ("!I"), (4, True) : struct.Struct ("!i"),
+    (8, False) : struct.Struct ("!Q"), (8, True) : struct.Struct ("!q"),
+    }
+_sdp_u16 = struct.Struct ("!H")
+_sdp_u32 = struct.Struct ("!I")
+
+def _sdp_header (buf, pos, end):
+    """decodes the type/size descriptor at buf[pos].  Returns the data
+    element type, the size of its body and the offset of its body."""
+    if pos >= end:
+        raise ValueError ("truncated SDP data element at offset %d" % pos)
+    dts = buf[pos]
+    dtype, dsizedesc = dts >> 3, dts & 0x7
+    pos += 1
+    if dtype > 8:
+        raise ValueError ("Invalid TypeSizeDescriptor byte %02x %d, %d" \
+                % (dts, dtype, dsizedesc))
+    if dtype == 0:
+        dsize = 0
+    elif dsizedesc < 5:
+        dsize = _sdp_fixed_sizes[dsizedesc]
+    elif dsizedesc == 5:
+        if pos + 1 > end: raise ValueError ("truncated SDP size descriptor")
+        dsize = buf[pos]
+        pos += 1
+    elif dsizedesc == 6:
+        if pos + 2 > end: raise ValueError ("truncated SDP size descriptor")
+        dsize = _sdp_u16.unpack_from (buf, pos)[0]
+        pos += 2
+    else:
+        if pos + 4 > end: raise ValueError ("truncated SDP size descriptor")
+        dsize = _sdp_u32.unpack_from (buf, pos)[0]
+        pos += 4
+    if pos + dsize > end:
+        raise ValueError ("truncated SDP data element at offset %d" % pos)
+    return dtype, dsize, pos
+
+def _sdp_decode (buf, pos, end):
+    dtype, dsize, pos = _sdp_header (buf, pos, end)
+    epos = pos + dsize
+
+    if dtype == 1 or dtype == 2:
+        signed = dtype == 2
+        fmt = _sdp_int_structs.get ((dsize, signed))
+        if fmt is not None:
+            rval = fmt.unpack_from (buf, pos)[0]
+        else:
+            rval = int.from_bytes (buf[pos:epos], "big", signed=signed)
+        rtype = ("SInt%d" if signed else "UInt%d") % (dsize*8)
+    elif dtype == 6 or dtype == 7:
+        rval = []
+        while pos < epos:
+            rtype, item, pos = _sdp_decode (buf, pos, epos)
+            rval.append ( (rtype, item))
+        rtype = "ElemSeq" if dtype == 6 else "AltElemSeq"
+    elif dtype == 3:
+        rtype, rval = "UUID", sdp_parse_uuid (buf[pos:epos], dsize)
+    elif dtype == 4:
+        rtype, rval = "String", bytes (buf[pos:epos])
+    elif dtype == 0:
+        rtype, rval = "Nil", None
+    elif dtype == 5:
+        rtype, rval = "Bool", buf[pos] != 0
     else:
-        return struct.unpack (fmt, data)[0]
+        rtype, rval = "URL", bytes (buf[pos:epos])
+
+    return rtype, rval, epos
+
+def sdp_decode_data_element (data, pos=0, end=None):
+    """sdp_decode_data_element (data, pos=0, end=None) -> (type, value, next)
+
+    Decodes the SDP data element starting at offset pos of data, which may
+    be any object supporting the buffer protocol.  Nested sequences are
+    decoded in the same pass.  Returns the element type, its value, and the
+    offset just past the element.
+
+    """
+    buf = data if isinstance (data, memoryview) else memoryview (data)
+    if buf.ndim != 1 or buf.itemsize != 1:
+        buf = buf.cast ("B")
+    if end is None:
+        end = len (buf)
+    return _sdp_decode (buf, pos, end)
 
 def sdp_parse_data_elementSequence (data):
+    buf = memoryview (data)
     result = []
     pos = 0
-    datalen = len (data)
+    datalen = len (buf)
     while pos < datalen:
-        rtype, rval, consumed = sdp_parse_data_element (data[pos:])
-        pos += consumed
+        rtype, rval, pos = _sdp_decode (buf, pos, datalen)
         result.append ( (rtype, rval))
     return result
 
 def sdp_parse_data_element (data):
-    dtype, dsize, dstart = sdp_parse_size_desc (data)
-    elem = data[dstart:dstart+dsize]
-
-    if dtype == 0:
-        rtype, rval = "Nil", None
-    elif dtype == 1:
-        rtype, rval = "UInt%d"% (dsize*8), sdp_parse_int (elem, dsize, False)
-    elif dtype == 2:
-        rtype, rval = "SInt%d"% (dsize*8), sdp_parse_int (elem, dsize, True)
-    elif dtype == 3:
-        rtype, rval = "UUID", sdp_parse_uuid (elem, dsize)
-    elif dtype == 4:
-        rtype, rval = "String", elem
-    elif dtype == 5:
-        rtype, rval = "Bool", (struct.unpack ("B", elem)[0] != 0)
-    elif dtype == 6:
-        rtype, rval = "ElemSeq", sdp_parse_data_elementSequence (elem)
-    elif dtype == 7:
-        rtype, rval = "AltElemSeq", sdp_parse_data_elementSequence (elem)
-    elif dtype == 8:
-        rtype, rval = "URL", elem
-
-    return rtype, rval, dstart+dsize
+    rtype, rval, consumed = sdp_decode_data_element (data)
+    return rtype, rval, consumed
 
 def sdp_parse_raw_record (data):
-    dtype, dsize, dstart = sdp_parse_size_desc (data)
-    assert dtype == 6
+    buf = memoryview (data)
+    dtype, dsize, pos = _sdp_header (buf, 0, len (buf))
+    if dtype != 6:
+        raise ValueError ("SDP record must be a data element sequence")
 
-    pos = dstart
-    datalen = len (data)
+    end = pos + dsize
     record = {}
-    while pos < datalen:
-        type, attrid, consumed = sdp_parse_data_element (data[pos:])
-        assert type == "UInt16"
-        pos += consumed
-        type, attrval, consumed = sdp_parse_data_element (data[pos:])
-        pos += consumed
+    while pos < end:
+        type, attrid, pos = _sdp_decode (buf, pos, end)
+        if type != "UInt16":
+            raise ValueError ("invalid SDP attribute ID type %s" % type)
+        type, attrval, pos = _sdp_decode (buf, pos, end)
         record[attrid] = attrval
     return record
 
-def sdp_make_data_element (type, value):
-    def maketsd (tdesc, sdesc):
-        return struct.pack ("B", (tdesc << 3) | sdesc)
-    def maketsdl (tdesc, size):
-        if   size < (1<<8):  return struct.pack ("!BB", tdesc << 3 | 5, size)
-        elif size < (1<<16): return struct.pack ("!BH", tdesc << 3 | 6, size)
-        else:                return struct.pack ("!BI", tdesc << 3 | 7, size)
-
-    easyinttypes = { "UInt8"   : (1, 0, "!B"),  "UInt16"  : (1, 1, "!H"),
-                     "UInt32"  : (1, 2, "!I"),  "UInt64"  : (1, 3, "!Q"),
-                     "SInt8"   : (2, 0, "!b"),  "SInt16"  : (2, 1, "!h"),
-                     "SInt32"  : (2, 2, "!i"),  "SInt64"  : (2, 3, "!q"),
-                     }
-
-    if type == "Nil": 
-        return maketsd (0, 0)
-    elif type in easyinttypes:
-        tdesc, sdesc, fmt = easyinttypes[type]
-        return maketsd (tdesc, sdesc) + struct.pack (fmt, value)
-    elif type == "UInt128":
-        ts = maketsd (1, 4)
-        upper = ts >> 64
-        lower = (ts & 0xFFFFFFFFFFFFFFFF)
-        return ts + struct.pack ("!QQ", upper, lower)
-    elif type == "SInt128":
-        ts = maketsd (2, 4)
-        # FIXME
-        raise NotImplementedError ("128-bit signed int NYI!")
+class LazySDPRecord (Mapping):
+    """LazySDPRecord (data)
+
+    A read-only mapping from attribute ID to attribute value over a raw SDP
+    service record, as returned by sdp_parse_raw_record.  Constructing the
+    record only scans the top level sequence to find where each attribute
+    value starts.  A value is decoded the first time it is looked up, and
+    the result is cached.
+
+    data may be any object supporting the buffer protocol.  It is not
+    copied, so it must not be modified while the record is in use.
+
+    """
+    __slots__ = ("_buf", "_end", "_offsets", "_cache")
+
+    def __init__ (self, data):
+        buf = memoryview (data)
+        if buf.ndim != 1 or buf.itemsize != 1:
+            buf = buf.cast ("B")
+        dtype, dsize, pos = _sdp_header (buf, 0, len (buf))
+        if dtype != 6:
+            raise ValueError ("SDP record must be a data element sequence")
+
+        end = pos + dsize
+        offsets = {}
+        while pos < end:
+            if buf[pos] != 0x09 or pos + 3 > end:
+                raise ValueError ("invalid SDP attribute ID at offset %d" % pos)
+            attrid = _sdp_u16.unpack_from (buf, pos + 1)[0]
+            pos += 3
+            offsets[attrid] = pos
+            dtype, dsize, body = _sdp_header (buf, pos, end)
+            pos = body + dsize
+
+        self._buf = buf
+        self._end = end
+        self._offsets = offsets
+        self._cache = {}
+
+    def __getitem__ (self, attrid):
+        try:
+            return self._cache[attrid]
+        except KeyError:
+            pass
+        pos = self._offsets[attrid]
+        value = _sdp_decode (self._buf, pos, self._end)[1]
+        self._cache[attrid] = value
+        return value
+
+    def __contains__ (self, attrid):
+        return attrid in self._offsets
+
+    def __iter__ (self):
+        return iter (self._offsets)
+
+    def __len__ (self):
+        return len (self._offsets)
+
+    def get_raw (self, attrid):
+        """get_raw (attrid) -> bytes
+
+        Returns the encoded data element of the attribute, without decoding
+        it.
+
+        """
+        pos = self._offsets[attrid]
+        dtype, dsize, body = _sdp_header (self._buf, pos, self._end)
+        return bytes (self._buf[pos:body+dsize])
+
+    def __repr__ (self):
+        return "<LazySDPRecord with %d attributes, %d decoded>" % \
+                (len (self._offsets), len (self._cache))
+
+def _sdp_uuid_str (value):
+    # 16 and 32 bit UUIDs are decoded as hex bytes, 128 bit ones as strings
+    if isinstance (value, bytes):
+        return value.decode ("ascii").upper ()
+    return value
+
+def _sdp_text (value):
+    if value is None:
+        return None
+    return bytes (value).split (b"\0", 1)[0].decode ("utf-8", "replace")
+
+class ServiceRecord:
+    """ServiceRecord (host=None, name=None, description=None, provider=None,
+                   protocol=None, port=None, service_classes=(),
+                   profiles=(), service_id=None, raw=None)
+
+    The fields find_service returns for a service record, in a compact
+    object instead of a dictionary.  Items can also be read and set with
+    the dictionary keys, e.g. record["service-classes"], so a ServiceRecord
+    can stand in for the dictionaries.
+
+    raw is the encoded record the fields were taken from, if any.  All of
+    its attributes, including those no field is made from, are available
+    from attributes ().
+
+    """
+    __slots__ = ("host", "name", "description", "provider", "protocol",
+                 "port", "service_classes", "profiles", "service_id", "raw")
+
+    _keys = { "service-classes" : "service_classes",
+              "service-id" : "service_id" }
+
+    def __init__ (self, host=None, name=None, description=None,
+                  provider=None, protocol=None, port=None,
+                  service_classes=(), profiles=(), service_id=None,
+                  raw=None):
+        self.host = host
+        self.name = name
+        self.description = description
+        self.provider = provider
+        self.protocol = protocol
+        self.port = port
+        self.service_classes = list (service_classes)
+        self.profiles = list (profiles)
+        self.service_id = service_id
+        self.raw = raw
+
+    @classmethod
+    def from_raw (cls, data, host=None):
+        """from_raw (data, host=None) -> ServiceRecord
+
+        Makes a ServiceRecord from an encoded record, such as one returned
+        by SDPSession.search with raw=True.  Only the attributes the fields
+        are made from are decoded.
+
+        """
+        attrs = LazySDPRecord (data)
+        record = cls (host, raw=data)
+        record.name = _sdp_text (attrs.get (SERVICE_NAME_ATTRID))
+        record.description = _sdp_text (attrs.get (SERVICE_DESCRIPTION_ATTRID))
+        record.provider = _sdp_text (attrs.get (PROVIDER_NAME_ATTRID))
+        if SERVICE_ID_ATTRID in attrs:
+            record.service_id = _sdp_uuid_str (attrs[SERVICE_ID_ATTRID])
+        for type, value in attrs.get (SERVICE_CLASS_ID_LIST_ATTRID, ()):
+            if type == "UUID":
+                record.service_classes.append (_sdp_uuid_str (value))
+        for type, value in attrs.get (BLUETOOTH_PROFILE_DESCRIPTOR_LIST_ATTRID,
+                                      ()):
+            if type == "ElemSeq" and len (value) >= 2 and \
+                    value[0][0] == "UUID":
+                record.profiles.append ((_sdp_uuid_str (value[0][1]),
+                                         value[1][1]))
+        if PROTOCOL_DESCRIPTOR_LIST_ATTRID in attrs:
+            record.protocol, record.port = _sdp_access_port (
+                    attrs[PROTOCOL_DESCRIPTOR_LIST_ATTRID])
+        return record
+
+    def to_raw (self):
+        """to_raw () -> bytes
+
+        Encodes the fields, other than host, as a service record that is
+        publicly browsable, as advertise_service would register it.  Other
+        attributes of raw are not carried over.
+
+        """
+        attrs = []
+        if self.service_classes:
+            attrs.append ((SERVICE_CLASS_ID_LIST_ATTRID, ("ElemSeq",
+                    [("UUID", uuid) for uuid in self.service_classes])))
+        if self.service_id:
+            attrs.append ((SERVICE_ID_ATTRID, ("UUID", self.service_id)))
+        if self.protocol == "RFCOMM":
+            attrs.append ((PROTOCOL_DESCRIPTOR_LIST_ATTRID, ("ElemSeq", [
+                    ("ElemSeq", [("UUID", L2CAP_UUID)]),
+                    ("ElemSeq", [("UUID", RFCOMM_UUID),
+                                 ("UInt8", self.port)])])))
+        elif self.protocol == "L2CAP":
+            attrs.append ((PROTOCOL_DESCRIPTOR_LIST_ATTRID, ("ElemSeq", [
+                    ("ElemSeq", [("UUID", L2CAP_UUID),
+                                 ("UInt16", self.port)])])))
+        attrs.append ((BROWSE_GROUP_LIST_ATTRID,
+                       ("ElemSeq", [("UUID", PUBLIC_BROWSE_GROUP)])))
+        texts = [(attrid, value) for attrid, value in (
+                    (SERVICE_NAME_ATTRID, self.name),
+                    (SERVICE_DESCRIPTION_ATTRID, self.description),
+                    (PROVIDER_NAME_ATTRID, self.provider)) if value]
+        if texts:
+            # English, UTF-8, with the primary language base of 0x0100
+            attrs.append ((LANGUAGE_BASE_ATTRID_LIST_ATTRID, ("ElemSeq",
+                    [("UInt16", 0x656e), ("UInt16", 106),
+                     ("UInt16", 0x0100)])))
+        if self.profiles:
+            attrs.append ((BLUETOOTH_PROFILE_DESCRIPTOR_LIST_ATTRID,
+                    ("ElemSeq", [("ElemSeq", [("UUID", uuid),
+                                              ("UInt16", version)])
+                                 for uuid, version in self.profiles])))
+        attrs.extend ((attrid, ("String", value)) for attrid, value in texts)
+
+        elements = []
+        for attrid, element in attrs:
+            elements.append (("UInt16", attrid))
+            elements.append (element)
+        return sdp_make_data_element ("ElemSeq", elements)
+
+    def attributes (self):
+        """attributes () -> LazySDPRecord
+
+        Returns a mapping from attribute ID to value over raw.
+
+        """
+        if self.raw is None:
+            raise ValueError ("the record was not made from raw data")
+        return LazySDPRecord (self.raw)
+
+    def to_dict (self):
+        """Returns the record as a dictionary, as find_service does."""
+        return { "host" : self.host, "name" : self.name,
+                 "description" : self.description,
+                 "provider" : self.provider, "protocol" : self.protocol,
+                 "port" : self.port,
+                 "service-classes" : list (self.service_classes),
+                 "profiles" : list (self.profiles),
+                 "service-id" : self.service_id }
+
+    def _slot (self, key):
+        key = self._keys.get (key, key)
+        if key not in self.__slots__ or key == "raw":
+            raise KeyError (key)
+        return key
+
+    def __getitem__ (self, key):
+        return getattr (self, self._slot (key))
+
+    def __setitem__ (self, key, value):
+        setattr (self, self._slot (key), value)
+
+    def get (self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__ (self, other):
+        if not isinstance (other, ServiceRecord):
+            return NotImplemented
+        return self.to_dict () == other.to_dict ()
+
+    def __repr__ (self):
+        return "<ServiceRecord %r on %s, %s %s>" % (self.name, self.host,
+                self.protocol, self.port)
+
+def _sdp_access_port (value):
+    # the first protocol stack, if there are alternatives
+    if value and value[0][0] == "ElemSeq" and value[0][1] and \
+            value[0][1][0][0] == "ElemSeq":
+        value = value[0][1]
+    params = {}
+    for type, descriptor in value:
+        if type == "ElemSeq" and descriptor and descriptor[0][0] == "UUID":
+            uuid = _sdp_uuid_str (descriptor[0][1])
+            if len (descriptor) > 1:
+                params[uuid] = descriptor[1][1]
+    # as the C implementation: RFCOMM if there is a channel, else L2CAP
+    if params.get (RFCOMM_UUID):
+        return "RFCOMM", params[RFCOMM_UUID]
+    if params.get (L2CAP_UUID):
+        return "L2CAP", params[L2CAP_UUID]
+    return "UNKNOWN", None
+
+# The encoder sizes the whole data element tree first, then writes it into a
+# single preallocated bytearray.  The sizing pass records, in pre-order, the
+# body length of every sequence and the payload of every variable length
+# element, so that the writing pass never has to re-encode or re-measure.
+
+_sdp_easyinttypes = {
+    "UInt8"   : (1, 0, struct.Struct ("!B")),
+    "UInt16"  : (1, 1, struct.Struct ("!H")),
+    "UInt32"  : (1, 2, struct.Struct ("!I")),
+    "UInt64"  : (1, 3, struct.Struct ("!Q")),
+    "SInt8"   : (2, 0, struct.Struct ("!b")),
+    "SInt16"  : (2, 1, struct.Struct ("!h")),
+    "SInt32"  : (2, 2, struct.Struct ("!i")),
+    "SInt64"  : (2, 3, struct.Struct ("!q")),
+    }
+_sdp_seqtypes = { "ElemSeq" : 6, "AltElemSeq" : 7 }
+_sdp_strtypes = { "String" : 4, "URL" : 8 }
+_sdp_uuid_sizedesc = { 2 : 1, 4 : 2, 16 : 4 }
+
+def _sdp_tsdl_size (size):
+    if   size < (1<<8):  return 2
+    elif size < (1<<16): return 3
+    else:                return 5
+
+def _sdp_pack_tsdl (buf, pos, tdesc, size):
+    if size < (1<<8):
+        struct.pack_into ("!BB", buf, pos, tdesc << 3 | 5, size)
+        return pos + 2
+    elif size < (1<<16):
+        struct.pack_into ("!BH", buf, pos, tdesc << 3 | 6, size)
+        return pos + 3
+    else:
+        struct.pack_into ("!BI", buf, pos, tdesc << 3 | 7, size)
+        return pos + 5
+
+def _sdp_uuid_bytes (value):
+    if len (value) == 4 or len (value) == 8:
+        return binascii.unhexlify (value)
+    elif len (value) == 36:
+        return binascii.unhexlify (value.replace ("-",""))
+    raise ValueError ("invalid UUID %s" % value)
+
+def _sdp_measure (type, value, plan):
+    """returns the encoded size of a data element, appending the information
+    needed by _sdp_write to plan"""
+    if type in _sdp_easyinttypes:
+        return 1 + (1 << _sdp_easyinttypes[type][1])
+    elif type in _sdp_seqtypes:
+        idx = len (plan)
+        plan.append (0)
+        size = 0
+        for subtype, subval in value:
+            size += _sdp_measure (subtype, subval, plan)
+        plan[idx] = size
+        return _sdp_tsdl_size (size) + size
+    elif type in _sdp_strtypes:
+        if not isinstance (value, (bytes, bytearray, memoryview)):
+            value = str.encode (value)
+        plan.append (value)
+        return _sdp_tsdl_size (len (value)) + len (value)
     elif type == "UUID":
-        if len (value) == 4:
-            return maketsd (3, 1) + binascii.unhexlify (value)
-        elif len (value) == 8:
-            return maketsd (3, 2) + binascii.unhexlify (value)
-        elif len (value) == 36:
-            return maketsd (3, 4) + binascii.unhexlify (value.replace ("-",""))
-    elif type == "String":
-        return maketsdl (4, len (value)) + str.encode(value)
+        value = _sdp_uuid_bytes (value)
+        plan.append (value)
+        return 1 + len (value)
+    elif type == "UInt128" or type == "SInt128":
+        return 17
     elif type == "Bool":
-        return maketsd (5,0) + (value and "\x01" or "\x00")
-    elif type == "ElemSeq":
-        packedseq = bytes()
-        for subtype, subval in value:
-            nextelem = sdp_make_data_element (subtype, subval)
-            packedseq = packedseq + nextelem
-        return maketsdl (6, len (packedseq)) + packedseq
-    elif type == "AltElemSeq":
-        packedseq = bytes()
-        for subtype, subval in value:
-            packedseq = packedseq + sdp_make_data_element (subtype, subval)
-        return maketsdl (7, len (packedseq)) + packedseq
-    elif type == "URL":
-        return maketsdl (8, len (value)) + value
+        return 2
+    elif type == "Nil":
+        return 1
     else:
         raise ValueError ("invalid type %s" % type)
 
+def _sdp_write (type, value, buf, pos, plan):
+    if type in _sdp_easyinttypes:
+        tdesc, sdesc, fmt = _sdp_easyinttypes[type]
+        buf[pos] = (tdesc << 3) | sdesc
+        fmt.pack_into (buf, pos + 1, value)
+        return pos + 1 + fmt.size
+    elif type in _sdp_seqtypes:
+        pos = _sdp_pack_tsdl (buf, pos, _sdp_seqtypes[type], next (plan))
+        for subtype, subval in value:
+            pos = _sdp_write (subtype, subval, buf, pos, plan)
+        return pos
+    elif type in _sdp_strtypes:
+        payload = next (plan)
+        pos = _sdp_pack_tsdl (buf, pos, _sdp_strtypes[type], len (payload))
+        buf[pos:pos+len (payload)] = payload
+        return pos + len (payload)
+    elif type == "UUID":
+        payload = next (plan)
+        buf[pos] = (3 << 3) | _sdp_uuid_sizedesc[len (payload)]
+        buf[pos+1:pos+1+len (payload)] = payload
+        return pos + 1 + len (payload)
+    elif type == "UInt128" or type == "SInt128":
+        tdesc = 1 if type == "UInt128" else 2
+        buf[pos] = (tdesc << 3) | 4
+        buf[pos+1:pos+17] = value.to_bytes (16, "big", signed=(tdesc == 2))
+        return pos + 17
+    elif type == "Bool":
+        buf[pos] = 5 << 3
+        buf[pos+1] = 1 if value else 0
+        return pos + 2
+    else:
+        buf[pos] = 0
+        return pos + 1
+
+def sdp_make_data_element (type, value):
+    plan = []
+    size = _sdp_measure (type, value, plan)
+    buf = bytearray (size)
+    _sdp_write (type, value, buf, 0, iter (plan))
+    return bytes (buf)
@@ -0,0 +1,388 @@
+"""Caches for information about remote devices.
+
+DeviceCache remembers the name, class of device and signal strength of
+remote devices, so that discover_devices, lookup_name and DeviceDiscoverer
+don't have to ask the same device for its name over and over again.
+
+ServiceCache remembers the service records of remote devices, so that
+find_service and find_services only query a device's SDP server again when
+its records may have changed.
+
+"""
+import collections
+import sqlite3
+import threading
+import time
+
+
+class DeviceInfo:
+    """What is known about one remote device.
+
+    address      the bluetooth address of the device
+    name         the last name resolved for the device, or None
+    device_class the last class of device seen, or None
+    rssi         the last RSSI seen, or None
+    last_seen    when the device was last seen or named (seconds since the
+                 epoch)
+    name_time    when name was resolved, or None
+    failed_time  when the last name lookup failed, or None
+
+    """
+    __slots__ = ("address", "name", "device_class", "rssi", "last_seen",
+                 "name_time", "failed_time")
+
+    def __init__ (self, address, name=None, device_class=None, rssi=None,
+                  last_seen=None, name_time=None, failed_time=None):
+        self.address = address
+        self.name = name
+        self.device_class = device_class
+        self.rssi = rssi
+        self.last_seen = last_seen
+        self.name_time = name_time
+        self.failed_time = failed_time
+
+    def __repr__ (self):
+        return "DeviceInfo(%s)" % ", ".join ("%s=%r" % (f, getattr (self, f))
+                                             for f in self.__slots__)
+
+
+class DeviceCache:
+    """DeviceCache (ttl=3600, negative_ttl=60, max_entries=4096, path=None)
+
+    An in-memory cache of remote device information keyed by bluetooth
+    address, with least recently used eviction.
+
+    ttl          how many seconds a resolved name stays valid
+    negative_ttl how many seconds a failed name lookup is remembered for.
+                 While it is, lookups of that device fail immediately
+                 instead of waiting for the timeout again.  0 disables
+                 negative caching.
+    max_entries  the maximum number of devices kept.  The least recently
+                 used device is evicted first.
+    path         if given, the cache is also kept in an sqlite database at
+                 this path, so that it survives restarts.  Changes are
+                 written out in batches; call flush () or close () to write
+                 them immediately.
+
+    All methods are thread safe.  Pass a DeviceCache as the cache argument of
+    discover_devices, lookup_name, lookup_names or DeviceDiscoverer to use
+    it.
+
+    """
+    flush_every = 32
+
+    def __init__ (self, ttl=3600, negative_ttl=60, max_entries=4096,
+                  path=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict ()
+        self._lock = threading.RLock ()
+        self._dirty = set ()
+        self._evicted = set ()
+        self._db = None
+        if path is not None:
+            self._open_db (path)
+
+    # ---------------- lookups ----------------
+
+    def get (self, address):
+        """get (address) -> DeviceInfo or None
+
+        Returns everything known about the device, whether or not its name
+        is still valid.
+
+        """
+        with self._lock:
+            info = self._entries.get (address.upper ())
+            if info is not None:
+                self._entries.move_to_end (info.address)
+            return info
+
+    def lookup_name (self, address):
+        """lookup_name (address) -> (hit, name)
+
+        hit is True if the cache can answer for the device: either with a
+        name that has not expired, or, with name None, because a lookup
+        failed less than negative_ttl seconds ago.
+
+        """
+        info = self.get (address)
+        if info is None:
+            return False, None
+        now = time.time ()
+        if info.failed_time is not None and self.negative_ttl and \
+                now - info.failed_time < self.negative_ttl:
+            return True, None
+        if info.name_time is not None and now - info.name_time < self.ttl:
+            return True, info.name
+        return False, None
+
+    def __contains__ (self, address):
+        with self._lock:
+            return address.upper () in self._entries
+
+    def __len__ (self):
+        with self._lock:
+            return len (self._entries)
+
+    def __iter__ (self):
+        with self._lock:
+            return iter (list (self._entries.values ()))
+
+    # ---------------- updates ----------------
+
+    def seen (self, address, device_class=None, rssi=None):
+        """Records that the device was seen, e.g. in an inquiry."""
+        with self._lock:
+            info = self._touch (address)
+            if device_class is not None:
+                info.device_class = device_class
+            if rssi is not None:
+                info.rssi = rssi
+
+    def set_name (self, address, name):
+        """Records a successfully resolved name."""
+        with self._lock:
+            info = self._touch (address)
+            info.name = name
+            info.name_time = info.last_seen
+            info.failed_time = None
+
+    def name_failed (self, address):
+        """Records a failed name lookup."""
+        with self._lock:
+            info = self._touch (address)
+            info.failed_time = info.last_seen
+
+    def clear (self):
+        with self._lock:
+            self._evicted.update (self._entries)
+            self._entries.clear ()
+            self._dirty.clear ()
+            self._maybe_flush (force=True)
+
+    def _touch (self, address):
+        address = address.upper ()
+        info = self._entries.get (address)
+        if info is None:
+            info = DeviceInfo (address)
+            self._entries[address] = info
+            self._evicted.discard (address)
+            while len (self._entries) > self.max_entries:
+                old, _ = self._entries.popitem (last=False)
+                self._dirty.discard (old)
+                self._evicted.add (old)
+        else:
+            self._entries.move_to_end (address)
+        info.last_seen = time.time ()
+        self._dirty.add (address)
+        self._maybe_flush ()
+        return info
+
+    # ---------------- persistence ----------------
+
+    def _open_db (self, path):
+        self._db = sqlite3.connect (path, check_same_thread=False)
+        self._db.execute ("PRAGMA journal_mode=WAL")
+        self._db.execute ("PRAGMA synchronous=NORMAL")
+        self._db.execute ("CREATE TABLE IF NOT EXISTS devices ("
+                          "address TEXT PRIMARY KEY, name TEXT, "
+                          "device_class INTEGER, rssi INTEGER, "
+                          "last_seen REAL, name_time REAL, failed_time REAL)")
+        rows = self._db.execute ("SELECT address, name, device_class, rssi, "
+                                 "last_seen, name_time, failed_time "
+                                 "FROM devices ORDER BY last_seen DESC "
+                                 "LIMIT ?", (self.max_entries,)).fetchall ()
+        for row in reversed (rows):
+            self._entries[row[0]] = DeviceInfo (*row)
+        # devices beyond max_entries, e.g. from a larger cache, are evicted
+        # like those that fall out of the cache later
+        excess = self._db.execute ("SELECT address FROM devices "
+                                   "ORDER BY last_seen DESC LIMIT -1 "
+                                   "OFFSET ?", (self.max_entries,))
+        self._evicted.update (row[0] for row in excess)
+        if self._evicted:
+            self._maybe_flush (force=True)
+
+    def _maybe_flush (self, force=False):
+        if self._db is None:
+            return
+        if not force and len (self._dirty) + len (self._evicted) < \
+                self.flush_every:
+            return
+        rows = [(i.address, i.name, i.device_class, i.rssi, i.last_seen,
+                 i.name_time, i.failed_time)
+                for i in (self._entries[a] for a in self._dirty)]
+        with self._db:
+            self._db.executemany ("INSERT OR REPLACE INTO devices VALUES "
+                                  "(?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.executemany ("DELETE FROM devices WHERE address = ?",
+                                  [(a,) for a in self._evicted])
+        self._dirty.clear ()
+        self._evicted.clear ()
+
+    def flush (self):
+        """Writes pending changes to the on-disk store, if there is one."""
+        with self._lock:
+            self._maybe_flush (force=True)
+
+    def close (self):
+        """Flushes and closes the on-disk store, if there is one."""
+        with self._lock:
+            if self._db is not None:
+                self._maybe_flush (force=True)
+                self._db.close ()
+                self._db = None
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
+
+
+def _query_key (uuid, attrs, raw):
+    if uuid is not None:
+        uuid = uuid.upper ()
+    if attrs is not None:
+        attrs = tuple (tuple (a) if isinstance (a, (tuple, list)) else a
+                       for a in attrs)
+    return uuid, attrs, bool (raw)
+
+def _copy_records (records):
+    # callers add keys such as "host" to the record dictionaries
+    return [dict (r) if isinstance (r, dict) else r for r in records]
+
+
+class _ServiceEntry:
+    __slots__ = ("state", "queries")
+
+    def __init__ (self):
+        self.state = None
+        self.queries = {}       # (uuid, attrs, raw) -> (records, fetched)
+
+
+class ServiceCache:
+    """ServiceCache (ttl=300, max_devices=1024, validate=True)
+
+    An in-memory cache of the service records found on remote devices,
+    keyed by bluetooth address and by the UUID and attributes searched
+    for, with least recently used eviction of devices.
+
+    ttl          how many seconds the records of a search are used without
+                 asking the device
+    max_devices  the maximum number of devices kept
+    validate     if True, expired records are checked against the
+                 ServiceDatabaseState attribute of the device's SDP server,
+                 which changes whenever a record is added, removed or
+                 changed.  If it is the same as when the records were
+                 fetched, they are used for another ttl seconds, and only
+                 that one attribute goes over the air.
+
+    All methods are thread safe.  Pass a ServiceCache as the cache argument
+    of find_service or find_services to use it.
+
+    """
+    def __init__ (self, ttl=300, max_devices=1024, validate=True):
+        self.ttl = ttl
+        self.max_devices = max_devices
+        self.validate = validate
+        self._entries = collections.OrderedDict ()
+        self._lock = threading.RLock ()
+
+    def _entry (self, address, create=False):
+        address = address.upper ()
+        entry = self._entries.get (address)
+        if entry is not None:
+            self._entries.move_to_end (address)
+        elif create:
+            entry = self._entries[address] = _ServiceEntry ()
+            while len (self._entries) > self.max_devices:
+                self._entries.popitem (last=False)
+        return entry
+
+    def get (self, address, uuid=None, attrs=None, raw=False):
+        """get (address, uuid=None, attrs=None, raw=False) -> list of records or None
+
+        Returns the records of a search of address for uuid, or of a browse
+        if uuid is None, that are less than ttl seconds old.  raw tells
+        whether the search asked for encoded records or for dictionaries.
+
+        """
+        records, fresh, state = self.lookup (address, uuid, attrs, raw)
+        return records if fresh else None
+
+    def lookup (self, address, uuid=None, attrs=None, raw=False):
+        """lookup (address, uuid=None, attrs=None, raw=False) -> (records, fresh, state)
+
+        Returns the cached records of a search, whether they are less than
+        ttl seconds old, and the ServiceDatabaseState they were fetched
+        under, or None if it is not known.  records is None if the search
+        is not cached at all.
+
+        """
+        with self._lock:
+            entry = self._entry (address)
+            if entry is None:
+                return None, False, None
+            hit = entry.queries.get (_query_key (uuid, attrs, raw))
+            if hit is None:
+                return None, False, entry.state
+            records, fetched = hit
+            return (_copy_records (records), time.time () - fetched < self.ttl,
+                    entry.state)
+
+    def put (self, address, uuid, attrs, records, state=None, raw=False):
+        """put (address, uuid, attrs, records, state=None, raw=False)
+
+        Stores the records found by a search.  state is the
+        ServiceDatabaseState read before the search.  If it differs from
+        the one the device's other records were fetched under, those are
+        dropped.
+
+        """
+        with self._lock:
+            entry = self._entry (address, create=True)
+            if state is not None and state != entry.state:
+                entry.queries.clear ()
+            entry.state = state
+            entry.queries[_query_key (uuid, attrs, raw)] = \
+                    (_copy_records (records), time.time ())
+
+    def revalidate (self, address, state):
+        """revalidate (address, state) -> bool
+
+        Compares the ServiceDatabaseState just read from a device with the
+        one its records were fetched under.  If they are equal, all of the
+        device's records are valid for another ttl seconds and True is
+        returned.  Otherwise they are dropped.
+
+        """
+        with self._lock:
+            entry = self._entry (address)
+            if entry is None:
+                return False
+            if state is None or state != entry.state:
+                entry.queries.clear ()
+                entry.state = None
+                return False
+            now = time.time ()
+            for key, (records, fetched) in entry.queries.items ():
+                entry.queries[key] = (records, now)
+            return True
+
+    def invalidate (self, address=None):
+        """Forgets the records of address, or of all devices if None."""
+        with self._lock:
+            if address is None:
+                self._entries.clear ()
+            else:
+                self._entries.pop (address.upper (), None)
+
+    def __contains__ (self, address):
+        with self._lock:
+            return address.upper () in self._entries
+
+    def __len__ (self):
+        return len (self._entries)
@@ -0,0 +1,244 @@
+"""Recording HCI traffic in btsnoop and pcap files.
+
+CaptureWriter appends HCI packets, in H4 format (a packet type byte followed
+by the packet), to a btsnoop file or to a pcap file with the link type
+LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR.  Both can be opened with Wireshark.
+
+The files are preallocated and memory mapped, so writing a packet is a
+couple of copies into memory and no system calls, and a capture can be
+left running permanently.  With files > 1 the capture is a ring of files
+that keeps the most recent traffic.
+
+Pass a CaptureWriter to bluetooth.set_capture to record the commands and
+events of the BlueZ backend.
+
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+
+BTSNOOP = "btsnoop"
+PCAP = "pcap"
+
+# btsnoop: big endian, timestamps in microseconds since 0000-01-01
+BTSNOOP_MAGIC = b"btsnoop\0"
+BTSNOOP_VERSION = 1
+BTSNOOP_DATALINK_H4 = 1002
+BTSNOOP_EPOCH_DELTA = 0x00dcddb30f2f8000
+
+# pcap
+PCAP_MAGIC = 0xa1b2c3d4
+LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR = 201
+
+# H4 packet types
+HCI_COMMAND_PKT = 0x01
+HCI_ACLDATA_PKT = 0x02
+HCI_SCODATA_PKT = 0x03
+HCI_EVENT_PKT = 0x04
+
+_btsnoop_header = struct.Struct (">8sII")
+_btsnoop_record = struct.Struct (">IIIIq")
+_pcap_header = struct.Struct ("<IHHiIII")
+_pcap_record = struct.Struct ("<IIII")
+_phdr = struct.Struct (">I")
+
+
+def read_capture (path):
+    """read_capture (path) -> iterator of (timestamp, received, packet)
+
+    Reads the H4 packets of a btsnoop file (datalink 1002) or of a pcap file
+    with the link type LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR, e.g. one written
+    by CaptureWriter or by btmon.  timestamp is in seconds since the epoch,
+    and received is True for packets from the controller.  Reading stops at
+    the zero filled tail of a file that was not closed properly.
+
+    """
+    with open (path, "rb") as f:
+        data = f.read ()
+    if data[:8] == BTSNOOP_MAGIC:
+        return _read_btsnoop (data)
+    if len (data) >= _pcap_header.size:
+        magic = struct.unpack_from ("<I", data)[0]
+        if magic in (0xa1b2c3d4, 0xa1b23c4d):
+            return _read_pcap (data, "<", magic == 0xa1b23c4d)
+        if magic in (0xd4c3b2a1, 0x4d3cb2a1):
+            return _read_pcap (data, ">", magic == 0x4d3cb2a1)
+    raise ValueError ("%s is not a btsnoop or pcap file" % (path,))
+
+def _read_btsnoop (data):
+    magic, version, datalink = _btsnoop_header.unpack_from (data)
+    if datalink != BTSNOOP_DATALINK_H4:
+        raise ValueError ("unsupported btsnoop datalink %d" % datalink)
+    pos = _btsnoop_header.size
+    end = len (data)
+    size = _btsnoop_record.size
+    while pos + size <= end:
+        orig_len, incl_len, flags, drops, ts = \
+                _btsnoop_record.unpack_from (data, pos)
+        if incl_len == 0:
+            break
+        pos += size
+        yield ((ts - BTSNOOP_EPOCH_DELTA) * 1e-6, bool (flags & 1),
+               data[pos:pos+incl_len])
+        pos += incl_len
+
+def _read_pcap (data, order, nanoseconds):
+    header = struct.Struct (order + "IHHiIII")
+    record = struct.Struct (order + "IIII")
+    linktype = header.unpack_from (data)[6]
+    if linktype != LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR:
+        raise ValueError ("unsupported pcap link type %d" % linktype)
+    scale = 1e-9 if nanoseconds else 1e-6
+    pos = header.size
+    end = len (data)
+    while pos + record.size <= end:
+        sec, frac, incl_len, orig_len = record.unpack_from (data, pos)
+        if incl_len < 4:
+            break
+        pos += record.size
+        received = _phdr.unpack_from (data, pos)[0] & 1
+        yield (sec + frac * scale, bool (received),
+               data[pos+4:pos+incl_len])
+        pos += incl_len
+
+
+class CaptureWriter:
+    """CaptureWriter (path, format=BTSNOOP, file_size=16 << 20, files=1)
+
+    Writes HCI packets to the btsnoop or pcap file at path.  Each file is
+    preallocated to file_size bytes and trimmed to the size of its contents
+    when it is finished.
+
+    With files=1, packets that no longer fit are dropped and counted in
+    dropped.  With files > 1 the capture is a ring: path.0, path.1, ...
+    are filled in turn, and the oldest one is overwritten once all are
+    full.
+
+    Writing is thread safe.
+
+    """
+    def __init__ (self, path, format=BTSNOOP, file_size=16 << 20, files=1):
+        if format not in (BTSNOOP, PCAP):
+            raise ValueError ("unknown capture format %r" % (format,))
+        if files < 1:
+            raise ValueError ("files must be at least 1")
+        self.path = path
+        self.format = format
+        self.file_size = file_size
+        self.files = files
+        self.packets = 0
+        self.dropped = 0
+        self._lock = threading.Lock ()
+        self._index = 0
+        self._fd = -1
+        self._map = None
+        self._pos = 0
+        if format == BTSNOOP:
+            self._header = _btsnoop_header.pack (BTSNOOP_MAGIC,
+                    BTSNOOP_VERSION, BTSNOOP_DATALINK_H4)
+            self._record_size = _btsnoop_record.size
+        else:
+            self._header = _pcap_header.pack (PCAP_MAGIC, 2, 4, 0, 0,
+                    0xffff, LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR)
+            self._record_size = _pcap_record.size + _phdr.size
+        if file_size < len (self._header) + self._record_size:
+            raise ValueError ("file_size is too small")
+        self._open (0)
+
+    @property
+    def current_path (self):
+        """The path of the file being written."""
+        if self.files == 1:
+            return self.path
+        return "%s.%d" % (self.path, self._index)
+
+    def _open (self, index):
+        self._index = index
+        self._fd = os.open (self.current_path,
+                            os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate (self._fd, self.file_size)
+            self._map = mmap.mmap (self._fd, self.file_size)
+        except OSError:
+            os.close (self._fd)
+            self._fd = -1
+            raise
+        self._map[:len (self._header)] = self._header
+        self._pos = len (self._header)
+
+    def _finish (self):
+        # trim the file so it ends with the last packet
+        self._map.close ()
+        self._map = None
+        os.ftruncate (self._fd, self._pos)
+        os.close (self._fd)
+        self._fd = -1
+
+    def write (self, packet, received, timestamp=None):
+        """write (packet, received, timestamp=None)
+
+        Records one H4 packet.  received is True for packets from the
+        controller and False for packets sent to it.  timestamp is in
+        seconds since the epoch, and defaults to now.
+
+        """
+        if timestamp is None:
+            timestamp = time.time ()
+        n = len (packet)
+        size = self._record_size + n
+        with self._lock:
+            if self._map is None:
+                raise ValueError ("write to a closed CaptureWriter")
+            pos = self._pos
+            if pos + size > self.file_size:
+                if self.files == 1 or \
+                        len (self._header) + size > self.file_size:
+                    self.dropped += 1
+                    return
+                self._finish ()
+                self._open ((self._index + 1) % self.files)
+                pos = self._pos
+            buf = self._map
+            if self.format == BTSNOOP:
+                flags = 1 if received else 0
+                if packet and packet[0] in (HCI_COMMAND_PKT, HCI_EVENT_PKT):
+                    flags |= 2
+                # btsnoop's H4 datalink stores the packet type byte too
+                _btsnoop_record.pack_into (buf, pos, n, n, flags,
+                        self.dropped,
+                        int (timestamp * 1000000) + BTSNOOP_EPOCH_DELTA)
+                pos += _btsnoop_record.size
+            else:
+                usec = int (timestamp * 1000000)
+                _pcap_record.pack_into (buf, pos, usec // 1000000,
+                        usec % 1000000, n + 4, n + 4)
+                _phdr.pack_into (buf, pos + _pcap_record.size,
+                        1 if received else 0)
+                pos += _pcap_record.size + 4
+            buf[pos:pos+n] = packet
+            self._pos = pos + n
+            self.packets += 1
+
+    def flush (self):
+        """Writes the packets recorded so far out to the file."""
+        with self._lock:
+            if self._map is not None:
+                self._map.flush ()
+
+    def close (self):
+        """Trims and closes the current file."""
+        with self._lock:
+            if self._map is not None:
+                self._finish ()
+
+    @property
+    def closed (self):
+        return self._map is None
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
@@ -0,0 +1,184 @@
+"""Parser for extended inquiry response (EIR) and advertising data (AD).
+
+Both are a sequence of length, type, value structures.  parse_eir decodes
+the common types in a single pass and returns an EIRData record.  It does
+not need a Bluetooth adapter.
+
+"""
+import struct
+
+# EIR / AD data types
+EIR_FLAGS = 0x01
+EIR_UUID16_SOME = 0x02
+EIR_UUID16_ALL = 0x03
+EIR_UUID32_SOME = 0x04
+EIR_UUID32_ALL = 0x05
+EIR_UUID128_SOME = 0x06
+EIR_UUID128_ALL = 0x07
+EIR_NAME_SHORT = 0x08
+EIR_NAME_COMPLETE = 0x09
+EIR_TX_POWER = 0x0A
+EIR_CLASS_OF_DEVICE = 0x0D
+EIR_SOLICIT16 = 0x14
+EIR_SOLICIT128 = 0x15
+EIR_SERVICE_DATA16 = 0x16
+EIR_APPEARANCE = 0x19
+EIR_SOLICIT32 = 0x1F
+EIR_SERVICE_DATA32 = 0x20
+EIR_SERVICE_DATA128 = 0x21
+EIR_MANUFACTURER_DATA = 0xFF
+
+_u16 = struct.Struct ("<H")
+_u32 = struct.Struct ("<I")
+
+def _uuid16 (data):
+    return "%04X" % _u16.unpack (data)[0]
+
+def _uuid32 (data):
+    return "%08X" % _u32.unpack (data)[0]
+
+def _uuid128 (data):
+    # UUIDs are little endian in EIR data
+    return "%08X-%04X-%04X-%04X-%04X%08X" % \
+            struct.unpack (">IHHHHI", bytes (data[::-1]))
+
+class EIRData:
+    """The decoded contents of an EIR or advertising data block.
+
+    name            the complete or shortened local name, or None
+    name_complete   True if name is the complete local name
+    flags           the flags field, or None
+    tx_power        the TX power level in dBm, or None
+    device_class    the class of device, or None
+    appearance      the appearance value, or None
+    uuids           service class UUIDs, as strings in the format used by
+                    find_service (XXXX, XXXXXXXX or the full 128-bit form)
+    uuids_complete  True if every UUID list present was marked complete
+    solicited_uuids service solicitation UUIDs
+    service_data    dictionary mapping UUID strings to service data bytes
+    manufacturer_data  dictionary mapping company IDs to data bytes
+    unknown         list of (type, bytes) pairs for other data types
+
+    """
+    __slots__ = ("name", "name_complete", "flags", "tx_power",
+                 "device_class", "appearance", "uuids", "uuids_complete",
+                 "solicited_uuids", "service_data", "manufacturer_data",
+                 "unknown")
+
+    def __init__ (self):
+        self.name = None
+        self.name_complete = False
+        self.flags = None
+        self.tx_power = None
+        self.device_class = None
+        self.appearance = None
+        self.uuids = []
+        self.uuids_complete = True
+        self.solicited_uuids = []
+        self.service_data = {}
+        self.manufacturer_data = {}
+        self.unknown = []
+
+    def __repr__ (self):
+        fields = ["%s=%r" % (f, getattr (self, f)) for f in self.__slots__
+                  if getattr (self, f) not in (None, [], {})]
+        return "EIRData(%s)" % ", ".join (fields)
+
+def _decode_name (data):
+    return bytes (data).decode ("utf-8", "replace")
+
+def _name_short (rec, data):
+    if not rec.name_complete:
+        rec.name = _decode_name (data)
+
+def _name_complete (rec, data):
+    rec.name = _decode_name (data)
+    rec.name_complete = True
+
+def _flags (rec, data):
+    if len (data) >= 1:
+        rec.flags = data[0]
+
+def _tx_power (rec, data):
+    if len (data) >= 1:
+        rec.tx_power = struct.unpack ("b", data[:1])[0]
+
+def _device_class (rec, data):
+    if len (data) >= 3:
+        rec.device_class = data[0] | (data[1] << 8) | (data[2] << 16)
+
+def _appearance (rec, data):
+    if len (data) >= 2:
+        rec.appearance = _u16.unpack (data[:2])[0]
+
+def _uuid_list (size, convert, complete, solicited=False):
+    def handler (rec, data):
+        n = len (data) - len (data) % size
+        uuids = [convert (data[i:i+size]) for i in range (0, n, size)]
+        if solicited:
+            rec.solicited_uuids.extend (uuids)
+        else:
+            rec.uuids.extend (uuids)
+            if not complete:
+                rec.uuids_complete = False
+    return handler
+
+def _service_data (size, convert):
+    def handler (rec, data):
+        if len (data) >= size:
+            rec.service_data[convert (data[:size])] = bytes (data[size:])
+    return handler
+
+def _manufacturer_data (rec, data):
+    if len (data) >= 2:
+        rec.manufacturer_data[_u16.unpack (data[:2])[0]] = bytes (data[2:])
+
+# compiled dispatch table: data type -> handler (record, value)
+_handlers = {
+    EIR_FLAGS : _flags,
+    EIR_UUID16_SOME : _uuid_list (2, _uuid16, False),
+    EIR_UUID16_ALL : _uuid_list (2, _uuid16, True),
+    EIR_UUID32_SOME : _uuid_list (4, _uuid32, False),
+    EIR_UUID32_ALL : _uuid_list (4, _uuid32, True),
+    EIR_UUID128_SOME : _uuid_list (16, _uuid128, False),
+    EIR_UUID128_ALL : _uuid_list (16, _uuid128, True),
+    EIR_NAME_SHORT : _name_short,
+    EIR_NAME_COMPLETE : _name_complete,
+    EIR_TX_POWER : _tx_power,
+    EIR_CLASS_OF_DEVICE : _device_class,
+    EIR_SOLICIT16 : _uuid_list (2, _uuid16, True, solicited=True),
+    EIR_SOLICIT32 : _uuid_list (4, _uuid32, True, solicited=True),
+    EIR_SOLICIT128 : _uuid_list (16, _uuid128, True, solicited=True),
+    EIR_SERVICE_DATA16 : _service_data (2, _uuid16),
+    EIR_SERVICE_DATA32 : _service_data (4, _uuid32),
+    EIR_SERVICE_DATA128 : _service_data (16, _uuid128),
+    EIR_APPEARANCE : _appearance,
+    EIR_MANUFACTURER_DATA : _manufacturer_data,
+}
+
+def parse_eir (data):
+    """parse_eir (data) -> EIRData
+
+    Decodes an extended inquiry response or an advertising data block.
+    data may be any object supporting the buffer protocol.  Parsing stops at
+    the first zero length structure, which marks the start of the padding,
+    or at a structure that runs past the end of data.
+
+    """
+    buf = memoryview (data)
+    end = len (buf)
+    rec = EIRData ()
+    pos = 0
+    while pos < end:
+        length = buf[pos]
+        if length == 0 or pos + 1 + length > end:
+            break
+        dtype = buf[pos+1]
+        value = buf[pos+2:pos+1+length]
+        handler = _handlers.get (dtype)
+        if handler is not None:
+            handler (rec, value)
+        else:
+            rec.unknown.append ((dtype, bytes (value)))
+        pos += 1 + length
+    return rec
@@ -0,0 +1,1042 @@
+"""A software HCI controller for testing without Bluetooth hardware.
+
+VirtualController speaks the HCI command and event protocol, in H4 framing,
+over socket pairs or any other packet transport.  It answers the commands
+used for discovery from a population of virtual devices: Inquiry, Remote
+Name Request, Create Connection, Disconnect, Read BD_ADDR, Read RSSI and LE
+scanning, and the connection commands of HCIDevice: Read and Write Automatic
+Flush Timeout, Read Link Quality and Read Clock.  Other commands fail with
+the Unknown HCI Command status.
+
+Installed with bluetooth.set_hci_transport, it takes the place of the
+adapter for discover_devices, lookup_name, lookup_names, read_local_bdaddr,
+DeviceDiscoverer and HCIDevice:
+
+    controller = VirtualController (population (5000), time_scale=0.01)
+    bluetooth.set_hci_transport (controller.open)
+    try:
+        devices = bluetooth.discover_devices (lookup_names=True)
+    finally:
+        bluetooth.set_hci_transport (None)
+        controller.close ()
+
+All air times, such as the inquiry length and the time to page a device,
+are multiplied by time_scale, so large populations can be run through
+quickly.  latency delays every event, and loss is the probability that a
+device misses an inquiry, a page or an advertisement.
+
+VirtualSDPServer stands in for the SDP server of a device, for
+bluetooth.sdp.SDPClient:
+
+    server = VirtualSDPServer (records)
+    client = SDPClient (server.open ())
+
+"""
+import heapq
+import itertools
+import queue
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+from bluetooth.btcommon import (sdp_decode_data_element,
+                                sdp_make_data_element, to_full_uuid,
+                                _sdp_header)
+from bluetooth.sdp import (SDP_ERROR_RSP, SDP_SVC_SEARCH_REQ,
+                           SDP_SVC_ATTR_REQ, SDP_SVC_SEARCH_ATTR_REQ,
+                           SDP_INVALID_RECORD_HANDLE, SDP_INVALID_SYNTAX,
+                           SDP_INVALID_CSTATE, pack_pdu, unpack_pdu,
+                           pack_cstate, unpack_cstate)
+from bluetooth.hci import (ba2str, HCI_COMMAND_PKT, HCI_EVENT_PKT,
+                           EVT_INQUIRY_COMPLETE, EVT_INQUIRY_RESULT,
+                           EVT_INQUIRY_RESULT_WITH_RSSI,
+                           EVT_EXTENDED_INQUIRY_RESULT, EIR_DATA_SIZE)
+
+# events
+EVT_CONN_COMPLETE = 0x03
+EVT_DISCONN_COMPLETE = 0x05
+EVT_REMOTE_NAME_REQ_COMPLETE = 0x07
+EVT_CMD_COMPLETE = 0x0E
+EVT_CMD_STATUS = 0x0F
+EVT_LE_META_EVENT = 0x3E
+EVT_LE_ADVERTISING_REPORT = 0x02
+
+# commands
+OP_INQUIRY = 0x0401
+OP_INQUIRY_CANCEL = 0x0402
+OP_CREATE_CONN = 0x0405
+OP_DISCONNECT = 0x0406
+OP_REMOTE_NAME_REQ = 0x0419
+OP_RESET = 0x0C03
+OP_READ_FLUSH_TIMEOUT = 0x0C27
+OP_WRITE_FLUSH_TIMEOUT = 0x0C28
+OP_READ_INQUIRY_MODE = 0x0C44
+OP_WRITE_INQUIRY_MODE = 0x0C45
+OP_READ_BD_ADDR = 0x1009
+OP_READ_LINK_QUALITY = 0x1403
+OP_READ_RSSI = 0x1405
+OP_READ_CLOCK = 0x1407
+OP_LE_SET_SCAN_PARAMETERS = 0x200B
+OP_LE_SET_SCAN_ENABLE = 0x200C
+
+# status codes
+HCI_SUCCESS = 0x00
+HCI_UNKNOWN_COMMAND = 0x01
+HCI_NO_CONNECTION = 0x02
+HCI_PAGE_TIMEOUT = 0x04
+HCI_COMMAND_DISALLOWED = 0x0C
+HCI_INVALID_PARAMETERS = 0x12
+HCI_OE_USER_ENDED_CONNECTION = 0x13
+HCI_OE_LOCAL_HOST_TERM = 0x16
+
+# socket options of raw HCI sockets
+SOL_HCI = 0
+HCI_FILTER = 2
+
+_filter_struct = struct.Struct ("<IIIH")
+
+INQUIRY_LENGTH_UNIT = 1.28
+CLOCK_RATE = 3200
+PAGE_TIMEOUT = 5.12
+
+
+def _str2ba (address):
+    return bytes.fromhex (address.replace (":", ""))[::-1]
+
+
+class VirtualDevice:
+    """VirtualDevice (address, name=None, device_class=0x5a020c, rssi=-60,
+                   clock_offset=0, page_time=0.2, uuids=(), le=False,
+                   classic=True, eir_name=True, link_quality=255)
+
+    A remote device of a VirtualController.  page_time is the time, in
+    seconds before scaling, that paging it for a name request or a
+    connection takes.  uuids are 16 bit service class UUIDs advertised in
+    its extended inquiry response, which also carries the name if eir_name
+    is set.  Devices with classic answer inquiries, and devices with le
+    advertise while LE scanning is enabled.  link_quality is reported by
+    Read Link Quality while it is connected.
+
+    """
+    __slots__ = ("address", "name", "device_class", "rssi", "clock_offset",
+                 "page_time", "uuids", "le", "classic", "eir_name",
+                 "link_quality")
+
+    def __init__ (self, address, name=None, device_class=0x5a020c, rssi=-60,
+                  clock_offset=0, page_time=0.2, uuids=(), le=False,
+                  classic=True, eir_name=True, link_quality=255):
+        self.address = address.upper ()
+        self.name = name
+        self.device_class = device_class
+        self.rssi = rssi
+        self.clock_offset = clock_offset
+        self.page_time = page_time
+        self.uuids = tuple (uuids)
+        self.le = le
+        self.classic = classic
+        self.eir_name = eir_name
+        self.link_quality = link_quality
+
+    def __repr__ (self):
+        return "VirtualDevice (%r, %r)" % (self.address, self.name)
+
+    def eir (self):
+        """Returns the device's extended inquiry response data."""
+        data = b""
+        if self.uuids:
+            data += struct.pack ("BB", 2 * len (self.uuids) + 1, 0x03) + \
+                b"".join (struct.pack ("<H", u) for u in self.uuids)
+        if self.name is not None and self.eir_name:
+            data += _name_structure (self.name, EIR_DATA_SIZE - len (data))
+        return data.ljust (EIR_DATA_SIZE, b"\0")
+
+    def advertising_data (self):
+        """Returns the device's LE advertising data."""
+        data = b"\x02\x01\x06"
+        if self.name is not None:
+            data += _name_structure (self.name, 31 - len (data))
+        return data
+
+
+def _name_structure (name, room):
+    # a complete local name, or a shortened one if it does not fit
+    name = name.encode ("utf-8")
+    if len (name) + 2 <= room:
+        return struct.pack ("BB", len (name) + 1, 0x09) + name
+    name = name[:max (0, room - 2)]
+    return struct.pack ("BB", len (name) + 1, 0x08) + name
+
+
+def population (count, seed=0, le_fraction=0.0, nameless_fraction=0.0,
+                page_time=(0.05, 0.5)):
+    """population (count, seed=0, le_fraction=0.0, nameless_fraction=0.0,
+                page_time=(0.05, 0.5)) -> list of VirtualDevice
+
+    Makes count devices with addresses 02:00:00:00:00:00 upwards, names
+    "device-<index>", pseudo-random classes, signal strengths and clock
+    offsets, and page times drawn uniformly from the page_time range.  A
+    le_fraction of them are LE only devices, and a nameless_fraction of
+    the classic ones leave their name out of their extended inquiry
+    response, so it has to be asked for with a name request.
+
+    """
+    rng = random.Random (seed)
+    classes = (0x5a020c, 0x240404, 0x1f00, 0x7a020c, 0x200418)
+    uuids = (0x1101, 0x1105, 0x110a, 0x110b, 0x111e, 0x1200)
+    devices = []
+    for i in range (count):
+        le = rng.random () < le_fraction
+        device = VirtualDevice ("02:%02X:%02X:%02X:%02X:%02X" %
+                tuple (i.to_bytes (5, "big")), "device-%d" % i,
+                device_class=rng.choice (classes),
+                rssi=rng.randrange (-95, -30),
+                clock_offset=rng.randrange (0x8000),
+                page_time=rng.uniform (*page_time),
+                uuids=rng.sample (uuids, 2), le=le, classic=not le,
+                eir_name=rng.random () >= nameless_fraction)
+        devices.append (device)
+    return devices
+
+
+class VirtualHCISocket:
+    """VirtualHCISocket (sock)
+
+    The host end of a connection to a VirtualController, used like a raw
+    HCI socket.  HCI_FILTER socket options are applied to the events it
+    receives the way the kernel applies them; other SOL_HCI options are
+    accepted and ignored.  Everything else is passed on to sock.
+
+    """
+    def __init__ (self, sock):
+        self._sock = sock
+        self._filter = None
+
+    def __getattr__ (self, name):
+        return getattr (self._sock, name)
+
+    def setsockopt (self, level, option, value, *args):
+        if level != SOL_HCI:
+            return self._sock.setsockopt (level, option, value, *args)
+        if option == HCI_FILTER:
+            if isinstance (value, str):
+                # what setsockopt of a btsocket does with a str
+                value = value.encode ("utf-8")
+            self._filter = _filter_struct.unpack (bytes (value)[:14])
+
+    def getsockopt (self, level, option, buflen=0):
+        if level != SOL_HCI:
+            return self._sock.getsockopt (level, option, buflen)
+        if option == HCI_FILTER:
+            if self._filter is None:
+                # everything passes
+                return _filter_struct.pack (0xffffffff, 0xffffffff,
+                                            0xffffffff, 0)
+            return _filter_struct.pack (*self._filter)
+        return bytes (buflen) if buflen else 0
+
+    def _accept (self, pkt, n):
+        flt = self._filter
+        if flt is None or n < 1:
+            return True
+        type_mask, mask0, mask1, opcode = flt
+        ptype = pkt[0]
+        if not type_mask & (1 << (ptype & 31)):
+            return False
+        if ptype != HCI_EVENT_PKT or n < 3:
+            return True
+        event = pkt[1] & 63
+        if not (mask0 | mask1 << 32) & (1 << event):
+            return False
+        if opcode:
+            if event == EVT_CMD_COMPLETE and n >= 6 and \
+                    opcode != pkt[4] | pkt[5] << 8:
+                return False
+            if event == EVT_CMD_STATUS and n >= 7 and \
+                    opcode != pkt[5] | pkt[6] << 8:
+                return False
+        return True
+
+    def recv (self, bufsize, flags=0):
+        while True:
+            pkt = self._sock.recv (bufsize, flags)
+            if not pkt or self._accept (pkt, len (pkt)):
+                return pkt
+
+    def recv_into (self, buffer, nbytes=0, flags=0):
+        while True:
+            n = self._sock.recv_into (buffer, nbytes, flags)
+            if n == 0 or self._accept (buffer, n):
+                return n
+
+    def recvmsg_into (self, buffers, ancbufsize=0, flags=0):
+        while True:
+            result = self._sock.recvmsg_into (buffers, ancbufsize, flags)
+            if result[0] == 0 or self._accept (buffers[0], result[0]):
+                return result
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self._sock.close ()
+
+
+class VirtualController:
+    """VirtualController (devices=(), address="00:1B:DC:00:00:01",
+                       latency=0.0, loss=0.0, time_scale=1.0,
+                       inquiry_mode=2, max_pages=None, adv_interval=0.1,
+                       command_packets=1, seed=None)
+
+    A software Bluetooth controller with the VirtualDevice objects in
+    devices in range.  It runs in a thread of its own, started by the
+    first open () or attach (), and broadcasts every event to all of its
+    transports, as the kernel does to raw HCI sockets.
+
+    latency is added to the delivery of every event.  loss is the
+    probability of a device not answering an inquiry, a page or an LE scan
+    interval; a lost page ends with a page timeout.  inquiry_mode selects
+    standard (0), RSSI (1) or extended (2) inquiry results, and can also be
+    changed with Write Inquiry Mode.  At most max_pages name requests and
+    connection attempts are run at once; further ones are refused with
+    Command Disallowed.  LE devices advertise every adv_interval seconds
+    while scanning.  command_packets is the number of commands it takes at
+    once: the Num_HCI_Command_Packets value in command complete and command
+    status events is what is left of it by the commands whose answers have
+    not been delivered yet.
+
+    """
+    def __init__ (self, devices=(), address="00:1B:DC:00:00:01",
+                  latency=0.0, loss=0.0, time_scale=1.0, inquiry_mode=2,
+                  max_pages=None, adv_interval=0.1, command_packets=1,
+                  seed=None):
+        self.devices = list (devices)
+        self.address = address.upper ()
+        self.latency = latency
+        self.loss = loss
+        self.time_scale = time_scale
+        self.inquiry_mode = inquiry_mode
+        self.max_pages = max_pages
+        self.adv_interval = adv_interval
+        self.command_packets = command_packets
+        self.commands = 0
+        self.events = 0
+        self._unanswered = 0
+        self._by_address = {d.address: d for d in self.devices}
+        self._rng = random.Random (seed)
+        self._lock = threading.RLock ()
+        self._timers = []
+        self._seq = itertools.count ()
+        self._transports = {}   # fd -> transport
+        self._epoll = select.epoll ()
+        self._wake_r, self._wake_w = socket.socketpair ()
+        self._wake_r.setblocking (False)
+        self._epoll.register (self._wake_r.fileno (), select.EPOLLIN)
+        self._thread = None
+        self._stopping = False
+        self._reset ()
+        self._handlers = {
+            OP_INQUIRY: self._inquiry,
+            OP_INQUIRY_CANCEL: self._inquiry_cancel,
+            OP_CREATE_CONN: self._create_connection,
+            OP_DISCONNECT: self._disconnect,
+            OP_REMOTE_NAME_REQ: self._remote_name_request,
+            OP_RESET: self._reset_command,
+            OP_READ_INQUIRY_MODE: self._read_inquiry_mode,
+            OP_WRITE_INQUIRY_MODE: self._write_inquiry_mode,
+            OP_READ_BD_ADDR: self._read_bd_addr,
+            OP_READ_RSSI: self._read_rssi,
+            OP_READ_LINK_QUALITY: self._read_link_quality,
+            OP_READ_CLOCK: self._read_clock,
+            OP_READ_FLUSH_TIMEOUT: self._read_flush_timeout,
+            OP_WRITE_FLUSH_TIMEOUT: self._write_flush_timeout,
+            OP_LE_SET_SCAN_PARAMETERS: self._le_set_scan_parameters,
+            OP_LE_SET_SCAN_ENABLE: self._le_set_scan_enable,
+        }
+
+    def _reset (self):
+        self._inquiry_token = None
+        self._scan_token = None
+        self._scan_filter_duplicates = False
+        self._pages = 0
+        self._connections = {}      # handle -> VirtualDevice
+        self._flush_timeouts = {}   # handle -> automatic flush timeout
+        self._next_handle = 1
+        self._clock_start = time.monotonic ()
+
+    def add_device (self, device):
+        """Puts another VirtualDevice in range."""
+        with self._lock:
+            self.devices.append (device)
+            self._by_address[device.address] = device
+
+    def remove_device (self, address):
+        """Takes the device with the given address out of range."""
+        with self._lock:
+            device = self._by_address.pop (address.upper ())
+            self.devices.remove (device)
+
+    def drop_connection (self, address):
+        """Has the device with the given address end its connections."""
+        address = address.upper ()
+        with self._lock:
+            for handle, device in list (self._connections.items ()):
+                if device.address == address:
+                    del self._connections[handle]
+                    self._flush_timeouts.pop (handle, None)
+                    self._event (EVT_DISCONN_COMPLETE,
+                            struct.pack ("<BHB", HCI_SUCCESS, handle,
+                                         HCI_OE_USER_ENDED_CONNECTION))
+
+    # ---------------- transports ----------------
+
+    def open (self, device_id=-1):
+        """open (device_id=-1) -> VirtualHCISocket
+
+        Returns a new socket connected to the controller, to be used like
+        a raw HCI socket.  device_id is ignored; it is accepted so open can
+        be passed to bluetooth.set_hci_transport.
+
+        """
+        host, controller = socket.socketpair (socket.AF_UNIX,
+                                              socket.SOCK_SEQPACKET)
+        self.attach (controller)
+        return VirtualHCISocket (host)
+
+    def attach (self, transport):
+        """attach (transport)
+
+        Serves HCI commands received on transport, an object with fileno (),
+        recv (bufsize), send (packet) and close () methods that carry one H4
+        packet per call, such as a SOCK_SEQPACKET socket.  The transport is
+        closed when the host closes its end or the controller is closed.
+
+        """
+        with self._lock:
+            if self._stopping:
+                raise ValueError ("attach to a closed VirtualController")
+            fd = transport.fileno ()
+            self._transports[fd] = transport
+            self._epoll.register (fd, select.EPOLLIN)
+            if self._thread is None:
+                self._thread = threading.Thread (target=self._run,
+                        name="VirtualController", daemon=True)
+                self._thread.start ()
+
+    def _detach (self, fd):
+        transport = self._transports.pop (fd, None)
+        if transport is not None:
+            try:
+                self._epoll.unregister (fd)
+            except (OSError, ValueError):
+                pass
+            transport.close ()
+
+    def close (self):
+        """Stops the controller and closes all of its transports."""
+        # not under the lock, which the event loop may hold while it is
+        # blocked sending to a host that is not reading
+        if self._stopping:
+            return
+        self._stopping = True
+        self._wake_w.send (b"\0")
+        if self._thread is not None and \
+                self._thread is not threading.current_thread ():
+            self._thread.join ()
+        with self._lock:
+            for fd in list (self._transports):
+                self._detach (fd)
+            self._epoll.close ()
+            self._wake_r.close ()
+            self._wake_w.close ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
+
+    # ---------------- event loop ----------------
+
+    def _run (self):
+        while True:
+            with self._lock:
+                if self._stopping:
+                    return
+                now = time.monotonic ()
+                while self._timers and self._timers[0][0] <= now:
+                    due, seq, func, args = heapq.heappop (self._timers)
+                    func (*args)
+                timeout = self._timers[0][0] - now if self._timers else -1
+            for fd, events in self._epoll.poll (timeout):
+                if fd == self._wake_r.fileno ():
+                    try:
+                        self._wake_r.recv (64)
+                    except BlockingIOError:
+                        pass
+                    continue
+                with self._lock:
+                    transport = self._transports.get (fd)
+                    if transport is None:
+                        continue
+                    try:
+                        pkt = transport.recv (1024)
+                    except OSError:
+                        pkt = b""
+                    if not pkt:
+                        self._detach (fd)
+                    else:
+                        self._command (pkt)
+
+    def _later (self, delay, func, *args):
+        # called with the lock held.  Timers added from other threads wake
+        # the event loop so it can shorten its wait.
+        heapq.heappush (self._timers, (time.monotonic () + delay,
+                                       next (self._seq), func, args))
+        if threading.current_thread () is not self._thread:
+            self._wake_w.send (b"\0")
+
+    def _air_time (self, seconds):
+        return seconds * self.time_scale
+
+    def _lost (self):
+        return self.loss > 0 and self._rng.random () < self.loss
+
+    def _emit (self, code, params):
+        pkt = struct.pack ("BBB", HCI_EVENT_PKT, code, len (params)) + params
+        self.events += 1
+        for fd, transport in list (self._transports.items ()):
+            try:
+                transport.send (pkt)
+            except OSError:
+                self._detach (fd)
+
+    def _event (self, code, params, delay=0.0):
+        self._later (self.latency + delay, self._emit, code, params)
+
+    def _complete (self, opcode, params):
+        self._later (self.latency, self._answer, EVT_CMD_COMPLETE, opcode,
+                     params)
+
+    def _status (self, opcode, status):
+        self._later (self.latency, self._answer, EVT_CMD_STATUS, opcode,
+                     bytes ([status]))
+
+    def _answer (self, code, opcode, params):
+        # Num_HCI_Command_Packets is counted as the answer is delivered
+        self._unanswered = max (0, self._unanswered - 1)
+        ncmd = max (0, self.command_packets - self._unanswered)
+        if code == EVT_CMD_COMPLETE:
+            self._emit (code, struct.pack ("<BH", ncmd, opcode) + params)
+        else:
+            self._emit (code, params + struct.pack ("<BH", ncmd, opcode))
+
+    def _command (self, pkt):
+        if len (pkt) < 4 or pkt[0] != HCI_COMMAND_PKT:
+            return
+        opcode, plen = struct.unpack_from ("<HB", pkt, 1)
+        params = bytes (pkt[4:4+plen])
+        self.commands += 1
+        self._unanswered += 1
+        handler = self._handlers.get (opcode)
+        if handler is None:
+            self._complete (opcode, bytes ([HCI_UNKNOWN_COMMAND]))
+            return
+        try:
+            handler (params)
+        except struct.error:
+            self._status (opcode, HCI_INVALID_PARAMETERS)
+
+    # ---------------- commands ----------------
+
+    def _reset_command (self, params):
+        self._reset ()
+        self._complete (OP_RESET, b"\0")
+
+    def _read_bd_addr (self, params):
+        self._complete (OP_READ_BD_ADDR, b"\0" + _str2ba (self.address))
+
+    def _read_inquiry_mode (self, params):
+        self._complete (OP_READ_INQUIRY_MODE,
+                        bytes ([HCI_SUCCESS, self.inquiry_mode]))
+
+    def _write_inquiry_mode (self, params):
+        mode = struct.unpack ("B", params[:1])[0]
+        if mode > 2:
+            self._complete (OP_WRITE_INQUIRY_MODE,
+                            bytes ([HCI_INVALID_PARAMETERS]))
+            return
+        self.inquiry_mode = mode
+        self._complete (OP_WRITE_INQUIRY_MODE, b"\0")
+
+    def _inquiry (self, params):
+        lap, length, max_responses = struct.unpack ("<3sBB", params[:5])
+        if self._inquiry_token is not None:
+            self._status (OP_INQUIRY, HCI_COMMAND_DISALLOWED)
+            return
+        self._status (OP_INQUIRY, HCI_SUCCESS)
+        token = self._inquiry_token = object ()
+        window = self._air_time (length * INQUIRY_LENGTH_UNIT)
+        responses = sorted ((self._rng.uniform (0, window), d.address)
+                            for d in self.devices
+                            if d.classic and not self._lost ())
+        if max_responses:
+            responses = responses[:max_responses]
+        for delay, address in responses:
+            self._later (self.latency + delay, self._inquiry_result, token,
+                         self._by_address[address])
+        self._later (self.latency + window, self._inquiry_complete, token)
+
+    def _inquiry_result (self, token, device):
+        if token is not self._inquiry_token:
+            return
+        bdaddr = _str2ba (device.address)
+        dev_class = struct.pack ("<I", device.device_class)[:3]
+        clock = struct.pack ("<H", device.clock_offset)
+        rssi = struct.pack ("b", device.rssi)
+        # psrm R1, pscan period mode P0
+        if self.inquiry_mode == 0:
+            params = b"\x01" + bdaddr + b"\x01\x00\x00" + dev_class + clock
+            self._emit (EVT_INQUIRY_RESULT, params)
+        elif self.inquiry_mode == 1:
+            params = b"\x01" + bdaddr + b"\x01\x00" + dev_class + clock + \
+                    rssi
+            self._emit (EVT_INQUIRY_RESULT_WITH_RSSI, params)
+        else:
+            params = b"\x01" + bdaddr + b"\x01\x00" + dev_class + clock + \
+                    rssi + device.eir ()
+            self._emit (EVT_EXTENDED_INQUIRY_RESULT, params)
+
+    def _inquiry_complete (self, token):
+        if token is self._inquiry_token:
+            self._inquiry_token = None
+            self._emit (EVT_INQUIRY_COMPLETE, b"\0")
+
+    def _inquiry_cancel (self, params):
+        if self._inquiry_token is None:
+            self._complete (OP_INQUIRY_CANCEL,
+                            bytes ([HCI_COMMAND_DISALLOWED]))
+            return
+        self._inquiry_token = None
+        self._complete (OP_INQUIRY_CANCEL, b"\0")
+
+    def _page (self, opcode, address):
+        # starts paging a device.  Returns the delay until the page ends,
+        # and the device, or None if it times out.
+        if self.max_pages is not None and self._pages >= self.max_pages:
+            self._status (opcode, HCI_COMMAND_DISALLOWED)
+            return None, None
+        self._status (opcode, HCI_SUCCESS)
+        self._pages += 1
+        device = self._by_address.get (address)
+        if device is None or not device.classic or self._lost ():
+            return self._air_time (PAGE_TIMEOUT), None
+        return self._air_time (device.page_time), device
+
+    def _remote_name_request (self, params):
+        bdaddr = params[:6]
+        if len (bdaddr) != 6:
+            raise struct.error ("short Remote Name Request")
+        delay, device = self._page (OP_REMOTE_NAME_REQ, ba2str (bdaddr))
+        if delay is None:
+            return
+        if device is None:
+            params = bytes ([HCI_PAGE_TIMEOUT]) + bdaddr + bytes (248)
+        else:
+            name = (device.name or "").encode ("utf-8")[:248]
+            params = b"\0" + bdaddr + name.ljust (248, b"\0")
+        self._later (self.latency + delay, self._page_done,
+                     EVT_REMOTE_NAME_REQ_COMPLETE, params, None)
+
+    def _page_done (self, code, params, connection):
+        self._pages -= 1
+        if connection is not None:
+            handle, device = connection
+            self._connections[handle] = device
+        self._emit (code, params)
+
+    def _create_connection (self, params):
+        bdaddr = params[:6]
+        if len (bdaddr) != 6:
+            raise struct.error ("short Create Connection")
+        delay, device = self._page (OP_CREATE_CONN, ba2str (bdaddr))
+        if delay is None:
+            return
+        if device is None:
+            params = struct.pack ("<BH6sBB", HCI_PAGE_TIMEOUT, 0, bdaddr,
+                                  1, 0)
+            connection = None
+        else:
+            handle = self._next_handle
+            self._next_handle = handle % 0x0eff + 1
+            params = struct.pack ("<BH6sBB", HCI_SUCCESS, handle, bdaddr,
+                                  1, 0)
+            connection = (handle, device)
+        self._later (self.latency + delay, self._page_done,
+                     EVT_CONN_COMPLETE, params, connection)
+
+    def _disconnect (self, params):
+        handle, reason = struct.unpack ("<HB", params[:3])
+        if self._connections.pop (handle, None) is None:
+            self._status (OP_DISCONNECT, HCI_NO_CONNECTION)
+            return
+        self._flush_timeouts.pop (handle, None)
+        self._status (OP_DISCONNECT, HCI_SUCCESS)
+        self._event (EVT_DISCONN_COMPLETE, struct.pack ("<BHB",
+                HCI_SUCCESS, handle, HCI_OE_LOCAL_HOST_TERM))
+
+    def _read_rssi (self, params):
+        handle = struct.unpack ("<H", params[:2])[0]
+        device = self._connections.get (handle)
+        if device is None:
+            self._complete (OP_READ_RSSI, struct.pack ("<BHb",
+                    HCI_NO_CONNECTION, handle, 0))
+        else:
+            self._complete (OP_READ_RSSI, struct.pack ("<BHb",
+                    HCI_SUCCESS, handle, device.rssi))
+
+    def _read_link_quality (self, params):
+        handle = struct.unpack ("<H", params[:2])[0]
+        device = self._connections.get (handle)
+        if device is None:
+            self._complete (OP_READ_LINK_QUALITY, struct.pack ("<BHB",
+                    HCI_NO_CONNECTION, handle, 0))
+        else:
+            self._complete (OP_READ_LINK_QUALITY, struct.pack ("<BHB",
+                    HCI_SUCCESS, handle, device.link_quality))
+
+    def _read_clock (self, params):
+        handle, which = struct.unpack ("<HB", params[:3])
+        # the native clock ticks CLOCK_RATE times a second, in 28 bits
+        clock = int ((time.monotonic () - self._clock_start) *
+                     CLOCK_RATE / self.time_scale)
+        if which == 0:
+            handle = 0
+        else:
+            device = self._connections.get (handle)
+            if device is None:
+                self._complete (OP_READ_CLOCK, struct.pack ("<BHIH",
+                        HCI_NO_CONNECTION, handle, 0, 0))
+                return
+            clock += device.clock_offset << 2
+        self._complete (OP_READ_CLOCK, struct.pack ("<BHIH", HCI_SUCCESS,
+                handle, clock & 0x0fffffff, 0))
+
+    def _read_flush_timeout (self, params):
+        handle = struct.unpack ("<H", params[:2])[0]
+        if handle not in self._connections:
+            self._complete (OP_READ_FLUSH_TIMEOUT, struct.pack ("<BHH",
+                    HCI_NO_CONNECTION, handle, 0))
+        else:
+            timeout = self._flush_timeouts.get (handle, 0)
+            self._complete (OP_READ_FLUSH_TIMEOUT, struct.pack ("<BHH",
+                    HCI_SUCCESS, handle, timeout))
+
+    def _write_flush_timeout (self, params):
+        handle, timeout = struct.unpack ("<HH", params[:4])
+        if handle not in self._connections:
+            status = HCI_NO_CONNECTION
+        elif timeout > 0x07ff:
+            status = HCI_INVALID_PARAMETERS
+        else:
+            self._flush_timeouts[handle] = timeout
+            status = HCI_SUCCESS
+        self._complete (OP_WRITE_FLUSH_TIMEOUT, struct.pack ("<BH", status,
+                handle))
+
+    def _le_set_scan_parameters (self, params):
+        if self._scan_token is not None:
+            self._complete (OP_LE_SET_SCAN_PARAMETERS,
+                            bytes ([HCI_COMMAND_DISALLOWED]))
+            return
+        self._complete (OP_LE_SET_SCAN_PARAMETERS, b"\0")
+
+    def _le_set_scan_enable (self, params):
+        enable, filter_duplicates = struct.unpack ("BB", params[:2])
+        self._complete (OP_LE_SET_SCAN_ENABLE, b"\0")
+        if not enable:
+            self._scan_token = None
+            return
+        if self._scan_token is not None:
+            return
+        token = self._scan_token = object ()
+        self._scan_filter_duplicates = bool (filter_duplicates)
+        interval = self._air_time (self.adv_interval)
+        for device in self.devices:
+            if device.le:
+                self._later (self.latency +
+                             self._rng.uniform (0, interval),
+                             self._advertise, token, device)
+
+    def _advertise (self, token, device):
+        if token is not self._scan_token:
+            return
+        if not self._lost ():
+            data = device.advertising_data ()
+            self._emit (EVT_LE_META_EVENT, struct.pack ("<BBBB6sB",
+                    EVT_LE_ADVERTISING_REPORT, 1, 0, 0,
+                    _str2ba (device.address), len (data)) + data +
+                    struct.pack ("b", device.rssi))
+            if self._scan_filter_duplicates:
+                return
+        self._later (self._air_time (self.adv_interval), self._advertise,
+                     token, device)
+
+
+# ---------------- SDP server ----------------
+
+class _SDPErrorResponse (Exception):
+    pass
+
+def _sdp_sequence (body):
+    if len (body) < 0x100:
+        return struct.pack ("!BB", 0x35, len (body)) + body
+    if len (body) < 0x10000:
+        return struct.pack ("!BH", 0x36, len (body)) + body
+    return struct.pack ("!BI", 0x37, len (body)) + body
+
+def _sdp_uuids (type, value, found):
+    if type == "UUID":
+        if isinstance (value, bytes):
+            value = to_full_uuid (value.decode ("ascii").upper ())
+        found.add (value.upper ())
+    elif type in ("ElemSeq", "AltElemSeq"):
+        for item in value:
+            _sdp_uuids (*item, found)
+
+
+class VirtualSDPServer:
+    """VirtualSDPServer (records=(), mtu=672, latency=0.0)
+
+    An SDP server that answers ServiceSearch, ServiceAttribute and
+    ServiceSearchAttribute requests from records, a list of encoded service
+    records such as those SDPSession.search returns with raw=True.  Records
+    without a ServiceRecordHandle attribute are given one.  Responses that
+    exceed the MaximumAttributeByteCount of a request, or mtu, are split
+    with continuation states, as real servers do.
+
+    Requests are answered in the order they arrive.  latency delays every
+    response without holding up the requests behind it, so that pipelined
+    requests overlap as they do over the air.  requests counts the
+    requests received.
+
+    """
+    def __init__ (self, records=(), mtu=672, latency=0.0):
+        self.mtu = mtu
+        self.latency = latency
+        self.requests = 0
+        self._records = {}      # handle -> (uuids, [(attrid, encoded pair)])
+        self._lock = threading.Lock ()
+        self._sockets = []
+        self._closed = False
+        for record in records:
+            self.add_record (record)
+
+    def add_record (self, record):
+        """add_record (record) -> handle
+
+        Adds an encoded record to the server and returns its handle.
+
+        """
+        buf = memoryview (record)
+        dtype, dsize, pos = _sdp_header (buf, 0, len (buf))
+        if dtype != 6:
+            raise ValueError ("SDP record must be a data element sequence")
+        end = pos + dsize
+        attrs = []
+        uuids = set ()
+        handle = None
+        while pos < end:
+            start = pos
+            type, attrid, pos = sdp_decode_data_element (buf, pos, end)
+            type, value, pos = sdp_decode_data_element (buf, pos, end)
+            attrs.append ((attrid, bytes (buf[start:pos])))
+            _sdp_uuids (type, value, uuids)
+            if attrid == 0x0000:
+                handle = value
+        with self._lock:
+            if handle is None:
+                handle = 0x10000 + len (self._records)
+                while handle in self._records:
+                    handle += 1
+                attrs.insert (0, (0x0000, sdp_make_data_element ("UInt16", 0)
+                        + sdp_make_data_element ("UInt32", handle)))
+            self._records[handle] = (uuids, sorted (attrs))
+        return handle
+
+    def open (self):
+        """open () -> socket
+
+        Returns the client end of a new connection to the server, a
+        SOCK_SEQPACKET socket.
+
+        """
+        client, server = socket.socketpair (socket.AF_UNIX,
+                                            socket.SOCK_SEQPACKET)
+        outbox = queue.Queue ()
+        with self._lock:
+            if self._closed:
+                raise ValueError ("open on a closed VirtualSDPServer")
+            self._sockets.append (server)
+        threading.Thread (target=self._serve, args=(server, outbox),
+                          name="VirtualSDPServer", daemon=True).start ()
+        threading.Thread (target=self._deliver, args=(server, outbox),
+                          name="VirtualSDPServer output", daemon=True).start ()
+        return client
+
+    def close (self):
+        """Closes all connections to the server."""
+        with self._lock:
+            self._closed = True
+            sockets, self._sockets = self._sockets, []
+        for sock in sockets:
+            try:
+                sock.shutdown (socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
+
+    def _serve (self, sock, outbox):
+        try:
+            while True:
+                try:
+                    data = sock.recv (65536)
+                except OSError:
+                    break
+                if not data:
+                    break
+                self.requests += 1
+                outbox.put ((time.monotonic () + self.latency,
+                             self._respond (data)))
+        finally:
+            outbox.put (None)
+
+    def _deliver (self, sock, outbox):
+        try:
+            while True:
+                item = outbox.get ()
+                if item is None:
+                    break
+                due, pdu = item
+                delay = due - time.monotonic ()
+                if delay > 0:
+                    time.sleep (delay)
+                try:
+                    sock.send (pdu)
+                except OSError:
+                    break
+        finally:
+            sock.close ()
+
+    # ---------------- requests ----------------
+
+    def _respond (self, data):
+        tid = 0
+        try:
+            try:
+                pdu_id, tid, params = unpack_pdu (data)
+                if pdu_id == SDP_SVC_SEARCH_REQ:
+                    params = self._service_search (params)
+                elif pdu_id == SDP_SVC_ATTR_REQ:
+                    params = self._service_attribute (params)
+                elif pdu_id == SDP_SVC_SEARCH_ATTR_REQ:
+                    params = self._service_search_attribute (params)
+                else:
+                    raise _SDPErrorResponse (SDP_INVALID_SYNTAX)
+                return pack_pdu (pdu_id + 1, tid, params)
+            except (ValueError, struct.error):
+                raise _SDPErrorResponse (SDP_INVALID_SYNTAX)
+        except _SDPErrorResponse as e:
+            return pack_pdu (SDP_ERROR_RSP, tid, struct.pack ("!H",
+                                                              e.args[0]))
+
+    def _pattern (self, params, pos):
+        type, value, pos = sdp_decode_data_element (params, pos)
+        if type != "ElemSeq" or not value:
+            raise _SDPErrorResponse (SDP_INVALID_SYNTAX)
+        uuids = set ()
+        _sdp_uuids (type, value, uuids)
+        with self._lock:
+            handles = [h for h, (found, attrs) in sorted (self._records.items ())
+                       if uuids <= found]
+        return handles, pos
+
+    def _ranges (self, params, pos):
+        type, value, pos = sdp_decode_data_element (params, pos)
+        if type != "ElemSeq" or not value:
+            raise _SDPErrorResponse (SDP_INVALID_SYNTAX)
+        ranges = []
+        for type, attr in value:
+            if type == "UInt16":
+                ranges.append ((attr, attr))
+            elif type == "UInt32":
+                ranges.append ((attr >> 16, attr & 0xffff))
+            else:
+                raise _SDPErrorResponse (SDP_INVALID_SYNTAX)
+        return ranges, pos
+
+    def _attributes (self, handle, ranges):
+        with self._lock:
+            attrs = self._records[handle][1]
+        return _sdp_sequence (b"".join (pair for attrid, pair in attrs
+                if any (first <= attrid <= last for first, last in ranges)))
+
+    def _offset (self, params, pos, limit):
+        cstate = unpack_cstate (params, pos)
+        if not cstate:
+            return 0
+        if len (cstate) != 4:
+            raise _SDPErrorResponse (SDP_INVALID_CSTATE)
+        offset = struct.unpack ("!I", cstate)[0]
+        if offset > limit:
+            raise _SDPErrorResponse (SDP_INVALID_CSTATE)
+        return offset
+
+    def _service_search (self, params):
+        handles, pos = self._pattern (params, 0)
+        max_count = struct.unpack_from ("!H", params, pos)[0]
+        handles = handles[:max_count]
+        offset = self._offset (params, pos + 2, len (handles))
+        # room for the counts and the continuation state
+        room = max (1, (self.mtu - 5 - 4 - 5) // 4)
+        part = handles[offset:offset + room]
+        offset += len (part)
+        cstate = struct.pack ("!I", offset) if offset < len (handles) else b""
+        return struct.pack ("!HH%dI" % len (part), len (handles), len (part),
+                            *part) + pack_cstate (cstate)
+
+    def _split (self, data, max_bytes, params, pos):
+        offset = self._offset (params, pos, len (data))
+        room = max (1, min (max_bytes, self.mtu - 5 - 2 - 5))
+        part = data[offset:offset + room]
+        offset += len (part)
+        cstate = struct.pack ("!I", offset) if offset < len (data) else b""
+        return struct.pack ("!H", len (part)) + part + pack_cstate (cstate)
+
+    def _service_attribute (self, params):
+        handle, max_bytes = struct.unpack_from ("!IH", params)
+        ranges, pos = self._ranges (params, 6)
+        with self._lock:
+            if handle not in self._records:
+                raise _SDPErrorResponse (SDP_INVALID_RECORD_HANDLE)
+        if max_bytes < 7:
+            raise _SDPErrorResponse (SDP_INVALID_SYNTAX)
+        return self._split (self._attributes (handle, ranges), max_bytes,
+                            params, pos)
+
+    def _service_search_attribute (self, params):
+        handles, pos = self._pattern (params, 0)
+        max_bytes = struct.unpack_from ("!H", params, pos)[0]
+        ranges, pos = self._ranges (params, pos + 2)
+        if max_bytes < 7:
+            raise _SDPErrorResponse (SDP_INVALID_SYNTAX)
+        data = _sdp_sequence (b"".join (self._attributes (h, ranges)
+                                        for h in handles))
+        return self._split (data, max_bytes, params, pos)
@@ -0,0 +1,149 @@
+"""Pure Python helpers for decoding HCI packets.
+
+Nothing in this module talks to a Bluetooth adapter, so it can be used on
+captured packets, and on systems where the _bluetooth extension is not
+available.
+
+"""
+import struct
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# HCI packet types
+HCI_COMMAND_PKT = 0x01
+HCI_ACLDATA_PKT = 0x02
+HCI_SCODATA_PKT = 0x03
+HCI_EVENT_PKT = 0x04
+
+# HCI events
+EVT_INQUIRY_COMPLETE = 0x01
+EVT_INQUIRY_RESULT = 0x02
+EVT_INQUIRY_RESULT_WITH_RSSI = 0x22
+EVT_EXTENDED_INQUIRY_RESULT = 0x2F
+
+INQUIRY_INFO_SIZE = 14
+INQUIRY_INFO_WITH_RSSI_SIZE = 14
+EXTENDED_INQUIRY_INFO_SIZE = 254
+EIR_DATA_SIZE = EXTENDED_INQUIRY_INFO_SIZE - INQUIRY_INFO_WITH_RSSI_SIZE
+
+_bdaddr_fmt = ":".join (["%02X"] * 6)
+_bdaddr_struct = struct.Struct ("6B")
+_devclass_struct = struct.Struct ("<HB")
+
+def ba2str (data):
+    """ba2str (data) -> str
+
+    Converts a packed, little endian bluetooth address into a string of the
+    form XX:XX:XX:XX:XX:XX.
+
+    """
+    return _bdaddr_fmt % tuple (bytes (data[5::-1]))
+
+def _addresses (buf, pos, nrsp):
+    # Reversing the whole block reverses the byte order of each address as
+    # well as the order of the addresses, so each address can be formatted
+    # straight from iter_unpack and the list reversed once at the end.
+    block = bytes (buf[pos:pos+6*nrsp])[::-1]
+    addrs = [_bdaddr_fmt % b for b in _bdaddr_struct.iter_unpack (block)]
+    addrs.reverse ()
+    return addrs
+
+InquiryResults = namedtuple ("InquiryResults", ["addresses", "classes",
+    "pscan_rep_modes", "pscan_period_modes", "clock_offsets", "rssi", "eir"])
+InquiryResults.__doc__ = \
+    """Column arrays for all the responses of one inquiry result event.
+
+    addresses is a list of address strings.  classes, pscan_rep_modes,
+    pscan_period_modes and clock_offsets hold integers.  rssi is None for
+    EVT_INQUIRY_RESULT, and eir, the raw extended inquiry response data of
+    each response, is None except for EVT_EXTENDED_INQUIRY_RESULT.
+
+    """
+
+def decode_inquiry_results (event, params, use_numpy=False):
+    """decode_inquiry_results (event, params, use_numpy=False) -> InquiryResults
+
+    Decodes every response of an EVT_INQUIRY_RESULT,
+    EVT_INQUIRY_RESULT_WITH_RSSI or EVT_EXTENDED_INQUIRY_RESULT event at
+    once.  params is the event parameter block, starting with the number of
+    responses, and may be any object supporting the buffer protocol.
+
+    The parameters of each kind are stored contiguously, so each column is
+    decoded with a single struct call.  If use_numpy is True, the numeric
+    columns are returned as numpy arrays instead of lists.
+
+    """
+    buf = memoryview (params)
+    if len (buf) < 1:
+        raise ValueError ("empty inquiry result event")
+    nrsp = buf[0]
+
+    if event == EVT_INQUIRY_RESULT:
+        # bdaddr, pscan_rep_mode, pscan_period_mode, pscan_mode, dev_class,
+        # clock_offset
+        class_pos, clock_pos, rssi_pos = 9, 12, None
+        size = INQUIRY_INFO_SIZE
+    elif event == EVT_INQUIRY_RESULT_WITH_RSSI:
+        # bdaddr, pscan_rep_mode, pscan_period_mode, dev_class,
+        # clock_offset, rssi
+        class_pos, clock_pos, rssi_pos = 8, 11, 13
+        size = INQUIRY_INFO_WITH_RSSI_SIZE
+    elif event == EVT_EXTENDED_INQUIRY_RESULT:
+        class_pos, clock_pos, rssi_pos = 8, 11, 13
+        size = EXTENDED_INQUIRY_INFO_SIZE
+    else:
+        raise ValueError ("0x%02X is not an inquiry result event" % event)
+
+    if len (buf) < 1 + size * nrsp:
+        raise ValueError ("truncated inquiry result event: %d responses in "
+                          "%d bytes" % (nrsp, len (buf)))
+
+    addrs = _addresses (buf, 1, nrsp)
+    if use_numpy:
+        if numpy is None:
+            raise ImportError ("numpy is not available")
+        cols = _numpy_columns (buf, nrsp, class_pos, clock_pos, rssi_pos)
+    else:
+        cols = _struct_columns (buf, nrsp, class_pos, clock_pos, rssi_pos)
+
+    eir = None
+    if event == EVT_EXTENDED_INQUIRY_RESULT:
+        pos = 1 + INQUIRY_INFO_WITH_RSSI_SIZE * nrsp
+        eir = [bytes (buf[pos+EIR_DATA_SIZE*i:pos+EIR_DATA_SIZE*(i+1)])
+               for i in range (nrsp)]
+
+    return InquiryResults (addrs, *cols, eir)
+
+def _struct_columns (buf, nrsp, class_pos, clock_pos, rssi_pos):
+    psrm = list (buf[1+6*nrsp:1+7*nrsp])
+    pspm = list (buf[1+7*nrsp:1+8*nrsp])
+    pos = 1 + class_pos * nrsp
+    classes = [low | (high << 16) for low, high in
+               _devclass_struct.iter_unpack (buf[pos:pos+3*nrsp])]
+    clockoffs = list (struct.unpack_from ("<%dH" % nrsp, buf,
+                                          1 + clock_pos * nrsp))
+    rssi = None
+    if rssi_pos is not None:
+        rssi = list (struct.unpack_from ("%db" % nrsp, buf,
+                                         1 + rssi_pos * nrsp))
+    return classes, psrm, pspm, clockoffs, rssi
+
+def _numpy_columns (buf, nrsp, class_pos, clock_pos, rssi_pos):
+    def column (dtype, pos, count=nrsp):
+        return numpy.frombuffer (buf, dtype=dtype, count=count,
+                                 offset=1 + pos * nrsp)
+
+    psrm = column (numpy.uint8, 6)
+    pspm = column (numpy.uint8, 7)
+    raw = column (numpy.uint8, class_pos, 3 * nrsp).reshape (nrsp, 3)
+    classes = raw.astype (numpy.uint32) @ numpy.array ([1, 1 << 8, 1 << 16],
+                                                        dtype=numpy.uint32)
+    clockoffs = column ("<u2", clock_pos)
+    rssi = None
+    if rssi_pos is not None:
+        rssi = column (numpy.int8, rssi_pos)
+    return classes, psrm, pspm, clockoffs, rssi
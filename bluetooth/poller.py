@@ -0,0 +1,158 @@
+"""Waiting on many Bluetooth objects at once with epoll.
+
+A Poller watches any mix of BluetoothSocket, DeviceDiscoverer,
+_bluetooth.SDPSession, plain sockets and file descriptors with one epoll
+instance, so a single thread can serve many connections, inquiries and SDP
+sessions, and each wakeup only costs as much as the number of objects that
+are ready.
+
+"""
+import select
+
+
+class Poller:
+    """Poller (edge_triggered=False)
+
+    Registered objects must have a fileno () method or be file descriptors.
+    poll () waits for some of them to become ready.  Objects registered with
+    a callback have it called as callback (obj, events); the others are
+    returned from poll () as (obj, events) pairs.  events is a mask of
+    POLLIN, POLLOUT, POLLERR and POLLHUP.
+
+    In edge triggered mode an object is only reported when it becomes
+    ready, not for as long as it stays ready, so it has to be read (or
+    written) until it would block.  The default level triggered mode
+    reports an object on every poll () while it is ready.
+
+    A DeviceDiscoverer opens a new HCI socket in every find_devices (), so
+    register it after calling find_devices (), e.g. with process_event as
+    the callback:
+
+        poller.register (discoverer, callback=lambda d, e: d.process_event ())
+
+    Closed descriptors are dropped by the kernel automatically, but
+    unregister () should still be called to drop the reference to the
+    object.
+
+    """
+    POLLIN = select.EPOLLIN
+    POLLOUT = select.EPOLLOUT
+    POLLERR = select.EPOLLERR
+    POLLHUP = select.EPOLLHUP
+
+    def __init__ (self, edge_triggered=False):
+        self.edge_triggered = edge_triggered
+        self._epoll = select.epoll ()
+        self._fds = {}      # fd -> (obj, callback)
+        self._objs = {}     # id (obj) -> fd
+
+    @staticmethod
+    def _fileno (obj):
+        fd = obj if isinstance (obj, int) else obj.fileno ()
+        if fd is None or fd < 0:
+            raise ValueError ("%r has no open file descriptor" % (obj,))
+        return fd
+
+    def _mask (self, events, edge_triggered):
+        if edge_triggered is None:
+            edge_triggered = self.edge_triggered
+        if edge_triggered:
+            events |= select.EPOLLET
+        return events
+
+    def register (self, obj, events=select.EPOLLIN, callback=None,
+                  edge_triggered=None):
+        """register (obj, events=POLLIN, callback=None, edge_triggered=None)
+
+        Starts watching obj for events.  edge_triggered overrides the mode
+        of the Poller for this object.  Registering an object again
+        replaces its events and callback.
+
+        """
+        fd = self._fileno (obj)
+        old = self._objs.pop (id (obj), None)
+        if old is not None and old != fd:
+            self._unregister_fd (old)
+        mask = self._mask (events, edge_triggered)
+        try:
+            self._epoll.register (fd, mask)
+        except FileExistsError:
+            self._epoll.modify (fd, mask)
+        stale = self._fds.get (fd)
+        if stale is not None:
+            self._objs.pop (id (stale[0]), None)
+        self._fds[fd] = (obj, callback)
+        self._objs[id (obj)] = fd
+
+    def modify (self, obj, events, callback=None, edge_triggered=None):
+        """modify (obj, events, callback=None, edge_triggered=None)
+
+        Changes the events watched for an object that is already registered.
+        The callback is kept unless a new one is given.
+
+        """
+        fd = self._objs[id (obj)]
+        self._epoll.modify (fd, self._mask (events, edge_triggered))
+        if callback is not None:
+            self._fds[fd] = (obj, callback)
+
+    def unregister (self, obj):
+        """Stops watching obj.  Does nothing if obj is not registered."""
+        fd = self._objs.pop (id (obj), None)
+        if fd is not None:
+            self._unregister_fd (fd)
+
+    def _unregister_fd (self, fd):
+        self._fds.pop (fd, None)
+        try:
+            self._epoll.unregister (fd)
+        except (OSError, ValueError):
+            # already closed
+            pass
+
+    def poll (self, timeout=None, maxevents=-1):
+        """poll (timeout=None, maxevents=-1) -> list of (obj, events)
+
+        Waits up to timeout seconds, or forever if timeout is None, for
+        registered objects to become ready.  Calls the callbacks of the
+        ready objects that have one, and returns the others.
+
+        """
+        if timeout is None:
+            timeout = -1
+        ready = []
+        for fd, events in self._epoll.poll (timeout, maxevents):
+            entry = self._fds.get (fd)
+            if entry is None:
+                continue
+            obj, callback = entry
+            if callback is None:
+                ready.append ((obj, events))
+            else:
+                callback (obj, events)
+        return ready
+
+    def __len__ (self):
+        return len (self._fds)
+
+    def __contains__ (self, obj):
+        return id (obj) in self._objs
+
+    def fileno (self):
+        """Returns the epoll descriptor, so Pollers can be nested."""
+        return self._epoll.fileno ()
+
+    def close (self):
+        self._epoll.close ()
+        self._fds.clear ()
+        self._objs.clear ()
+
+    @property
+    def closed (self):
+        return self._epoll.closed
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
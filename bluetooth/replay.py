@@ -0,0 +1,207 @@
+"""Replaying HCI traffic through DeviceDiscoverer without a radio.
+
+ReplaySocket stands in for the HCI socket of a DeviceDiscoverer and hands
+it the events of a btsnoop or pcap capture, or of a synthetic generator
+such as synthetic_inquiry, so event processing, EIR parsing and name
+resolution run through the same code as with a live adapter.  replay ()
+runs a whole discovery that way and reports the throughput:
+
+    stats = replay (MyDiscoverer (), synthetic_inquiry (10000))
+    print (stats.events_per_second)
+
+Events are returned as fast as they are asked for, or, with pacing, at the
+intervals they were recorded at.  The commands the discoverer sends are
+collected in ReplaySocket.sent rather than answered; to have them answered,
+use the controller emulator in bluetooth.emulator instead.
+
+"""
+import collections
+import os
+import random
+import struct
+import time
+
+from bluetooth.capture import read_capture
+from bluetooth.hci import (HCI_EVENT_PKT, EVT_INQUIRY_COMPLETE,
+                           EVT_INQUIRY_RESULT_WITH_RSSI,
+                           EVT_EXTENDED_INQUIRY_RESULT, EIR_DATA_SIZE)
+
+EVT_CMD_STATUS = 0x0F
+_INQUIRY_OPCODE = 0x0401
+
+# at most 18 responses of 14 bytes fit in one event
+_MAX_RESPONSES_WITH_RSSI = 18
+
+
+class ReplaySocket:
+    """ReplaySocket (source, pacing=False, speed=1.0)
+
+    A stand-in for a raw HCI socket that returns the packets received from
+    the controller in source, one per recv () call.  source is the path of
+    a capture file, or an iterable of (timestamp, received, packet) tuples
+    or of bare H4 event packets.  Packets sent to the controller in the
+    capture are skipped.
+
+    With pacing, recv () waits so that packets are returned at the
+    intervals between their timestamps, divided by speed.  recv () raises
+    EOFError once source is exhausted.
+
+    """
+    def __init__ (self, source, pacing=False, speed=1.0):
+        if isinstance (source, (str, bytes, os.PathLike)):
+            source = read_capture (source)
+        self._source = iter (source)
+        self.pacing = pacing
+        self.speed = speed
+        self.sent = []
+        self.received = 0
+        self.closed = False
+        self._start = None
+
+    def _next_packet (self):
+        for item in self._source:
+            if isinstance (item, (bytes, bytearray, memoryview)):
+                return bytes (item)
+            timestamp, received, packet = item
+            if not received:
+                continue
+            if self.pacing and timestamp is not None:
+                self._wait (timestamp)
+            return bytes (packet)
+        raise EOFError ("end of replayed HCI traffic")
+
+    def _wait (self, timestamp):
+        now = time.monotonic ()
+        if self._start is None:
+            self._start = (now, timestamp)
+            return
+        due = self._start[0] + (timestamp - self._start[1]) / self.speed
+        if due > now:
+            time.sleep (due - now)
+
+    def recv (self, bufsize):
+        packet = self._next_packet ()
+        self.received += 1
+        return packet[:bufsize]
+
+    def recvmsg_into (self, buffers, ancbufsize=0, flags=0):
+        packet = self.recv (len (buffers[0]))
+        buffers[0][:len (packet)] = packet
+        return len (packet), [], 0, None
+
+    def send (self, data):
+        self.sent.append (bytes (data))
+        return len (data)
+
+    sendall = send
+
+    def setsockopt (self, *args):
+        pass
+
+    def close (self):
+        self.closed = True
+
+
+ReplayStats = collections.namedtuple ("ReplayStats",
+        ["events", "commands", "elapsed", "events_per_second"])
+ReplayStats.__doc__ = \
+    """The outcome of replay ().
+
+    events is the number of events processed, commands the number of
+    commands the discoverer sent, and elapsed the wall clock time in
+    seconds.
+
+    """
+
+def replay (discoverer, source, lookup_names=False, pacing=False,
+            speed=1.0):
+    """replay (discoverer, source, lookup_names=False, pacing=False,
+            speed=1.0) -> ReplayStats
+
+    Runs a discovery with discoverer, a DeviceDiscoverer, on the events of
+    source, as given to ReplaySocket, until the inquiry completes or the
+    events run out.  The discoverer's device_discovered (),
+    eir_received () and inquiry_complete () methods are called as for a
+    live inquiry.
+
+    """
+    sock = ReplaySocket (source, pacing, speed)
+    start = time.perf_counter ()
+    discoverer.find_devices (lookup_names=lookup_names, sock=sock)
+    try:
+        discoverer.process_inquiry ()
+    except EOFError:
+        pass
+    elapsed = time.perf_counter () - start
+    return ReplayStats (sock.received, len (sock.sent), elapsed,
+                        sock.received / elapsed if elapsed > 0 else 0.0)
+
+
+def _event (code, params):
+    return struct.pack ("BBB", HCI_EVENT_PKT, code, len (params)) + params
+
+def _eir (name, uuids):
+    data = struct.pack ("BB", len (uuids) * 2 + 1, 0x03) + \
+        b"".join (struct.pack ("<H", u) for u in uuids)
+    name = name.encode ("utf-8")[:EIR_DATA_SIZE - len (data) - 2]
+    data += struct.pack ("BB", len (name) + 1, 0x09) + name
+    return data + bytes (EIR_DATA_SIZE - len (data))
+
+def synthetic_address (index):
+    """synthetic_address (index) -> str
+
+    The address of the index'th device of synthetic_inquiry.
+
+    """
+    return "%02X:%02X:%02X:%02X:%02X:%02X" % \
+        ((0x02,) + tuple (index.to_bytes (5, "big")))
+
+def synthetic_inquiry (devices=1000, extended=True, seed=0,
+                       interval=0.001):
+    """synthetic_inquiry (devices=1000, extended=True, seed=0,
+                       interval=0.001) -> iterator of (timestamp, received, packet)
+
+    Generates the events of an inquiry that finds devices devices: the
+    Command Status of the Inquiry command, the inquiry results and
+    Inquiry Complete.  With extended, every device has its own extended
+    inquiry result carrying a complete name, "device-<index>", and a few
+    service UUIDs; otherwise the results come in Inquiry Result with RSSI
+    events of up to 18 devices each, without names.  RSSI values and
+    classes are pseudo-random, from seed.  Events are timestamped interval
+    seconds apart.
+
+    """
+    rng = random.Random (seed)
+    ts = time.time ()
+
+    def stamp (packet):
+        nonlocal ts
+        ts += interval
+        return (ts, True, packet)
+
+    yield stamp (_event (EVT_CMD_STATUS,
+                         struct.pack ("<BBH", 0, 1, _INQUIRY_OPCODE)))
+    step = 1 if extended else _MAX_RESPONSES_WITH_RSSI
+    for first in range (0, devices, step):
+        indexes = range (first, min (first + step, devices))
+        n = len (indexes)
+        bdaddrs = b"".join (bytes (reversed (bytes.fromhex (
+            synthetic_address (i).replace (":", "")))) for i in indexes)
+        classes = b"".join (struct.pack ("<I", rng.choice (
+            (0x5a020c, 0x240404, 0x1f00, 0x7a020c)))[:3] for i in indexes)
+        clocks = b"".join (struct.pack ("<H", rng.randrange (0x8000))
+                           for i in indexes)
+        rssi = struct.pack ("%db" % n,
+                            *(rng.randrange (-95, -30) for i in indexes))
+        # the parameters of the responses are stored column by column
+        params = bytes ([n]) + bdaddrs + b"\x01" * n + b"\x00" * n + \
+            classes + clocks + rssi
+        if extended:
+            params += b"".join (_eir ("device-%d" % i,
+                                      rng.sample ((0x1101, 0x110a, 0x110b,
+                                                   0x111e, 0x1200), 2))
+                                for i in indexes)
+            yield stamp (_event (EVT_EXTENDED_INQUIRY_RESULT, params))
+        else:
+            yield stamp (_event (EVT_INQUIRY_RESULT_WITH_RSSI, params))
+    yield stamp (_event (EVT_INQUIRY_COMPLETE, b"\x00"))
@@ -0,0 +1,482 @@
+"""A pure Python SDP client.
+
+SDPClient speaks the Service Discovery Protocol itself, over an L2CAP
+connection to PSM 1, instead of going through libbluetooth.  Requests are
+built with sdp_make_data_element and responses are split with the btcommon
+data element parser.  Several requests can be outstanding on one
+connection, and when the server splits a response with continuation
+states, the records that are complete are handed out before the rest
+arrives:
+
+    client = SDPClient.connect (address)
+    for raw in client.service_search_attribute (SERIAL_PORT_CLASS):
+        print (ServiceRecord.from_raw (raw, address))
+
+    handles = client.service_search (PUBLIC_BROWSE_GROUP).result ()
+    records = client.get_records (handles)
+
+Any socket that keeps packet boundaries can carry the connection, so the
+client end of a bluetooth.emulator.VirtualSDPServer stands in for an L2CAP
+socket in tests.
+
+"""
+import collections
+import struct
+import sys
+from errno import EINVAL, EIO, ECONNRESET
+
+from bluetooth.btcommon import BluetoothError, sdp_make_data_element, \
+                               _sdp_header
+
+SDP_PSM = 0x0001
+
+# PDU IDs
+SDP_ERROR_RSP = 0x01
+SDP_SVC_SEARCH_REQ = 0x02
+SDP_SVC_SEARCH_RSP = 0x03
+SDP_SVC_ATTR_REQ = 0x04
+SDP_SVC_ATTR_RSP = 0x05
+SDP_SVC_SEARCH_ATTR_REQ = 0x06
+SDP_SVC_SEARCH_ATTR_RSP = 0x07
+
+# error codes of SDP_ErrorResponse
+SDP_INVALID_VERSION = 0x0001
+SDP_INVALID_RECORD_HANDLE = 0x0002
+SDP_INVALID_SYNTAX = 0x0003
+SDP_INVALID_PDU_SIZE = 0x0004
+SDP_INVALID_CSTATE = 0x0005
+SDP_INSUFFICIENT_RESOURCES = 0x0006
+
+SDP_ERRORS = {
+    SDP_INVALID_VERSION : "invalid SDP version",
+    SDP_INVALID_RECORD_HANDLE : "invalid service record handle",
+    SDP_INVALID_SYNTAX : "invalid request syntax",
+    SDP_INVALID_PDU_SIZE : "invalid PDU size",
+    SDP_INVALID_CSTATE : "invalid continuation state",
+    SDP_INSUFFICIENT_RESOURCES : "insufficient resources",
+    }
+
+MAX_CSTATE_SIZE = 16
+MAX_SEARCH_UUIDS = 12
+
+_pdu_header = struct.Struct ("!BHH")
+_u16 = struct.Struct ("!H")
+_u32 = struct.Struct ("!I")
+
+def pack_pdu (pdu_id, tid, params):
+    """pack_pdu (pdu_id, tid, params) -> bytes
+
+    Prepends the SDP PDU header to params.
+
+    """
+    return _pdu_header.pack (pdu_id, tid, len (params)) + params
+
+def unpack_pdu (data):
+    """unpack_pdu (data) -> (pdu_id, tid, params)
+
+    Splits an SDP PDU into its header fields and parameters.  Raises
+    ValueError if it is truncated.
+
+    """
+    if len (data) < _pdu_header.size:
+        raise ValueError ("truncated SDP PDU header")
+    pdu_id, tid, length = _pdu_header.unpack_from (data)
+    if len (data) < _pdu_header.size + length:
+        raise ValueError ("truncated SDP PDU")
+    return pdu_id, tid, memoryview (data)[_pdu_header.size:
+                                          _pdu_header.size + length]
+
+def pack_cstate (cstate):
+    """pack_cstate (cstate) -> bytes
+
+    Encodes a continuation state: its length, then its bytes.
+
+    """
+    if len (cstate) > MAX_CSTATE_SIZE:
+        raise ValueError ("continuation state longer than %d bytes" %
+                          MAX_CSTATE_SIZE)
+    return bytes ((len (cstate),)) + bytes (cstate)
+
+def unpack_cstate (params, pos):
+    """unpack_cstate (params, pos) -> bytes
+
+    Decodes the continuation state at offset pos of params, which must end
+    the parameters.
+
+    """
+    if pos >= len (params):
+        raise ValueError ("missing continuation state")
+    size = params[pos]
+    if size > MAX_CSTATE_SIZE or pos + 1 + size != len (params):
+        raise ValueError ("invalid continuation state")
+    return bytes (params[pos + 1:])
+
+def search_pattern (uuids):
+    """search_pattern (uuids) -> bytes
+
+    Encodes a ServiceSearchPattern.  uuids is a UUID string or a sequence
+    of up to 12 of them.
+
+    """
+    if isinstance (uuids, str):
+        uuids = [uuids]
+    uuids = list (uuids)
+    if not 1 <= len (uuids) <= MAX_SEARCH_UUIDS:
+        raise ValueError ("a search pattern holds 1 to %d UUIDs" %
+                          MAX_SEARCH_UUIDS)
+    return sdp_make_data_element ("ElemSeq", [("UUID", u) for u in uuids])
+
+def attribute_ranges (attrs=None):
+    """attribute_ranges (attrs=None) -> list of (first, last)
+
+    Converts attrs, a sequence of attribute IDs and (first, last) ranges of
+    attribute IDs, into sorted ranges without overlaps.  None stands for
+    all attributes.
+
+    """
+    if attrs is None:
+        return [(0x0000, 0xffff)]
+    ranges = []
+    for attr in attrs:
+        if isinstance (attr, (tuple, list)):
+            first, last = attr
+        else:
+            first = last = attr
+        if not 0 <= first <= last <= 0xffff:
+            raise ValueError ("invalid attribute ID range %r" % (attr,))
+        ranges.append ((first, last))
+    if not ranges:
+        raise ValueError ("attrs is empty")
+    ranges.sort ()
+    merged = [list (ranges[0])]
+    for first, last in ranges[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1][1] = max (merged[-1][1], last)
+        else:
+            merged.append ([first, last])
+    return [tuple (r) for r in merged]
+
+def attribute_id_list (attrs=None):
+    """attribute_id_list (attrs=None) -> bytes
+
+    Encodes the AttributeIDList of the attributes selected by attrs, as for
+    attribute_ranges.
+
+    """
+    return sdp_make_data_element ("ElemSeq", [
+        ("UInt16", first) if first == last else
+        ("UInt32", first << 16 | last)
+        for first, last in attribute_ranges (attrs)])
+
+
+def _element_end (buf):
+    # the length of the data element at the start of buf, or None if its
+    # header is not complete yet
+    if not buf:
+        return None
+    sizedesc = buf[0] & 7
+    if buf[0] >> 3 == 0 or sizedesc < 5:
+        need = 1
+    else:
+        need = 1 + (1, 2, 4)[sizedesc - 5]
+    if len (buf) < need:
+        return None
+    dtype, dsize, pos = _sdp_header (buf, 0, sys.maxsize)
+    return pos + dsize
+
+
+class _ElementStream:
+    # cuts the attribute data of a response, which arrives in pieces, into
+    # records.  With nested, the data is a sequence of records, otherwise
+    # it is a single record.
+
+    def __init__ (self, nested):
+        self._buf = bytearray ()
+        self._left = None if nested else -1     # bytes of the outer sequence
+
+    def feed (self, data):
+        self._buf += data
+        records = []
+        if self._left is None:
+            end = _element_end (self._buf)
+            if end is None:
+                return records
+            dtype, dsize, pos = _sdp_header (self._buf, 0, sys.maxsize)
+            if dtype != 6:
+                raise ValueError ("attribute lists must be a data element "
+                                  "sequence")
+            del self._buf[:pos]
+            self._left = dsize
+        while self._buf:
+            end = _element_end (self._buf)
+            if end is None or end > len (self._buf):
+                break
+            records.append (bytes (self._buf[:end]))
+            del self._buf[:end]
+            if self._left >= 0:
+                self._left -= end
+        return records
+
+    def close (self):
+        if self._buf or self._left not in (0, -1):
+            raise ValueError ("SDP response ends inside a record")
+
+
+class SDPRequest:
+    """A request sent by SDPClient, and its response as it arrives.
+
+    Iterating over a request yields the items of its response, service
+    record handles for service_search and encoded records for the others,
+    as soon as each is complete, reading from the connection as needed.
+    result () waits for the rest of the response and returns the items not
+    taken yet.
+
+    done tells if the response is complete, and responses how many PDUs it
+    took.  If the request failed, error is the BluetoothError, which is
+    raised once the items before it have been taken.
+
+    """
+    def __init__ (self, client, pdu_id, params, nested=True):
+        self._client = client
+        self.pdu_id = pdu_id
+        self._params = params       # without the continuation state
+        self._items = collections.deque ()
+        self._stream = None
+        if pdu_id != SDP_SVC_SEARCH_REQ:
+            self._stream = _ElementStream (nested)
+        self.done = False
+        self.error = None
+        self.responses = 0
+
+    def _response (self, pdu_id, params):
+        # applies a response PDU, and returns its continuation state
+        if pdu_id == SDP_ERROR_RSP:
+            code = _u16.unpack_from (params)[0] if len (params) >= 2 else 0
+            raise BluetoothError (EIO, "SDP error 0x%04x, %s" % (code,
+                    SDP_ERRORS.get (code, "unknown error")))
+        if pdu_id != self.pdu_id + 1:
+            raise ValueError ("unexpected PDU 0x%02x in response to 0x%02x" %
+                              (pdu_id, self.pdu_id))
+        self.responses += 1
+        if pdu_id == SDP_SVC_SEARCH_RSP:
+            if len (params) < 4:
+                raise ValueError ("truncated ServiceSearchResponse")
+            count = _u16.unpack_from (params, 2)[0]
+            end = 4 + 4 * count
+            cstate = unpack_cstate (params, end)
+            self._items.extend (struct.unpack_from ("!%dI" % count, params, 4))
+        else:
+            if len (params) < 2:
+                raise ValueError ("truncated attribute response")
+            end = 2 + _u16.unpack_from (params)[0]
+            cstate = unpack_cstate (params, end)
+            self._items.extend (self._stream.feed (params[2:end]))
+        if not cstate:
+            if self._stream is not None:
+                self._stream.close ()
+            self.done = True
+        return cstate
+
+    def _fail (self, error):
+        self.error = error
+        self.done = True
+
+    def __iter__ (self):
+        while True:
+            while self._items:
+                yield self._items.popleft ()
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            self._client.process ()
+
+    def result (self):
+        """result () -> list
+
+        Waits until the response is complete and returns its items.
+
+        """
+        return list (self)
+
+
+class SDPClient:
+    """SDPClient (sock, max_attr_bytes=0xffff, max_pending=8)
+
+    An SDP client on sock, a connected socket that keeps packet boundaries,
+    such as a BluetoothSocket (L2CAP) connected to PSM 1.
+
+    max_attr_bytes is the MaximumAttributeByteCount of attribute requests:
+    the most attribute data the server may put in one response.  With a
+    smaller value, a large response comes in more PDUs, and its first
+    records arrive sooner.
+
+    At most max_pending requests are sent before the server has answered
+    them; more wait their turn.  The requests are made by service_search,
+    service_attribute and service_search_attribute, which return an
+    SDPRequest at once.  Responses are read by process (), which iterating
+    over a request, or its result (), calls as needed.  To serve the
+    connection from a selector instead, call process () whenever fileno ()
+    is readable.
+
+    """
+    recv_size = 65536
+
+    def __init__ (self, sock, max_attr_bytes=0xffff, max_pending=8):
+        if not 7 <= max_attr_bytes <= 0xffff:
+            raise ValueError ("max_attr_bytes must be in 7-65535")
+        self._sock = sock
+        self.max_attr_bytes = max_attr_bytes
+        self.max_pending = max (1, max_pending)
+        self._tid = 0
+        self._sent = {}                     # tid -> SDPRequest
+        self._queue = collections.deque ()  # SDPRequests not sent yet
+
+    @classmethod
+    def connect (cls, address, **kwargs):
+        """connect (address, **kwargs) -> SDPClient
+
+        Connects to the SDP server of address.  kwargs are passed to
+        SDPClient.
+
+        """
+        from bluetooth import BluetoothSocket, L2CAP
+        sock = BluetoothSocket (L2CAP)
+        try:
+            sock.connect ((address, SDP_PSM))
+        except BaseException:
+            sock.close ()
+            raise
+        return cls (sock, **kwargs)
+
+    def fileno (self):
+        return self._sock.fileno ()
+
+    def close (self):
+        self._sock.close ()
+        self._fail_all (BluetoothError (ECONNRESET, "SDP client closed"))
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close ()
+
+    @property
+    def pending (self):
+        """The number of requests whose responses are not complete."""
+        return len (self._sent) + len (self._queue)
+
+    # ---------------- requests ----------------
+
+    def service_search (self, uuids, max_records=0xffff):
+        """service_search (uuids, max_records=0xffff) -> SDPRequest
+
+        Sends a ServiceSearchRequest for the handles of the records that
+        contain all of uuids, a UUID string or a sequence of up to 12.
+
+        """
+        return self._submit (SDPRequest (self, SDP_SVC_SEARCH_REQ,
+                search_pattern (uuids) + _u16.pack (max_records)))
+
+    def service_attribute (self, handle, attrs=None):
+        """service_attribute (handle, attrs=None) -> SDPRequest
+
+        Sends a ServiceAttributeRequest for the attributes attrs of the
+        record with the given handle.  attrs is a sequence of attribute IDs
+        and (first, last) ranges of them; None requests all attributes.
+        The response holds a single encoded record.
+
+        """
+        return self._submit (SDPRequest (self, SDP_SVC_ATTR_REQ,
+                _u32.pack (handle) + _u16.pack (self.max_attr_bytes) +
+                attribute_id_list (attrs), nested=False))
+
+    def service_search_attribute (self, uuids, attrs=None):
+        """service_search_attribute (uuids, attrs=None) -> SDPRequest
+
+        Sends a ServiceSearchAttributeRequest for the attributes attrs of
+        the records that contain all of uuids, as for service_search and
+        service_attribute.
+
+        """
+        return self._submit (SDPRequest (self, SDP_SVC_SEARCH_ATTR_REQ,
+                search_pattern (uuids) + _u16.pack (self.max_attr_bytes) +
+                attribute_id_list (attrs)))
+
+    def get_records (self, handles, attrs=None):
+        """get_records (handles, attrs=None) -> list of encoded records
+
+        Requests the attributes attrs of the records with the given
+        handles, up to max_pending at a time, and returns the records in
+        the same order.
+
+        """
+        requests = [self.service_attribute (h, attrs) for h in handles]
+        return [record for r in requests for record in r.result ()]
+
+    # ---------------- transport ----------------
+
+    def _submit (self, request):
+        if len (self._sent) < self.max_pending:
+            self._send (request, b"")
+        else:
+            self._queue.append (request)
+        return request
+
+    def _send (self, request, cstate):
+        self._tid = (self._tid + 1) & 0xffff
+        tid = self._tid
+        self._sent[tid] = request
+        try:
+            self._sock.send (pack_pdu (request.pdu_id, tid,
+                                       request._params + pack_cstate (cstate)))
+        except BaseException:
+            del self._sent[tid]
+            raise
+
+    def _fail_all (self, error):
+        for request in list (self._sent.values ()) + list (self._queue):
+            request._fail (error)
+        self._sent.clear ()
+        self._queue.clear ()
+
+    def process (self):
+        """process () -> SDPRequest
+
+        Reads one response PDU and applies it to its request, which is
+        returned: its items become available to iteration, and the next
+        part of a split response, or a waiting request, is requested.
+        Blocks until a response arrives.
+
+        """
+        if not self._sent:
+            raise BluetoothError (EINVAL, "no SDP request in progress")
+        data = self._sock.recv (self.recv_size)
+        if not data:
+            error = BluetoothError (ECONNRESET,
+                                    "the SDP server closed the connection")
+            self._fail_all (error)
+            raise error
+        try:
+            pdu_id, tid, params = unpack_pdu (data)
+        except ValueError as e:
+            raise BluetoothError (EIO, "malformed SDP response: %s" % e)
+        request = self._sent.pop (tid, None)
+        if request is None:
+            raise BluetoothError (EIO, "SDP response with unknown "
+                                  "transaction ID %d" % tid)
+
+        cstate = None
+        try:
+            cstate = request._response (pdu_id, params)
+        except BluetoothError as e:
+            request._fail (e)
+        except ValueError as e:
+            request._fail (BluetoothError (EIO, "malformed SDP response: %s" %
+                                           e))
+        if cstate:
+            self._send (request, cstate)
+        elif self._queue:
+            self._send (self._queue.popleft (), b"")
+        return request
@@ -28,6 +28,7 @@ Local naming conventions:
 #include <stdlib.h>
 #include <string.h>
 #include <assert.h>
+#include <limits.h>
 
 #include <sys/ioctl.h>
 #include <sys/types.h>
@@ -36,6 +37,8 @@ Local naming conventions:
 #include <fcntl.h>
 #include <errno.h>
 #include <netdb.h>
+#include <poll.h>
+#include <time.h>
 
 #include <bluetooth/bluetooth.h>
 #include <bluetooth/hci.h>
@@ -124,16 +127,38 @@ internal_setblocking(PySocketSockObject *s, int block)
 	return 1;
 }
 
-/* Do a select() on the socket, if necessary (sock_timeout > 0).
+/* Returns the current time of the monotonic clock in seconds. */
+static double
+monotonic_time(void)
+{
+	struct timespec ts;
+
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return ts.tv_sec + ts.tv_nsec * 1e-9;
+}
+
+/* Returns the deadline for an operation on the socket that starts now,
+   for internal_select().  The deadline covers the whole operation, however
+   often it has to wait. */
+static double
+sock_deadline(PySocketSockObject *s)
+{
+	if (s->sock_timeout <= 0.0)
+		return 0.0;
+	return monotonic_time() + s->sock_timeout;
+}
+
+/* Wait with poll() for the socket to become ready, if necessary
+   (sock_timeout > 0), until the deadline returned by sock_deadline().
    The argument writing indicates the direction.
    This does not raise an exception; we'll let our caller do that
    after they've reacquired the interpreter lock.
    Returns 1 on timeout, 0 otherwise. */
 static int
-internal_select(PySocketSockObject *s, int writing)
+internal_select(PySocketSockObject *s, int writing, double deadline)
 {
-	fd_set fds;
-	struct timeval tv;
+	struct pollfd pfd;
+	double remaining, ms;
 	int n;
 
 	/* Nothing to do unless we're in timeout mode (not non-blocking) */
@@ -144,20 +169,34 @@ internal_select(PySocketSockObject *s, int writing)
 	if (s->sock_fd < 0)
 		return 0;
 
-	/* Construct the arguments to select */
-	tv.tv_sec = (int)s->sock_timeout;
-	tv.tv_usec = (int)((s->sock_timeout - tv.tv_sec) * 1e6);
-	FD_ZERO(&fds);
-	FD_SET(s->sock_fd, &fds);
+	pfd.fd = s->sock_fd;
+	pfd.events = writing ? POLLOUT : POLLIN;
+
+	for (;;) {
+		remaining = deadline - monotonic_time();
+		if (remaining <= 0.0)
+			return 1;
+
+		/* See if the socket is ready; round up so we don't spin.
+		   Timeouts too long for poll() are waited in parts. */
+		ms = remaining * 1000.0 + 0.999;
+		if (ms > INT_MAX)
+			ms = INT_MAX;
+		pfd.revents = 0;
+		n = poll(&pfd, 1, (int)ms);
+		if (n != 0)
+			return 0;
+	}
+}
 
-	/* See if the socket is ready */
-	if (writing)
-		n = select(s->sock_fd+1, NULL, &fds, NULL, &tv);
-	else
-		n = select(s->sock_fd+1, &fds, NULL, NULL, &tv);
-	if (n == 0)
-		return 1;
-	return 0;
+/* In timeout mode the descriptor is non-blocking, and the call can still
+   find nothing to do after poll() reported the socket ready, e.g. when
+   another thread got there first.  Returns 1 if the call should wait
+   again until the deadline. */
+static int
+sock_retry(PySocketSockObject *s)
+{
+	return s->sock_timeout > 0.0 && (errno == EAGAIN || errno == EWOULDBLOCK);
 }
 
 /* Initialize a new socket object. */
@@ -584,6 +623,7 @@ sock_accept(PySocketSockObject *s)
     PyObject *addr = NULL;
     PyObject *res = NULL;
     int timeout;
+    double deadline;
 
     if (!getsockaddrlen(s, &addrlen))
         return NULL;
@@ -592,9 +632,12 @@ sock_accept(PySocketSockObject *s)
     newfd = -1;
 
 	Py_BEGIN_ALLOW_THREADS
-	timeout = internal_select(s, 0);
-	if (!timeout)
-		newfd = accept(s->sock_fd, (struct sockaddr *) addrbuf, &addrlen);
+	deadline = sock_deadline(s);
+	do {
+		timeout = internal_select(s, 0, deadline);
+		if (!timeout)
+			newfd = accept(s->sock_fd, (struct sockaddr *) addrbuf, &addrlen);
+	} while (!timeout && newfd < 0 && sock_retry(s));
 	Py_END_ALLOW_THREADS
 
 	if (timeout) {
@@ -697,7 +740,10 @@ PyDoc_STRVAR(settimeout_doc,
 Set a timeout on socket operations.  'timeout' can be a float,\n\
 giving in seconds, or None.  Setting a timeout of None disables\n\
 the timeout feature and is equivalent to setblocking(1).\n\
-Setting a timeout of zero is the same as setblocking(0).");
+Setting a timeout of zero is the same as setblocking(0).\n\
+The timeout covers each call as a whole: sendall() times out when all of\n\
+the data has not been sent after 'timeout' seconds, however many sends\n\
+it takes.");
 
 /* s.gettimeout() method.
    Returns the timeout associated with a socket. */
@@ -913,7 +959,7 @@ internal_connect(PySocketSockObject *s, struct sockaddr *addr, int addrlen,
 
 	if (s->sock_timeout > 0.0) {
 		if (res < 0 && errno == EINPROGRESS) {
-			timeout = internal_select(s, 1);
+			timeout = internal_select(s, 1, sock_deadline(s));
 			res = connect(s->sock_fd, addr, addrlen);
 			if (res < 0 && errno == EISCONN)
 				res = 0;
@@ -1163,6 +1209,7 @@ static PyObject *
 sock_recv(PySocketSockObject *s, PyObject *args)
 {
 	int len, n = 0, flags = 0, timeout;
+	double deadline;
 	PyObject *buf;
 
 	if (!PyArg_ParseTuple(args, "i|i:recv", &len, &flags))
@@ -1178,9 +1225,12 @@ sock_recv(PySocketSockObject *s, PyObject *args)
 		return NULL;
 
 	Py_BEGIN_ALLOW_THREADS
-	timeout = internal_select(s, 0);
-	if (!timeout)
-		n = recv(s->sock_fd, PyBytes_AS_STRING(buf), len, flags);
+	deadline = sock_deadline(s);
+	do {
+		timeout = internal_select(s, 0, deadline);
+		if (!timeout)
+			n = recv(s->sock_fd, PyBytes_AS_STRING(buf), len, flags);
+	} while (!timeout && n < 0 && sock_retry(s));
 	Py_END_ALLOW_THREADS
 
 	if (timeout) {
@@ -1216,24 +1266,34 @@ sock_recvfrom(PySocketSockObject *s, PyObject *args)
 	PyObject *addr = NULL;
 	PyObject *ret = NULL;
 	int len, n = 0, flags = 0, timeout;
+	double deadline;
 	socklen_t addrlen;
 
 	if (!PyArg_ParseTuple(args, "i|i:recvfrom", &len, &flags))
 		return NULL;
 
+	if (len < 0) {
+		PyErr_SetString(PyExc_ValueError,
+				"negative buffersize in recvfrom");
+		return NULL;
+	}
+
 	if (!getsockaddrlen(s, &addrlen))
 		return NULL;
-	buf = PyUnicode_FromStringAndSize((char *) 0, len);
+	buf = PyBytes_FromStringAndSize((char *) 0, len);
 	if (buf == NULL)
 		return NULL;
 
 	Py_BEGIN_ALLOW_THREADS
 	memset(addrbuf, 0, addrlen);
-	timeout = internal_select(s, 0);
-	if (!timeout)
-		n = recvfrom(s->sock_fd, PyBytes_AS_STRING(buf), len, flags,
-			     (void *)addrbuf, &addrlen
-			);
+	deadline = sock_deadline(s);
+	do {
+		timeout = internal_select(s, 0, deadline);
+		if (!timeout)
+			n = recvfrom(s->sock_fd, PyBytes_AS_STRING(buf), len, flags,
+				     (void *)addrbuf, &addrlen
+				);
+	} while (!timeout && n < 0 && sock_retry(s));
 	Py_END_ALLOW_THREADS
 
 	if (timeout) {
@@ -1265,6 +1325,283 @@ PyDoc_STRVAR(recvfrom_doc,
 \n\
 Like recv(buffersize, flags) but also return the sender's address info.");
 
+
+/* s.recv_into(buffer[, nbytes[, flags]]) method */
+
+static PyObject *
+sock_recv_into(PySocketSockObject *s, PyObject *args)
+{
+	Py_buffer pbuf;
+	Py_ssize_t len = 0, n = 0;
+	int flags = 0, timeout;
+	double deadline;
+
+	if (!PyArg_ParseTuple(args, "w*|ni:recv_into", &pbuf, &len, &flags))
+		return NULL;
+
+	if (len < 0) {
+		PyBuffer_Release(&pbuf);
+		PyErr_SetString(PyExc_ValueError,
+				"negative buffersize in recv_into");
+		return NULL;
+	}
+	if (len == 0)
+		len = pbuf.len;
+	else if (len > pbuf.len) {
+		PyBuffer_Release(&pbuf);
+		PyErr_SetString(PyExc_ValueError,
+				"buffer too small for requested bytes");
+		return NULL;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	deadline = sock_deadline(s);
+	do {
+		timeout = internal_select(s, 0, deadline);
+		if (!timeout)
+			n = recv(s->sock_fd, pbuf.buf, len, flags);
+	} while (!timeout && n < 0 && sock_retry(s));
+	Py_END_ALLOW_THREADS
+
+	PyBuffer_Release(&pbuf);
+
+	if (timeout) {
+		PyErr_SetString(socket_timeout, "timed out");
+		return NULL;
+	}
+	if (n < 0)
+		return s->errorhandler();
+	return PyLong_FromSsize_t(n);
+}
+
+PyDoc_STRVAR(recv_into_doc,
+"recv_into(buffer[, nbytes[, flags]]) -> nbytes_read\n\
+\n\
+A version of recv() that stores its data into a buffer rather than creating\n\
+a new string.  Receive up to nbytes bytes from the socket.  If nbytes is not\n\
+specified (or 0), receive up to the size available in the given buffer.\n\
+\n\
+See recv() for documentation about the flags.");
+
+
+/* s.recvfrom_into(buffer[, nbytes[, flags]]) method */
+
+static PyObject *
+sock_recvfrom_into(PySocketSockObject *s, PyObject *args)
+{
+	char addrbuf[256];
+	Py_buffer pbuf;
+	PyObject *addr = NULL;
+	PyObject *ret = NULL;
+	Py_ssize_t len = 0, n = 0;
+	int flags = 0, timeout;
+	double deadline;
+	socklen_t addrlen;
+
+	if (!PyArg_ParseTuple(args, "w*|ni:recvfrom_into", &pbuf, &len,
+			      &flags))
+		return NULL;
+
+	if (len < 0) {
+		PyErr_SetString(PyExc_ValueError,
+				"negative buffersize in recvfrom_into");
+		goto finally;
+	}
+	if (len == 0)
+		len = pbuf.len;
+	else if (len > pbuf.len) {
+		PyErr_SetString(PyExc_ValueError,
+				"nbytes is greater than the length of the buffer");
+		goto finally;
+	}
+
+	if (!getsockaddrlen(s, &addrlen))
+		goto finally;
+
+	Py_BEGIN_ALLOW_THREADS
+	memset(addrbuf, 0, addrlen);
+	deadline = sock_deadline(s);
+	do {
+		timeout = internal_select(s, 0, deadline);
+		if (!timeout)
+			n = recvfrom(s->sock_fd, pbuf.buf, len, flags,
+				     (void *)addrbuf, &addrlen);
+	} while (!timeout && n < 0 && sock_retry(s));
+	Py_END_ALLOW_THREADS
+
+	if (timeout) {
+		PyErr_SetString(socket_timeout, "timed out");
+		goto finally;
+	}
+	if (n < 0) {
+		s->errorhandler();
+		goto finally;
+	}
+
+	if (!(addr = makesockaddr(s, (struct sockaddr *)addrbuf, addrlen)))
+		goto finally;
+
+	ret = Py_BuildValue("nO", n, addr);
+
+finally:
+	Py_XDECREF(addr);
+	PyBuffer_Release(&pbuf);
+	return ret;
+}
+
+PyDoc_STRVAR(recvfrom_into_doc,
+"recvfrom_into(buffer[, nbytes[, flags]]) -> (nbytes, address info)\n\
+\n\
+Like recv_into(buffer[, nbytes[, flags]]) but also return the sender's\n\
+address info.");
+
+
+/* s.recvmsg_into(buffers[, ancbufsize[, flags]]) method */
+
+static PyObject *
+sock_recvmsg_into(PySocketSockObject *s, PyObject *args)
+{
+	char addrbuf[256];
+	PyObject *buffers_arg, *fast = NULL;
+	PyObject *anc = NULL, *addr = NULL, *ret = NULL;
+	Py_buffer *bufs = NULL;
+	struct iovec *iovs = NULL;
+	char *controlbuf = NULL;
+	struct msghdr msg;
+	struct cmsghdr *cmsg;
+	Py_ssize_t nbufs, nparsed = 0, ancbufsize = 0, i, n = 0;
+	int flags = 0, timeout;
+	double deadline;
+	socklen_t addrlen;
+
+	if (!PyArg_ParseTuple(args, "O|ni:recvmsg_into", &buffers_arg,
+			      &ancbufsize, &flags))
+		return NULL;
+
+	if (ancbufsize < 0) {
+		PyErr_SetString(PyExc_ValueError,
+				"negative ancillary buffer size in recvmsg_into");
+		return NULL;
+	}
+	if (!getsockaddrlen(s, &addrlen))
+		return NULL;
+
+	fast = PySequence_Fast(buffers_arg, "recvmsg_into() argument 1 must "
+			       "be an iterable");
+	if (fast == NULL)
+		return NULL;
+	nbufs = PySequence_Fast_GET_SIZE(fast);
+
+	bufs = PyMem_New(Py_buffer, nbufs > 0 ? nbufs : 1);
+	iovs = PyMem_New(struct iovec, nbufs > 0 ? nbufs : 1);
+	if (bufs == NULL || iovs == NULL) {
+		PyErr_NoMemory();
+		goto finally;
+	}
+	for (; nparsed < nbufs; nparsed++) {
+		if (!PyArg_Parse(PySequence_Fast_GET_ITEM(fast, nparsed),
+				 "w*;recvmsg_into() argument 1 must be an "
+				 "iterable of single-segment read-write "
+				 "buffers", &bufs[nparsed]))
+			goto finally;
+		iovs[nparsed].iov_base = bufs[nparsed].buf;
+		iovs[nparsed].iov_len = bufs[nparsed].len;
+	}
+
+	if (ancbufsize > 0) {
+		controlbuf = PyMem_Malloc(ancbufsize);
+		if (controlbuf == NULL) {
+			PyErr_NoMemory();
+			goto finally;
+		}
+	}
+
+	memset(&msg, 0, sizeof(msg));
+	msg.msg_name = addrbuf;
+	msg.msg_namelen = addrlen;
+	msg.msg_iov = iovs;
+	msg.msg_iovlen = nbufs;
+	msg.msg_control = controlbuf;
+	msg.msg_controllen = ancbufsize;
+
+	Py_BEGIN_ALLOW_THREADS
+	memset(addrbuf, 0, addrlen);
+	deadline = sock_deadline(s);
+	do {
+		timeout = internal_select(s, 0, deadline);
+		if (!timeout)
+			n = recvmsg(s->sock_fd, &msg, flags);
+	} while (!timeout && n < 0 && sock_retry(s));
+	Py_END_ALLOW_THREADS
+
+	if (timeout) {
+		PyErr_SetString(socket_timeout, "timed out");
+		goto finally;
+	}
+	if (n < 0) {
+		s->errorhandler();
+		goto finally;
+	}
+
+	/* ancillary data, e.g. HCI_CMSG_DIR and HCI_CMSG_TSTAMP on HCI
+	   sockets.  The last item may have been truncated (MSG_CTRUNC). */
+	if ((anc = PyList_New(0)) == NULL)
+		goto finally;
+	for (cmsg = msg.msg_controllen ? CMSG_FIRSTHDR(&msg) : NULL;
+	     cmsg != NULL; cmsg = CMSG_NXTHDR(&msg, cmsg)) {
+		char *data = (char *)CMSG_DATA(cmsg);
+		char *end = controlbuf + msg.msg_controllen;
+		Py_ssize_t datalen = cmsg->cmsg_len - CMSG_LEN(0);
+		PyObject *item;
+		int err;
+
+		if (data > end)
+			break;
+		if (datalen > end - data)
+			datalen = end - data;
+		item = Py_BuildValue("iiy#", cmsg->cmsg_level,
+				     cmsg->cmsg_type, data, datalen);
+		if (item == NULL)
+			goto finally;
+		err = PyList_Append(anc, item);
+		Py_DECREF(item);
+		if (err < 0)
+			goto finally;
+	}
+
+	if (!(addr = makesockaddr(s, (struct sockaddr *)addrbuf,
+				  msg.msg_namelen)))
+		goto finally;
+
+	ret = Py_BuildValue("nOiO", n, anc, msg.msg_flags, addr);
+
+finally:
+	Py_XDECREF(addr);
+	Py_XDECREF(anc);
+	for (i = 0; i < nparsed; i++)
+		PyBuffer_Release(&bufs[i]);
+	PyMem_Free(bufs);
+	PyMem_Free(iovs);
+	PyMem_Free(controlbuf);
+	Py_DECREF(fast);
+	return ret;
+}
+
+PyDoc_STRVAR(recvmsg_into_doc,
+"recvmsg_into(buffers[, ancbufsize[, flags]]) -> (nbytes, ancdata, msg_flags, address)\n\
+\n\
+Receive normal data and ancillary data from the socket, scattering the\n\
+normal data into a series of buffers.  buffers must be an iterable of\n\
+objects that export writable buffers, e.g. bytearray or memoryview; they\n\
+are filled in order until the data runs out.  ancbufsize sets the size in\n\
+bytes of the internal buffer used to receive the ancillary data; it\n\
+defaults to 0, meaning that no ancillary data will be received.\n\
+\n\
+ancdata is a list of (cmsg_level, cmsg_type, cmsg_data) tuples.  On HCI\n\
+sockets this carries the packet direction and the kernel timestamp once\n\
+the HCI_DATA_DIR and HCI_TIME_STAMP options are enabled.  See recv() for\n\
+documentation about the flags.");
+
 /* s.send(data [,flags]) method */
 
 static PyObject *
@@ -1272,14 +1609,18 @@ sock_send(PySocketSockObject *s, PyObject *args)
 {
 	Py_buffer buf;
 	int n = 0, flags = 0, timeout;
+	double deadline;
 
 	if (!PyArg_ParseTuple(args, "s*|i:send", &buf, &flags))
 		return NULL;
 
 	Py_BEGIN_ALLOW_THREADS
-	timeout = internal_select(s, 1);
-	if (!timeout)
-		n = send(s->sock_fd, buf.buf, buf.len, flags);
+	deadline = sock_deadline(s);
+	do {
+		timeout = internal_select(s, 1, deadline);
+		if (!timeout)
+			n = send(s->sock_fd, buf.buf, buf.len, flags);
+	} while (!timeout && n < 0 && sock_retry(s));
 	Py_END_ALLOW_THREADS
 	PyBuffer_Release(&buf);
 
@@ -1308,6 +1649,7 @@ sock_sendall(PySocketSockObject *s, PyObject *args)
 	Py_buffer buf;
 	char *raw_buf;
 	int len, n = 0, flags = 0, timeout;
+	double deadline;
 
 	if (!PyArg_ParseTuple(args, "s*|i:sendall", &buf, &flags))
 		return NULL;
@@ -1315,13 +1657,18 @@ sock_sendall(PySocketSockObject *s, PyObject *args)
 	Py_BEGIN_ALLOW_THREADS
 	raw_buf = buf.buf;
 	len = buf.len;
+	/* one deadline for all of the data, not one per partial send */
+	deadline = sock_deadline(s);
 	do {
-		timeout = internal_select(s, 1);
+		timeout = internal_select(s, 1, deadline);
 		if (timeout)
 			break;
 		n = send(s->sock_fd, raw_buf, len, flags);
-		if (n < 0)
+		if (n < 0) {
+			if (sock_retry(s))
+				continue;
 			break;
+		}
 		raw_buf += n;
 		len -= n;
 	} while (len > 0);
@@ -1357,6 +1704,7 @@ sock_sendto(PySocketSockObject *s, PyObject *args)
 	Py_buffer buf;
 	struct sockaddr addr = { 0 };
 	int addrlen, n = 0, flags, timeout;
+	double deadline;
 
 	flags = 0;
 	if (!PyArg_ParseTuple(args, "s*O:sendto", &buf, &addro)) {
@@ -1369,9 +1717,12 @@ sock_sendto(PySocketSockObject *s, PyObject *args)
 		return NULL;
 
 	Py_BEGIN_ALLOW_THREADS
-	timeout = internal_select(s, 1);
-	if (!timeout)
-		n = sendto(s->sock_fd, buf.buf, buf.len, flags, &addr, addrlen);
+	deadline = sock_deadline(s);
+	do {
+		timeout = internal_select(s, 1, deadline);
+		if (!timeout)
+			n = sendto(s->sock_fd, buf.buf, buf.len, flags, &addr, addrlen);
+	} while (!timeout && n < 0 && sock_retry(s));
 	Py_END_ALLOW_THREADS
 	PyBuffer_Release(&buf);
 
@@ -1391,6 +1742,270 @@ Like send(data, flags) but allows specifying the destination address.\n\
 For IP sockets, the address is a pair (hostaddr, port).");
 
 
+/* Gets a readable buffer for each item of the sequence fast, and points
+   iovs at them.  Returns the number of buffers acquired, which the caller
+   must release; if it is less than the length of fast, an exception is
+   set. */
+
+static Py_ssize_t
+get_iovecs(PyObject *fast, Py_buffer *bufs, struct iovec *iovs,
+	   const char *errmsg)
+{
+	Py_ssize_t i, n = PySequence_Fast_GET_SIZE(fast);
+
+	for (i = 0; i < n; i++) {
+		if (PyObject_GetBuffer(PySequence_Fast_GET_ITEM(fast, i),
+				       &bufs[i], PyBUF_SIMPLE) < 0) {
+			PyErr_SetString(PyExc_TypeError, errmsg);
+			break;
+		}
+		iovs[i].iov_base = bufs[i].buf;
+		iovs[i].iov_len = bufs[i].len;
+	}
+	return i;
+}
+
+
+/* s.sendmsg(buffers[, ancdata[, flags[, address]]]) method */
+
+static PyObject *
+sock_sendmsg(PySocketSockObject *s, PyObject *args)
+{
+	PyObject *buffers_arg, *anc_arg = NULL, *addro = NULL;
+	PyObject *fast = NULL, *anc_fast = NULL, *ret = NULL;
+	Py_buffer *bufs = NULL, *anc_bufs = NULL;
+	struct iovec *iovs = NULL;
+	struct sockaddr addr = { 0 };
+	struct msghdr msg;
+	struct cmsghdr *cmsg;
+	char *controlbuf = NULL;
+	Py_ssize_t nbufs, nparsed = 0, nanc = 0, nanc_parsed = 0, i, n = 0;
+	size_t controllen = 0;
+	int *anc_levels = NULL, *anc_types = NULL;
+	int addrlen, flags = 0, timeout;
+	double deadline;
+
+	if (!PyArg_ParseTuple(args, "O|OiO:sendmsg", &buffers_arg, &anc_arg,
+			      &flags, &addro))
+		return NULL;
+
+	memset(&msg, 0, sizeof(msg));
+	if (addro != NULL && addro != Py_None) {
+		if (!getsockaddrarg(s, addro, &addr, &addrlen))
+			return NULL;
+		msg.msg_name = &addr;
+		msg.msg_namelen = addrlen;
+	}
+
+	fast = PySequence_Fast(buffers_arg, "sendmsg() argument 1 must be an "
+			       "iterable");
+	if (fast == NULL)
+		return NULL;
+	nbufs = PySequence_Fast_GET_SIZE(fast);
+	bufs = PyMem_New(Py_buffer, nbufs > 0 ? nbufs : 1);
+	iovs = PyMem_New(struct iovec, nbufs > 0 ? nbufs : 1);
+	if (bufs == NULL || iovs == NULL) {
+		PyErr_NoMemory();
+		goto finally;
+	}
+	nparsed = get_iovecs(fast, bufs, iovs, "sendmsg() argument 1 must be "
+			     "an iterable of bytes-like objects");
+	if (nparsed < nbufs)
+		goto finally;
+	msg.msg_iov = iovs;
+	msg.msg_iovlen = nbufs;
+
+	/* ancillary data: a sequence of (level, type, data) tuples */
+	if (anc_arg != NULL && anc_arg != Py_None) {
+		anc_fast = PySequence_Fast(anc_arg, "sendmsg() argument 2 must "
+					   "be an iterable");
+		if (anc_fast == NULL)
+			goto finally;
+		nanc = PySequence_Fast_GET_SIZE(anc_fast);
+		anc_bufs = PyMem_New(Py_buffer, nanc > 0 ? nanc : 1);
+		anc_levels = PyMem_New(int, nanc > 0 ? nanc : 1);
+		anc_types = PyMem_New(int, nanc > 0 ? nanc : 1);
+		if (anc_bufs == NULL || anc_levels == NULL ||
+		    anc_types == NULL) {
+			PyErr_NoMemory();
+			goto finally;
+		}
+		for (; nanc_parsed < nanc; nanc_parsed++) {
+			if (!PyArg_ParseTuple(
+				    PySequence_Fast_GET_ITEM(anc_fast,
+							     nanc_parsed),
+				    "iiy*:sendmsg", &anc_levels[nanc_parsed],
+				    &anc_types[nanc_parsed],
+				    &anc_bufs[nanc_parsed]))
+				goto finally;
+			controllen += CMSG_SPACE(anc_bufs[nanc_parsed].len);
+		}
+	}
+	if (controllen > 0) {
+		controlbuf = PyMem_Calloc(1, controllen);
+		if (controlbuf == NULL) {
+			PyErr_NoMemory();
+			goto finally;
+		}
+		msg.msg_control = controlbuf;
+		msg.msg_controllen = controllen;
+		cmsg = CMSG_FIRSTHDR(&msg);
+		for (i = 0; i < nanc; i++, cmsg = CMSG_NXTHDR(&msg, cmsg)) {
+			cmsg->cmsg_level = anc_levels[i];
+			cmsg->cmsg_type = anc_types[i];
+			cmsg->cmsg_len = CMSG_LEN(anc_bufs[i].len);
+			memcpy(CMSG_DATA(cmsg), anc_bufs[i].buf,
+			       anc_bufs[i].len);
+		}
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	deadline = sock_deadline(s);
+	do {
+		timeout = internal_select(s, 1, deadline);
+		if (!timeout)
+			n = sendmsg(s->sock_fd, &msg, flags);
+	} while (!timeout && n < 0 && sock_retry(s));
+	Py_END_ALLOW_THREADS
+
+	if (timeout) {
+		PyErr_SetString(socket_timeout, "timed out");
+		goto finally;
+	}
+	if (n < 0) {
+		s->errorhandler();
+		goto finally;
+	}
+	ret = PyLong_FromSsize_t(n);
+
+finally:
+	for (i = 0; i < nparsed; i++)
+		PyBuffer_Release(&bufs[i]);
+	for (i = 0; i < nanc_parsed; i++)
+		PyBuffer_Release(&anc_bufs[i]);
+	PyMem_Free(bufs);
+	PyMem_Free(iovs);
+	PyMem_Free(anc_bufs);
+	PyMem_Free(anc_levels);
+	PyMem_Free(anc_types);
+	PyMem_Free(controlbuf);
+	Py_XDECREF(anc_fast);
+	Py_DECREF(fast);
+	return ret;
+}
+
+PyDoc_STRVAR(sendmsg_doc,
+"sendmsg(buffers[, ancdata[, flags[, address]]]) -> count\n\
+\n\
+Send normal and ancillary data to the socket, gathering the non-ancillary\n\
+data from a series of buffers and concatenating it into a single message,\n\
+e.g. a header and a payload as one L2CAP packet.  buffers must be an\n\
+iterable of bytes-like objects.  ancdata is an iterable of zero or more\n\
+(cmsg_level, cmsg_type, cmsg_data) tuples.  See send() for the flags.\n\
+address, if given and not None, sets the destination.  Returns the number\n\
+of bytes of normal data sent.");
+
+
+/* s.send_many(packets[, flags]) method */
+
+static PyObject *
+sock_send_many(PySocketSockObject *s, PyObject *args)
+{
+	PyObject *packets_arg, *fast, *ret = NULL;
+	Py_buffer *bufs = NULL;
+	struct iovec *iovs = NULL;
+	struct mmsghdr *msgs = NULL;
+	Py_ssize_t npkts, nparsed = 0, done = 0, i;
+	int n = 0, err = 0, flags = 0, timeout = 0;
+	double deadline;
+
+	if (!PyArg_ParseTuple(args, "O|i:send_many", &packets_arg, &flags))
+		return NULL;
+
+	fast = PySequence_Fast(packets_arg, "send_many() argument 1 must be "
+			       "an iterable");
+	if (fast == NULL)
+		return NULL;
+	npkts = PySequence_Fast_GET_SIZE(fast);
+	bufs = PyMem_New(Py_buffer, npkts > 0 ? npkts : 1);
+	iovs = PyMem_New(struct iovec, npkts > 0 ? npkts : 1);
+	msgs = PyMem_Calloc(npkts > 0 ? npkts : 1, sizeof(struct mmsghdr));
+	if (bufs == NULL || iovs == NULL || msgs == NULL) {
+		PyErr_NoMemory();
+		goto finally;
+	}
+	nparsed = get_iovecs(fast, bufs, iovs, "send_many() argument 1 must "
+			     "be an iterable of bytes-like objects");
+	if (nparsed < npkts)
+		goto finally;
+	for (i = 0; i < npkts; i++) {
+		msgs[i].msg_hdr.msg_iov = &iovs[i];
+		msgs[i].msg_hdr.msg_iovlen = 1;
+	}
+
+	/* Send as many packets per system call as the kernel takes.  In
+	   timeout mode, wait for the socket to become writable again when
+	   the send buffer fills up.  Stop at the first error. */
+	Py_BEGIN_ALLOW_THREADS
+	deadline = sock_deadline(s);
+	while (done < npkts) {
+		timeout = internal_select(s, 1, deadline);
+		if (timeout)
+			break;
+		n = sendmmsg(s->sock_fd, msgs + done,
+			     (unsigned int)(npkts - done), flags);
+		if (n < 0) {
+			err = errno;
+			if (sock_retry(s))
+				continue;
+			break;
+		}
+		done += n;
+	}
+	Py_END_ALLOW_THREADS
+
+	if (done == 0 && npkts > 0) {
+		if (timeout) {
+			PyErr_SetString(socket_timeout, "timed out");
+			goto finally;
+		}
+		errno = err;
+		s->errorhandler();
+		goto finally;
+	}
+
+	if ((ret = PyList_New(done)) == NULL)
+		goto finally;
+	for (i = 0; i < done; i++) {
+		PyObject *count = PyLong_FromUnsignedLong(msgs[i].msg_len);
+		if (count == NULL) {
+			Py_CLEAR(ret);
+			goto finally;
+		}
+		PyList_SET_ITEM(ret, i, count);
+	}
+
+finally:
+	for (i = 0; i < nparsed; i++)
+		PyBuffer_Release(&bufs[i]);
+	PyMem_Free(bufs);
+	PyMem_Free(iovs);
+	PyMem_Free(msgs);
+	Py_DECREF(fast);
+	return ret;
+}
+
+PyDoc_STRVAR(send_many_doc,
+"send_many(packets[, flags]) -> list of counts\n\
+\n\
+Send each of a sequence of bytes-like objects as a separate message, e.g.\n\
+one L2CAP packet each, with sendmmsg(), releasing the interpreter lock only\n\
+once.  Returns the number of bytes sent for each packet that was sent.\n\
+Sending stops at the first packet that fails or times out, so the list may\n\
+be shorter than packets; the error is only raised if no packet at all\n\
+could be sent.  See send() for the flags.");
+
+
 /* s.shutdown(how) method */
 
 static PyObject *
@@ -1464,12 +2079,22 @@ static PyMethodDef sock_methods[] = {
 			recv_doc},
 	{"recvfrom",	(PyCFunction)sock_recvfrom, METH_VARARGS,
 			recvfrom_doc},
+	{"recv_into",	(PyCFunction)sock_recv_into, METH_VARARGS,
+			recv_into_doc},
+	{"recvfrom_into", (PyCFunction)sock_recvfrom_into, METH_VARARGS,
+			recvfrom_into_doc},
+	{"recvmsg_into", (PyCFunction)sock_recvmsg_into, METH_VARARGS,
+			recvmsg_into_doc},
 	{"send",	(PyCFunction)sock_send, METH_VARARGS,
 			send_doc},
 	{"sendall",	(PyCFunction)sock_sendall, METH_VARARGS,
 			sendall_doc},
 	{"sendto",	(PyCFunction)sock_sendto, METH_VARARGS,
 			sendto_doc},
+	{"sendmsg",	(PyCFunction)sock_sendmsg, METH_VARARGS,
+			sendmsg_doc},
+	{"send_many",	(PyCFunction)sock_send_many, METH_VARARGS,
+			send_many_doc},
 	{"setblocking",	(PyCFunction)sock_setblocking, METH_O,
 			setblocking_doc},
 	{"settimeout", (PyCFunction)sock_settimeout, METH_O,
@@ -2183,7 +2808,7 @@ bt_hci_read_remote_name(PyObject *self, PyObject *args, PyObject *kwds)
     char *addr = NULL;
     bdaddr_t ba;
     int timeout = 5192;
-    static char name[249];
+    char name[249];     /* on the stack: other threads may run meanwhile */
     PySocketSockObject *socko = NULL;
     int err = 0;
 
@@ -2206,7 +2831,7 @@ bt_hci_read_remote_name(PyObject *self, PyObject *args, PyObject *kwds)
     if( err < 0)
         return PyErr_SetFromErrno(bluetooth_error);
 
-    return PyUnicode_FromString( name );
+    return PyUnicode_DecodeUTF8( name, strlen(name), "replace" );
 }
 PyDoc_STRVAR(bt_hci_read_remote_name_doc,
 "hci_read_remote_name(sock, bdaddr, timeout=5192)\n\
@@ -2216,7 +2841,9 @@ Performs a remote name request to the specified bluetooth device.\n\
    bdaddr - the bluetooth address of the remote device\n\
    timeout - maximum amount of time, in milliseconds, to wait\n\
 \n\
-Returns the name of the device, or raises an error on failure");
+Returns the name of the device, or raises an error on failure.  Bytes of\n\
+the name that are not valid UTF-8 are replaced with U+FFFD.  The call is\n\
+thread safe, but concurrent calls should use separate HCI sockets.");
 
 static char *opcode2str(uint16_t opcode);
 
@@ -2279,7 +2906,7 @@ static PyObject * bt_hci_filter_ ## name (PyObject *self, PyObject *args )\
         return 0; \
     } \
     hci_filter_ ## name ( arg, (struct hci_filter*)param ); \
-    return PyUnicode_FromStringAndSize(param, len); \
+    return PyBytes_FromStringAndSize(param, len); \
 } \
 PyDoc_STRVAR(bt_hci_filter_ ## name ## _doc, docstring);
 
@@ -2308,7 +2935,7 @@ static PyObject * bt_hci_filter_ ## name (PyObject *self, PyObject *args )\
         return 0; \
     } \
     hci_filter_ ## name ( (struct hci_filter*)param ); \
-    return PyUnicode_FromStringAndSize(param, len); \
+    return PyBytes_FromStringAndSize(param, len); \
 } \
 PyDoc_STRVAR(bt_hci_filter_ ## name ## _doc, docstring);
 
@@ -2547,9 +3174,9 @@ static PyObject *
 bt_hci_filter_new(PyObject *self, PyObject *args)
 {
     struct hci_filter flt;
-    int len = sizeof(flt);
+    Py_ssize_t len = sizeof(flt);
     hci_filter_clear( &flt );
-    return Py_BuildValue("s#", (char*)&flt, len);
+    return Py_BuildValue("y#", (char*)&flt, len);
 }
 PyDoc_STRVAR(bt_hci_filter_new_doc,
 "hci_filter_new()\n\
@@ -3078,6 +3705,8 @@ PyInit__bluetooth(void)
     PyModule_AddIntMacro(m, SOL_HCI);
     PyModule_AddIntMacro(m, HCI_DATA_DIR);
     PyModule_AddIntMacro(m, HCI_TIME_STAMP);
+    PyModule_AddIntMacro(m, HCI_CMSG_DIR);
+    PyModule_AddIntMacro(m, HCI_CMSG_TSTAMP);
     PyModule_AddIntMacro(m, HCI_FILTER);
     PyModule_AddIntMacro(m, HCI_MAX_EVENT_SIZE);
     PyModule_AddIntMacro(m, HCI_EVENT_HDR_SIZE);
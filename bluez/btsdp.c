@@ -52,38 +52,204 @@ PyDoc_STRVAR(sess_doc,
 TODO\n\
 ");
 
+/*
+ * the attributes do_search turns into the fields of a record dictionary,
+ * as ranges of attribute IDs (first << 16 | last)
+ */
+static const uint32_t default_attr_ranges[] = {
+    0x00010001,     /* ServiceClassIDList */
+    0x00030004,     /* ServiceID, ProtocolDescriptorList */
+    0x00090009,     /* BluetoothProfileDescriptorList */
+    0x01000102,     /* service name, description and provider name */
+};
+#define N_DEFAULT_ATTR_RANGES \
+    (sizeof(default_attr_ranges) / sizeof(default_attr_ranges[0]))
+
+static int
+compare_ranges( const void *a, const void *b )
+{
+    uint32_t x = *(const uint32_t*)a, y = *(const uint32_t*)b;
+    return x < y ? -1 : x > y;
+}
+
+/*
+ * converts attrs, a sequence of attribute IDs and (first, last) ranges of
+ * attribute IDs, into a sorted array of merged ranges, allocated with
+ * PyMem_Malloc.  None gives the default ranges.  Returns the number of
+ * ranges, or -1 with an exception set.
+ */
+static Py_ssize_t
+get_attr_ranges( PyObject *attrs, uint32_t **ranges_ret )
+{
+    PyObject *seq, *item;
+    Py_ssize_t i, n, count = 0;
+    uint32_t *ranges;
+    long first, last;
+
+    if( attrs == NULL || attrs == Py_None ) {
+        ranges = PyMem_New( uint32_t, N_DEFAULT_ATTR_RANGES );
+        if( ! ranges ) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        memcpy( ranges, default_attr_ranges, sizeof(default_attr_ranges) );
+        *ranges_ret = ranges;
+        return N_DEFAULT_ATTR_RANGES;
+    }
+
+    seq = PySequence_Fast( attrs, "attrs must be a sequence of attribute "
+            "IDs and (first, last) ranges" );
+    if( ! seq ) return -1;
+    n = PySequence_Fast_GET_SIZE( seq );
+    if( n == 0 ) {
+        Py_DECREF( seq );
+        PyErr_SetString( PyExc_ValueError, "attrs is empty" );
+        return -1;
+    }
+    ranges = PyMem_New( uint32_t, n );
+    if( ! ranges ) {
+        Py_DECREF( seq );
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    for( i = 0; i < n; i++ ) {
+        item = PySequence_Fast_GET_ITEM( seq, i );
+        if( PyTuple_Check( item ) ) {
+            if( ! PyArg_ParseTuple( item, "ll", &first, &last ) ) goto fail;
+        } else {
+            first = last = PyLong_AsLong( item );
+            if( first == -1 && PyErr_Occurred() ) goto fail;
+        }
+        if( first < 0 || last > 0xffff || first > last ) {
+            PyErr_Format( PyExc_ValueError,
+                    "invalid attribute ID range %ld-%ld", first, last );
+            goto fail;
+        }
+        ranges[i] = (uint32_t) first << 16 | (uint32_t) last;
+    }
+    Py_DECREF( seq );
+
+    // SDP servers want the IDs in ascending order, without overlaps
+    qsort( ranges, n, sizeof(uint32_t), compare_ranges );
+    for( i = 0; i < n; i++ ) {
+        if( count > 0 &&
+                (ranges[i] >> 16) <= (ranges[count-1] & 0xffff) + 1 ) {
+            if( (ranges[i] & 0xffff) > (ranges[count-1] & 0xffff) )
+                ranges[count-1] = (ranges[count-1] & 0xffff0000) |
+                    (ranges[i] & 0xffff);
+        } else {
+            ranges[count++] = ranges[i];
+        }
+    }
+    *ranges_ret = ranges;
+    return count;
+
+fail:
+    Py_DECREF( seq );
+    PyMem_Free( ranges );
+    return -1;
+}
+
+/*
+ * encodes rec back into the data element sequence of attribute ID and value
+ * pairs it was sent as, header included, and returns it as a python bytes
+ * object.
+ */
+static PyObject *
+record_to_bytes( sdp_record_t *rec )
+{
+    sdp_buf_t pdu;
+    uint8_t header[5];
+    size_t hlen;
+    uint32_t len;
+    PyObject *result;
+    char *p;
+
+    if( sdp_gen_record_pdu( rec, &pdu ) < 0 ) {
+        PyErr_SetString( bluetooth_error, "cannot encode the service record" );
+        return 0;
+    }
+
+    // sdp_gen_record_pdu writes the attribute list as one data element
+    // sequence, header included, which is the form the SDP server takes
+    // records in and returns them in.  Its attribute IDs are never encoded
+    // as sequences, so a list without the header is told apart by its
+    // first byte and given one.
+    len = pdu.data_size;
+    if( len > 0 && ( pdu.data[0] == SDP_SEQ8 || pdu.data[0] == SDP_SEQ16
+                || pdu.data[0] == SDP_SEQ32 ) ) {
+        result = PyBytes_FromStringAndSize( (char *) pdu.data, len );
+        free( pdu.data );
+        return result;
+    }
+    if( len <= 0xff ) {
+        header[0] = SDP_SEQ8;
+        header[1] = len;
+        hlen = 2;
+    } else if( len <= 0xffff ) {
+        header[0] = SDP_SEQ16;
+        header[1] = len >> 8;
+        header[2] = len;
+        hlen = 3;
+    } else {
+        header[0] = SDP_SEQ32;
+        header[1] = len >> 24;
+        header[2] = len >> 16;
+        header[3] = len >> 8;
+        header[4] = len;
+        hlen = 5;
+    }
+
+    result = PyBytes_FromStringAndSize( NULL, hlen + len );
+    if( result ) {
+        p = PyBytes_AS_STRING( result );
+        memcpy( p, header, hlen );
+        memcpy( p + hlen, pdu.data, len );
+    }
+    free( pdu.data );
+    return result;
+}
+
 /* 
- * utility function to perform an SDP search on a connected session.  Builds 
- * and returns a python list of dictionaries.  Each dictionary represents a 
- * service record match
+ * builds and returns a python list of dictionaries from the records of a
+ * search response.  Each dictionary represents a service record match.
+ * With raw, the list holds the records as bytes instead.  The records and
+ * the list are freed.
  */
 static PyObject *
-do_search( sdp_session_t *sess, uuid_t *uuid )
+records_to_list( sdp_list_t *response_list, int raw )
 {
-    sdp_list_t *response_list = NULL, *attrid_list, *search_list, *r;
-    uint32_t range = 0x0000ffff;
+    sdp_list_t *r;
     char buf[1024] = { 0 };
-    int err = 0;
     PyObject *result = 0;
 
 	PyObject *rtn_list = PyList_New(0);
-    if( ! rtn_list ) return 0;
-    search_list = sdp_list_append( 0, uuid );
-    attrid_list = sdp_list_append( 0, &range );
-
-    // perform the search
-    Py_BEGIN_ALLOW_THREADS
-    err = sdp_service_search_attr_req( sess, search_list, \
-            SDP_ATTR_REQ_RANGE, attrid_list, &response_list);
-    Py_END_ALLOW_THREADS
-    if( err ) {
-        PyErr_SetFromErrno( bluetooth_error );
-        result = 0;
-        goto cleanup;
+    if( ! rtn_list ) {
+        sdp_list_free( response_list, (sdp_free_func_t) sdp_record_free );
+        return 0;
     }
 
     // parse the results (ewww....)
 
+    if( raw ) {
+        for( r = response_list; r; r = r->next ) {
+            sdp_record_t *rec = (sdp_record_t*) r->data;
+            PyObject *data = rtn_list ? record_to_bytes( rec ) : NULL;
+
+            if( data ) {
+                if( PyList_Append( rtn_list, data ) < 0 )
+                    Py_CLEAR( rtn_list );
+                Py_DECREF( data );
+            } else {
+                Py_CLEAR( rtn_list );
+            }
+            sdp_record_free( rec );
+        }
+        result = rtn_list;
+        goto cleanup;
+    }
+
     // go through each of the service records
     for (r = response_list; r; r = r->next ) {
         PyObject *dict = PyDict_New();
@@ -218,9 +384,151 @@ do_search( sdp_session_t *sess, uuid_t *uuid )
 
 cleanup:
     sdp_list_free( response_list, 0 );
+    return result;
+}
+
+/* 
+ * utility function to perform an SDP search on a connected session.  Only
+ * the attributes in the n ranges are requested from the server.  Returns
+ * the records as records_to_list does.
+ */
+static PyObject *
+do_search( sdp_session_t *sess, uuid_t *uuid, uint32_t *ranges,
+        Py_ssize_t n, int raw )
+{
+    sdp_list_t *response_list = NULL, *attrid_list = NULL, *search_list;
+    int err = 0;
+    Py_ssize_t i;
+
+    search_list = sdp_list_append( 0, uuid );
+    for( i = 0; i < n; i++ )
+        attrid_list = sdp_list_append( attrid_list, &ranges[i] );
+
+    // perform the search
+    Py_BEGIN_ALLOW_THREADS
+    err = sdp_service_search_attr_req( sess, search_list, \
+            SDP_ATTR_REQ_RANGE, attrid_list, &response_list);
+    Py_END_ALLOW_THREADS
+    if( err ) PyErr_SetFromErrno( bluetooth_error );
     sdp_list_free( search_list, 0 );
     sdp_list_free( attrid_list, 0 );
-    return result;
+    if( err ) return 0;
+
+    return records_to_list( response_list, raw );
+}
+
+/*
+ * drops the transaction started by search_async or browse_async, if any,
+ * without calling its callback.
+ */
+static void
+clear_async( PySDPSessionObject *s )
+{
+    Py_CLEAR( s->callback );
+    sdp_list_free( s->results, (sdp_free_func_t) sdp_record_free );
+    s->results = NULL;
+    s->done = 0;
+}
+
+/*
+ * called by sdp_process once the response of an asynchronous search is
+ * complete, or the transaction failed.  Runs without the GIL, so it only
+ * keeps the records for sess_process to convert.
+ */
+static void
+async_notify( uint8_t type, uint16_t status, uint8_t *rsp, size_t size,
+        void *udata )
+{
+    PySDPSessionObject *s = (PySDPSessionObject *) udata;
+    sdp_list_t *recs = NULL;
+    uint8_t dtd;
+    int seqlen = 0, scanned, recsize, left = size;
+
+    s->done = 1;
+    s->status = status;
+    if( status == 0xffff ) {
+        s->err = sdp_get_error( s->session );
+        if( s->err == 0 ) s->err = EIO;
+        return;
+    }
+    if( type != SDP_SVC_SEARCH_ATTR_RSP || status ) {
+        s->err = EIO;
+        return;
+    }
+    s->err = 0;
+
+    // rsp is the AttributeLists sequence, of one sequence per record
+    scanned = sdp_extract_seqtype( rsp, left, &dtd, &seqlen );
+    if( scanned <= 0 || seqlen == 0 ) return;
+    rsp += scanned;
+    left -= scanned;
+    while( left > 0 ) {
+        sdp_record_t *rec;
+
+        recsize = 0;
+        rec = sdp_extract_pdu( rsp, left, &recsize );
+        if( ! rec ) break;
+        if( recsize <= 0 ) {
+            sdp_record_free( rec );
+            break;
+        }
+        recs = sdp_list_append( recs, rec );
+        rsp += recsize;
+        left -= recsize;
+    }
+    s->results = recs;
+}
+
+/*
+ * starts an asynchronous search of the session for uuid, whose records are
+ * passed to callback by sess_process.
+ */
+static PyObject *
+start_async( PySDPSessionObject *s, uuid_t *uuid, PyObject *callback,
+        PyObject *attrs, int raw )
+{
+    sdp_list_t *search_list, *attrid_list = NULL;
+    uint32_t *ranges = NULL;
+    Py_ssize_t i, n;
+    int err;
+
+    if( ! PyCallable_Check( callback ) ) {
+        PyErr_SetString( PyExc_TypeError, "callback must be callable" );
+        return 0;
+    }
+
+    // make sure the SDP session is open
+    if( ! s->session ) {
+        PyErr_SetString( bluetooth_error, "SDP session is not active!" );
+        return 0;
+    }
+    if( s->callback ) {
+        PyErr_SetString( bluetooth_error,
+                "an SDP transaction is already in progress" );
+        return 0;
+    }
+
+    if( (n = get_attr_ranges( attrs, &ranges )) < 0 ) return 0;
+    search_list = sdp_list_append( 0, uuid );
+    for( i = 0; i < n; i++ )
+        attrid_list = sdp_list_append( attrid_list, &ranges[i] );
+
+    clear_async( s );
+    sdp_set_notify( s->session, async_notify, s );
+
+    // this only sends the request
+    err = sdp_service_search_attr_async( s->session, search_list,
+            SDP_ATTR_REQ_RANGE, attrid_list );
+    if( err ) PyErr_SetFromErrno( bluetooth_error );
+    sdp_list_free( search_list, 0 );
+    sdp_list_free( attrid_list, 0 );
+    PyMem_Free( ranges );
+    if( err ) return 0;
+
+    Py_INCREF( callback );
+    s->callback = callback;
+    s->raw = raw;
+    Py_RETURN_NONE;
 }
 
 // ==================== SDPSession methods ===========================
@@ -233,18 +541,23 @@ sess_connect(PySDPSessionObject *s, PyObject *args, PyObject *kwds)
     bdaddr_t dst; 
     char *dst_buf = "localhost";
     uint32_t flags = SDP_RETRY_IF_BUSY;
+    int nonblocking = 0;
 
-	static char *keywords[] = {"target", 0};
+	static char *keywords[] = {"target", "nonblocking", 0};
 
     bacpy( &src, BDADDR_ANY );
     bacpy( &dst, BDADDR_LOCAL );
 
     if( s->session != NULL ) {
         sdp_close( s->session );
+        s->session = NULL;
     }
+    clear_async( s );
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|s", keywords, &dst_buf))
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|sp", keywords, &dst_buf,
+                &nonblocking))
         return NULL;
+    if( nonblocking ) flags |= SDP_NON_BLOCKING;
 
     if( strncmp( dst_buf, "localhost", 18 ) != 0 ) {
         str2ba( dst_buf, &dst );
@@ -261,7 +574,7 @@ sess_connect(PySDPSessionObject *s, PyObject *args, PyObject *kwds)
     Py_RETURN_NONE;
 }
 PyDoc_STRVAR(sess_connect_doc,
-"connect( dest = \"localhost\" )\n\
+"connect( dest = \"localhost\", nonblocking = False )\n\
 \n\
 Connects the SDP session to the SDP server specified by dest.  If the\n\
 session was already connected, it's closed first.\n\
@@ -269,6 +582,10 @@ session was already connected, it's closed first.\n\
 dest specifies the bluetooth address of the server to connect to.  Special\n\
 case is \"localhost\"\n\
 \n\
+With nonblocking, the connection to a remote server is only started, and is\n\
+established once fileno() becomes writable.  It is meant for search_async\n\
+and browse_async, which report a failed connection to their callback.\n\
+\n\
 Raises _bluetooth.error if something goes wrong");
 
 // close
@@ -281,24 +598,28 @@ sess_close(PySDPSessionObject *s)
         Py_END_ALLOW_THREADS
         s->session = NULL;
     }
+    clear_async( s );
     Py_RETURN_NONE;
 }
 PyDoc_STRVAR(sess_close_doc,
 "close()\n\
 \n\
-Closes the connection with the SDP server.  No effect if a session is not open.");
+Closes the connection with the SDP server.  No effect if a session is not open.\n\
+A transaction in progress is dropped without calling its callback.");
 
 // fileno
 static PyObject *
 sess_fileno(PySDPSessionObject *s)
 {
+	if( ! s->session ) return PyLong_FromLong( -1 );
 	return PyLong_FromLong((long) s->session->sock);
 }
 PyDoc_STRVAR(sess_fileno_doc,
 "fileno() -> integer\n\
 \n\
 Return the integer file descriptor of the socket.\n\
-You can use this for direct communication with the SDP server.");
+You can use this for direct communication with the SDP server.\n\
+-1 if the session is not connected.");
 
 // search
 static PyObject *
@@ -306,9 +627,16 @@ sess_search(PySDPSessionObject *s, PyObject *args, PyObject *kwds)
 {
     char *uuid_str = 0;
     uuid_t uuid = { 0 };
+    PyObject *attrs = Py_None;
+    uint32_t *ranges = NULL;
+    Py_ssize_t n;
     PyObject *result = 0;
+    int raw = 0;
+    static char *keywords[] = {"uuid", "attrs", "raw", 0};
 
-    if (!PyArg_ParseTuple(args, "s", &uuid_str)) return NULL;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "s|Op", keywords,
+                &uuid_str, &attrs, &raw))
+        return NULL;
 
     // convert the UUID string into a uuid_t
     if( ! str2uuid( uuid_str, &uuid ) ) {
@@ -322,26 +650,47 @@ sess_search(PySDPSessionObject *s, PyObject *args, PyObject *kwds)
         return 0;
      }
 
+    if( (n = get_attr_ranges( attrs, &ranges )) < 0 ) return 0;
+
     // perform the search
-    result = do_search( s->session, &uuid );
+    result = do_search( s->session, &uuid, ranges, n, raw );
 
+    PyMem_Free( ranges );
     return result;
 }
 PyDoc_STRVAR(sess_search_doc,
-"search( UUID )\n\
+"search( UUID, attrs = None, raw = False )\n\
 \n\
 Searches for a service record with the specified UUID.  If no match is found,\n\
 returns None.  Otherwise, returns a dictionary\n\
 \n\
 UUID must be in the form \"XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX\", \n\
-where each X is a hexadecimal digit.");
+where each X is a hexadecimal digit.\n\
+\n\
+attrs is a sequence of the attribute IDs to request, and of (first, last)\n\
+ranges of attribute IDs.  The default requests only the attributes the\n\
+fields of the dictionary are made from; [(0x0000, 0xffff)] requests all.\n\
+\n\
+With raw, the records are returned as bytes, each one data element\n\
+sequence of its attribute ID and value pairs, sequence header included,\n\
+which is also the form register takes, for bluetooth.LazySDPRecord or\n\
+bluetooth.ServiceRecord.from_raw to decode.");
 
 // browse
 static PyObject *
-sess_browse(PySDPSessionObject *s)
+sess_browse(PySDPSessionObject *s, PyObject *args, PyObject *kwds)
 {
     uuid_t uuid = { 0 };
+    PyObject *attrs = Py_None;
+    uint32_t *ranges = NULL;
+    Py_ssize_t n;
     PyObject *result = 0;
+    int raw = 0;
+    static char *keywords[] = {"attrs", "raw", 0};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|Op", keywords,
+                &attrs, &raw))
+        return NULL;
 
     // convert the UUID string into a uuid_t
     sdp_uuid16_create(&uuid, PUBLIC_BROWSE_GROUP);
@@ -352,23 +701,422 @@ sess_browse(PySDPSessionObject *s)
         return 0;
      }
 
+    if( (n = get_attr_ranges( attrs, &ranges )) < 0 ) return 0;
+
     // perform the search
-    result = do_search( s->session, &uuid );
+    result = do_search( s->session, &uuid, ranges, n, raw );
 
+    PyMem_Free( ranges );
     return result;
 }
 PyDoc_STRVAR(sess_browse_doc,
-"browse()\n\
+"browse( attrs = None, raw = False )\n\
+\n\
+Browses all services advertised by connected SDP session.  attrs and raw\n\
+select the attributes to request and the form of the records, as for search.");
+
+// search_async
+static PyObject *
+sess_search_async(PySDPSessionObject *s, PyObject *args, PyObject *kwds)
+{
+    char *uuid_str = 0;
+    uuid_t uuid = { 0 };
+    PyObject *callback, *attrs = Py_None;
+    int raw = 0;
+    static char *keywords[] = {"uuid", "callback", "attrs", "raw", 0};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "sO|Op", keywords,
+                &uuid_str, &callback, &attrs, &raw))
+        return NULL;
+
+    // convert the UUID string into a uuid_t
+    if( ! str2uuid( uuid_str, &uuid ) ) {
+        PyErr_SetString(PyExc_ValueError, "invalid UUID!");
+        return NULL;
+    }
+
+    return start_async( s, &uuid, callback, attrs, raw );
+}
+PyDoc_STRVAR(sess_search_async_doc,
+"search_async( UUID, callback, attrs = None, raw = False )\n\
+\n\
+Sends the request of search( UUID, attrs, raw ) without waiting for the\n\
+response.  Register fileno() for reading with a selector or event loop and\n\
+call process() whenever it is readable; once the response is complete,\n\
+process() calls callback( records, error ).  records is the list search\n\
+would return, or None if the search failed, and error is None or the\n\
+_bluetooth.error it failed with.\n\
+\n\
+A session carries one transaction at a time; to query many servers at\n\
+once, use one session for each.");
+
+// browse_async
+static PyObject *
+sess_browse_async(PySDPSessionObject *s, PyObject *args, PyObject *kwds)
+{
+    uuid_t uuid = { 0 };
+    PyObject *callback, *attrs = Py_None;
+    int raw = 0;
+    static char *keywords[] = {"callback", "attrs", "raw", 0};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|Op", keywords,
+                &callback, &attrs, &raw))
+        return NULL;
+
+    sdp_uuid16_create(&uuid, PUBLIC_BROWSE_GROUP);
+    return start_async( s, &uuid, callback, attrs, raw );
+}
+PyDoc_STRVAR(sess_browse_async_doc,
+"browse_async( callback, attrs = None, raw = False )\n\
+\n\
+Sends the request of browse( attrs, raw ) without waiting for the response,\n\
+whose records are passed to callback as for search_async.");
+
+// process
+static PyObject *
+sess_process(PySDPSessionObject *s)
+{
+    PyObject *callback, *records = NULL, *error = NULL, *result;
+    int err;
+
+    if( ! s->session ) {
+        PyErr_SetString( bluetooth_error, "SDP session is not active!" );
+        return 0;
+    }
+    if( ! s->callback ) {
+        PyErr_SetString( bluetooth_error, "no SDP transaction in progress" );
+        return 0;
+    }
+
+    // reads one response PDU, and sends the request for the next part of
+    // a response split by the server
+    Py_BEGIN_ALLOW_THREADS
+    err = sdp_process( s->session );
+    Py_END_ALLOW_THREADS
+    if( ! s->done ) {
+        if( err == 0 ) Py_RETURN_FALSE;
+        // failed before the transaction was looked at
+        s->done = 1;
+        s->status = 0xffff;
+        s->err = errno ? errno : EIO;
+    }
+
+    // take the transaction off the session first, so callback can start
+    // the next one
+    callback = s->callback;
+    s->callback = NULL;
+    s->done = 0;
+    if( s->err == 0 ) {
+        records = records_to_list( s->results, s->raw );
+        s->results = NULL;
+        if( ! records ) {
+            Py_DECREF( callback );
+            return 0;
+        }
+        error = Py_None;
+        Py_INCREF( error );
+    } else {
+        char msg[64];
+
+        if( s->status == 0xffff )
+            PyOS_snprintf( msg, sizeof(msg), "%s", strerror( s->err ) );
+        else
+            PyOS_snprintf( msg, sizeof(msg),
+                    "the SDP server returned error 0x%04x", s->status );
+        error = PyObject_CallFunction( bluetooth_error, "is", s->err, msg );
+        if( ! error ) {
+            Py_DECREF( callback );
+            return 0;
+        }
+        records = Py_None;
+        Py_INCREF( records );
+    }
+
+    result = PyObject_CallFunctionObjArgs( callback, records, error, NULL );
+    Py_DECREF( callback );
+    Py_DECREF( records );
+    Py_DECREF( error );
+    if( ! result ) return 0;
+    Py_DECREF( result );
+    Py_RETURN_TRUE;
+}
+PyDoc_STRVAR(sess_process_doc,
+"process() -> bool\n\
+\n\
+Reads a response of the server to the transaction started by search_async\n\
+or browse_async, and returns True if that completed it, after calling its\n\
+callback.  Call it when fileno() is readable; it blocks otherwise.  Raises\n\
+_bluetooth.error if there is no transaction in progress.");
+
+// database_state
+static PyObject *
+sess_database_state(PySDPSessionObject *s)
+{
+    uuid_t uuid = { 0 };
+    uint16_t attrid = SDP_ATTR_SVCDB_STATE;
+    sdp_list_t *search_list, *attrid_list, *response_list = NULL, *r;
+    sdp_data_t *d;
+    uint32_t state = 0;
+    int found = 0, err;
+
+    // make sure the SDP session is open
+    if( ! s->session ) {
+        PyErr_SetString( bluetooth_error, "SDP session is not active!" );
+        return 0;
+     }
+
+    // the attribute belongs to the record of the SDP server itself
+    sdp_uuid16_create( &uuid, SDP_SERVER_SVCLASS_ID );
+    search_list = sdp_list_append( 0, &uuid );
+    attrid_list = sdp_list_append( 0, &attrid );
+
+    Py_BEGIN_ALLOW_THREADS
+    err = sdp_service_search_attr_req( s->session, search_list,
+            SDP_ATTR_REQ_INDIVIDUAL, attrid_list, &response_list );
+    Py_END_ALLOW_THREADS
+    sdp_list_free( search_list, 0 );
+    sdp_list_free( attrid_list, 0 );
+    if( err ) return PyErr_SetFromErrno( bluetooth_error );
+
+    for( r = response_list; r; r = r->next ) {
+        sdp_record_t *rec = (sdp_record_t*) r->data;
+        d = sdp_data_get( rec, SDP_ATTR_SVCDB_STATE );
+        if( ! found && d && d->dtd == SDP_UINT32 ) {
+            state = d->val.uint32;
+            found = 1;
+        }
+        sdp_record_free( rec );
+    }
+    sdp_list_free( response_list, 0 );
+
+    if( ! found ) Py_RETURN_NONE;
+    return PyLong_FromUnsignedLong( state );
+}
+PyDoc_STRVAR(sess_database_state_doc,
+"database_state() -> integer or None\n\
+\n\
+Returns the ServiceDatabaseState attribute of the SDP server, which changes\n\
+whenever a service record is added, removed or changed, or None if the\n\
+server does not maintain it.  Only this attribute is transferred, so it is\n\
+a cheap way to tell if the results of earlier searches are still valid.");
+
+// register
+static PyObject *
+sess_register(PySDPSessionObject *s, PyObject *args)
+{
+    PyObject *records, *seq, *result = 0;
+    Py_buffer *bufs;
+    uint32_t *handles;
+    Py_ssize_t i, j, n, done = 0;
+    bdaddr_t any;
+    int err = 0;
+
+    if( ! PyArg_ParseTuple( args, "O", &records ) ) return 0;
+
+    // make sure the SDP session is open
+    if( ! s->session ) {
+        PyErr_SetString( bluetooth_error, "SDP session is not active!" );
+        return 0;
+    }
+
+    seq = PySequence_Fast( records, "records must be a sequence of bytes" );
+    if( ! seq ) return 0;
+    n = PySequence_Fast_GET_SIZE( seq );
+    bufs = PyMem_New( Py_buffer, n );
+    handles = PyMem_New( uint32_t, n );
+    if( ! bufs || ! handles ) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    for( i = 0; i < n; i++ ) {
+        if( PyObject_GetBuffer( PySequence_Fast_GET_ITEM( seq, i ), &bufs[i],
+                    PyBUF_SIMPLE ) < 0 ) {
+            for( j = 0; j < i; j++ ) PyBuffer_Release( &bufs[j] );
+            goto done;
+        }
+    }
+
+    // one request after the other on the same session, without the GIL
+    bacpy( &any, BDADDR_ANY );
+    Py_BEGIN_ALLOW_THREADS
+    for( done = 0; done < n; done++ ) {
+        errno = 0;
+        if( sdp_device_record_register_binary( s->session, &any,
+                    (uint8_t *) bufs[done].buf, bufs[done].len, 0,
+                    &handles[done] ) < 0 ) {
+            err = errno ? errno : EIO;
+            break;
+        }
+    }
+    // a batch is registered as a whole or not at all
+    if( err ) {
+        for( i = 0; i < done; i++ )
+            sdp_device_record_unregister_binary( s->session, &any,
+                    handles[i] );
+    }
+    Py_END_ALLOW_THREADS
+
+    for( i = 0; i < n; i++ ) PyBuffer_Release( &bufs[i] );
+    if( err ) {
+        errno = err;
+        PyErr_SetFromErrno( bluetooth_error );
+        goto done;
+    }
+
+    result = PyList_New( n );
+    if( ! result ) goto done;
+    for( i = 0; i < n; i++ ) {
+        PyObject *handle = PyLong_FromUnsignedLong( handles[i] );
+        if( ! handle ) {
+            Py_CLEAR( result );
+            goto done;
+        }
+        PyList_SET_ITEM( result, i, handle );
+    }
+
+done:
+    PyMem_Free( bufs );
+    PyMem_Free( handles );
+    Py_DECREF( seq );
+    return result;
+}
+PyDoc_STRVAR(sess_register_doc,
+"register( records ) -> list of handles\n\
+\n\
+Registers records, a sequence of encoded service records, with the SDP\n\
+server, which must be the local one, and returns their handles.  A record\n\
+is one data element sequence of attribute ID and value pairs, sequence\n\
+header included, as search( raw = True ) returns records and\n\
+bluetooth.ServiceRecord.to_raw encodes them.  Either all of them are\n\
+registered, or none is and _bluetooth.error is raised.  The records stay\n\
+registered until they are unregistered or the session is closed.");
+
+// update
+static PyObject *
+sess_update(PySDPSessionObject *s, PyObject *args)
+{
+    unsigned long handle;
+    Py_buffer buf;
+    sdp_record_t *rec;
+    bdaddr_t any;
+    int scanned = 0, err;
+
+    if( ! PyArg_ParseTuple( args, "ky*", &handle, &buf ) ) return 0;
+
+    // make sure the SDP session is open
+    if( ! s->session ) {
+        PyBuffer_Release( &buf );
+        PyErr_SetString( bluetooth_error, "SDP session is not active!" );
+        return 0;
+    }
+
+    rec = sdp_extract_pdu( (uint8_t *) buf.buf, buf.len, &scanned );
+    PyBuffer_Release( &buf );
+    if( ! rec ) {
+        PyErr_SetString( PyExc_ValueError, "invalid service record" );
+        return 0;
+    }
+    rec->handle = handle;
+
+    bacpy( &any, BDADDR_ANY );
+    Py_BEGIN_ALLOW_THREADS
+    errno = 0;
+    err = sdp_device_record_update( s->session, &any, rec );
+    if( err < 0 && ! errno ) errno = EIO;
+    Py_END_ALLOW_THREADS
+    if( err < 0 ) PyErr_SetFromErrno( bluetooth_error );
+    sdp_record_free( rec );
+    if( err < 0 ) return 0;
+    Py_RETURN_NONE;
+}
+PyDoc_STRVAR(sess_update_doc,
+"update( handle, record )\n\
+\n\
+Replaces the attributes of the registered record with the given handle by\n\
+those of record, an encoded service record.  The record keeps its handle\n\
+and stays visible throughout.");
+
+// unregister
+static PyObject *
+sess_unregister(PySDPSessionObject *s, PyObject *args)
+{
+    PyObject *handles, *seq;
+    uint32_t *values;
+    Py_ssize_t i, n;
+    bdaddr_t any;
+    int err = 0;
+
+    if( ! PyArg_ParseTuple( args, "O", &handles ) ) return 0;
+
+    // make sure the SDP session is open
+    if( ! s->session ) {
+        PyErr_SetString( bluetooth_error, "SDP session is not active!" );
+        return 0;
+    }
+
+    seq = PySequence_Fast( handles, "handles must be a sequence" );
+    if( ! seq ) return 0;
+    n = PySequence_Fast_GET_SIZE( seq );
+    values = PyMem_New( uint32_t, n );
+    if( ! values ) {
+        Py_DECREF( seq );
+        return PyErr_NoMemory();
+    }
+    for( i = 0; i < n; i++ ) {
+        values[i] = PyLong_AsUnsignedLong( PySequence_Fast_GET_ITEM( seq, i ) );
+        if( PyErr_Occurred() ) {
+            PyMem_Free( values );
+            Py_DECREF( seq );
+            return 0;
+        }
+    }
+    Py_DECREF( seq );
+
+    // all are tried, and the first error is reported
+    bacpy( &any, BDADDR_ANY );
+    Py_BEGIN_ALLOW_THREADS
+    for( i = 0; i < n; i++ ) {
+        errno = 0;
+        if( sdp_device_record_unregister_binary( s->session, &any,
+                    values[i] ) < 0 && ! err )
+            err = errno ? errno : EIO;
+    }
+    Py_END_ALLOW_THREADS
+    PyMem_Free( values );
+
+    if( err ) {
+        errno = err;
+        return PyErr_SetFromErrno( bluetooth_error );
+    }
+    Py_RETURN_NONE;
+}
+PyDoc_STRVAR(sess_unregister_doc,
+"unregister( handles )\n\
 \n\
-Browses all services advertised by connected SDP session");
+Removes the registered records with the given handles from the SDP server.\n\
+All of them are tried before _bluetooth.error is raised for a failure.");
 
 static PyMethodDef sess_methods[] = {
-    { "search", (PyCFunction) sess_search, METH_VARARGS, 
+    { "search", (PyCFunction) sess_search, METH_VARARGS | METH_KEYWORDS, 
         sess_search_doc },
-    { "browse", (PyCFunction) sess_browse, METH_NOARGS, 
+    { "browse", (PyCFunction) sess_browse, METH_VARARGS | METH_KEYWORDS, 
         sess_browse_doc },
     { "fileno", (PyCFunction)sess_fileno, METH_NOARGS, 
         sess_fileno_doc },
+    { "database_state", (PyCFunction)sess_database_state, METH_NOARGS,
+        sess_database_state_doc },
+    { "search_async", (PyCFunction) sess_search_async,
+        METH_VARARGS | METH_KEYWORDS, sess_search_async_doc },
+    { "browse_async", (PyCFunction) sess_browse_async,
+        METH_VARARGS | METH_KEYWORDS, sess_browse_async_doc },
+    { "process", (PyCFunction)sess_process, METH_NOARGS,
+        sess_process_doc },
+    { "register", (PyCFunction)sess_register, METH_VARARGS,
+        sess_register_doc },
+    { "update", (PyCFunction)sess_update, METH_VARARGS,
+        sess_update_doc },
+    { "unregister", (PyCFunction)sess_unregister, METH_VARARGS,
+        sess_unregister_doc },
     { "connect", (PyCFunction) sess_connect, METH_VARARGS | METH_KEYWORDS, 
         sess_connect_doc },
     { "close", (PyCFunction)sess_close, METH_NOARGS, 
@@ -389,6 +1137,7 @@ sess_dealloc(PySDPSessionObject *s)
         sdp_close( s->session );
         s->session = NULL;
     }
+    clear_async( s );
     Py_TYPE(s)->tp_free((PyObject *)s);
 }
 
@@ -415,6 +1164,9 @@ sess_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 	newsess = type->tp_alloc(type, 0);
 	if (newsess != NULL) {
         ((PySDPSessionObject *)newsess)->session = NULL;
+        ((PySDPSessionObject *)newsess)->callback = NULL;
+        ((PySDPSessionObject *)newsess)->results = NULL;
+        ((PySDPSessionObject *)newsess)->done = 0;
 	}
 	return newsess;
 }
@@ -8,6 +8,14 @@ typedef struct {
     PyObject_HEAD
     sdp_session_t *session;
 
+    /* the transaction started by search_async or browse_async */
+    PyObject *callback;         /* NULL if there is none */
+    int raw;
+    int done;                   /* set once the response is complete */
+    int err;                    /* errno, if it failed */
+    uint16_t status;            /* the SDP error code, if it failed */
+    sdp_list_t *results;        /* the records of the response */
+
 	PyObject *(*errorhandler)(void); /* Error handler; checks
 					    errno, returns NULL and
 					    sets a Python exception */
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""PyBluez advanced example asyncio-rfcomm-server.py
+
+RFCOMM echo server that serves any number of clients from one thread, using
+the asyncio support in bluetooth.aio.
+"""
+
+import asyncio
+
+import bluetooth
+from bluetooth.aio import AsyncBluetoothSocket, open_connection
+
+
+async def echo(client_sock, client_info):
+    print("Accepted connection from", client_info)
+    reader, writer = await open_connection(sock=client_sock)
+    while True:
+        data = await reader.read(1024)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+    print("Disconnected", client_info)
+
+
+async def main():
+    server_sock = AsyncBluetoothSocket(bluetooth.RFCOMM)
+    server_sock.bind(("", bluetooth.PORT_ANY))
+    server_sock.listen(5)
+    print("Waiting for connections on RFCOMM channel",
+          server_sock.getsockname()[1])
+
+    while True:
+        client_sock, client_info = await server_sock.accept()
+        asyncio.ensure_future(echo(client_sock, client_info))
+
+
+asyncio.run(main())
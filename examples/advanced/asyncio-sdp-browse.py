@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""PyBluez advanced example asyncio-sdp-browse.py
+
+Finds nearby devices and browses the services of all of them at once from
+one thread, using bluetooth.aio.AsyncSDPSession.
+"""
+
+import asyncio
+
+import bluetooth
+from bluetooth.aio import AsyncSDPSession
+
+TIMEOUT = 20
+
+
+async def browse(address):
+    session = AsyncSDPSession()
+    try:
+        await session.connect(address)
+        return address, await asyncio.wait_for(session.browse(), TIMEOUT)
+    except (bluetooth.BluetoothError, asyncio.TimeoutError) as e:
+        return address, e
+    finally:
+        session.close()
+
+
+async def main():
+    print("Performing inquiry...")
+    addresses = bluetooth.discover_devices()
+    print("Found {} devices, browsing their services...".format(len(addresses)))
+    for address, result in await asyncio.gather(*map(browse, addresses)):
+        if isinstance(result, Exception):
+            print("{}: failed: {!r}".format(address, result))
+            continue
+        print("{}: {} services".format(address, len(result)))
+        for service in result:
+            print("    {} ({} {})".format(service["name"], service["protocol"],
+                                        service["port"]))
+
+
+asyncio.run(main())
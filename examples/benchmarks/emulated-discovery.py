@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""PyBluez benchmark emulated-discovery.py
+
+Runs bluetooth.DeviceDiscoverer against a bluetooth.emulator
+VirtualController with a few thousand virtual devices, a third of which do
+not put their name in their extended inquiry response and have to be asked
+for it.  find_devices stops the inquiry after 255 responses.  Reports how
+long the discovery takes, with air times scaled down by TIME_SCALE, for
+several numbers of name requests in flight.
+
+This benchmark needs the _bluetooth extension but not a Bluetooth adapter.
+"""
+
+import time
+
+import bluetooth
+from bluetooth.emulator import VirtualController, population
+
+NDEVICES = 2000
+TIME_SCALE = 0.01
+
+
+class TimingDiscoverer(bluetooth.DeviceDiscoverer):
+    def pre_inquiry(self):
+        self.found = 0
+        self.named = 0
+        self.start = time.perf_counter()
+
+    def device_discovered(self, address, device_class, rssi, name):
+        self.found += 1
+        if name:
+            self.named += 1
+
+    def inquiry_complete(self):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def main():
+    devices = population(NDEVICES, nameless_fraction=0.3)
+    print("{:>10} {:>8} {:>8} {:>10}".format(
+        "in flight", "devices", "named", "time (ms)"))
+    for max_name_requests in (1, 2, 4, 8):
+        controller = VirtualController(devices, time_scale=TIME_SCALE,
+                                       latency=0.0005, seed=0)
+        previous = bluetooth.set_hci_transport(controller.open)
+        try:
+            discoverer = TimingDiscoverer(max_name_requests=max_name_requests)
+            discoverer.find_devices(lookup_names=True, duration=8)
+            discoverer.process_inquiry()
+        finally:
+            bluetooth.set_hci_transport(previous)
+            controller.close()
+        print("{:>10} {:>8} {:>8} {:>10.1f}".format(
+            max_name_requests, discoverer.found, discoverer.named,
+            discoverer.elapsed * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""PyBluez benchmark hci-pipelining.py
+
+Connects a bluetooth.emulator.VirtualController to a few virtual devices,
+with a 5 ms event latency, and reads the RSSI of every connection many
+times: first one command at a time with bluetooth.HCIDevice, then through a
+bluetooth.HCICommandScheduler, for several values of the
+Num_HCI_Command_Packets the controller reports.  Reports the time taken and
+the latency and queue depth seen by the scheduler.
+
+This benchmark needs the _bluetooth extension but not a Bluetooth adapter.
+"""
+
+import struct
+import threading
+import time
+
+import bluetooth
+import bluetooth._bluetooth as bt
+from bluetooth.emulator import VirtualController, population
+
+NDEVICES = 8
+ROUNDS = 25
+LATENCY = 0.005
+
+
+def connect(scheduler, devices):
+    handles = {}
+    done = threading.Event()
+
+    def connection_complete(event, params):
+        status, handle, bdaddr = struct.unpack_from("<BH6s", params)
+        handles[bt.ba2str(bdaddr)] = handle
+        if len(handles) == len(devices):
+            done.set()
+
+    scheduler.subscribe(bt.EVT_CONN_COMPLETE, connection_complete)
+    scheduler.submit_many([
+        (bt.OGF_LINK_CTL, bt.OCF_CREATE_CONN,
+         struct.pack("<6sHBBHB", bt.str2ba(d.address), 0xcc18, 1, 0, 0, 1))
+        for d in devices])
+    done.wait(10)
+    scheduler.unsubscribe(bt.EVT_CONN_COMPLETE, connection_complete)
+    return handles
+
+
+def main():
+    devices = population(NDEVICES)
+    print("{:>22} {:>8} {:>10} {:>12} {:>10}".format(
+        "", "commands", "time (ms)", "latency (ms)", "max queue"))
+    for command_packets in (1, 4, 8):
+        controller = VirtualController(devices, latency=LATENCY,
+                                       command_packets=command_packets)
+        bluetooth.set_hci_transport(controller.open)
+        try:
+            # HCIDevice learns the handles from the connection events
+            device = bluetooth.HCIDevice()
+            scheduler = bluetooth.HCICommandScheduler()
+            handles = connect(scheduler, devices)
+            opcode = bt.cmd_opcode_pack(bt.OGF_STATUS_PARAM, bt.OCF_READ_RSSI)
+
+            if command_packets == 1:
+                start = time.perf_counter()
+                for i in range(ROUNDS):
+                    for address in handles:
+                        device.read_rssi(address)
+                elapsed = time.perf_counter() - start
+                print("{:>22} {:>8} {:>10.1f} {:>12} {:>10}".format(
+                    "HCIDevice", ROUNDS * len(handles), elapsed * 1e3,
+                    "", ""))
+
+            start = time.perf_counter()
+            commands = scheduler.submit_many(
+                [(bt.OGF_STATUS_PARAM, bt.OCF_READ_RSSI,
+                  struct.pack("<H", handle))
+                 for i in range(ROUNDS) for handle in handles.values()])
+            for command in commands:
+                command.result()
+            elapsed = time.perf_counter() - start
+            stats = scheduler.stats()[opcode]
+            print("{:>22} {:>8} {:>10.1f} {:>12.1f} {:>10}".format(
+                "scheduler, {} credits".format(command_packets),
+                stats.count, elapsed * 1e3, stats.mean_latency * 1e3,
+                scheduler.max_queue_depth))
+            scheduler.close()
+            device.close()
+        finally:
+            bluetooth.set_hci_transport(None)
+            controller.close()
+
+
+if __name__ == "__main__":
+    main()
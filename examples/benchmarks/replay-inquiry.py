@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""PyBluez benchmark replay-inquiry.py
+
+Replays a synthetic inquiry that finds 10000 devices through a
+bluetooth.DeviceDiscoverer with bluetooth.replay, once with extended inquiry
+results that carry names and service UUIDs, and once with batched inquiry
+results with RSSI, and reports how many events and devices per second the
+discoverer processes.  A btsnoop or pcap capture can be replayed instead by
+passing its path on the command line.
+
+This benchmark needs the _bluetooth extension but not a Bluetooth adapter.
+"""
+
+import sys
+
+import bluetooth
+from bluetooth.replay import replay, synthetic_inquiry
+
+NDEVICES = 10000
+
+
+class CountingDiscoverer(bluetooth.DeviceDiscoverer):
+    def pre_inquiry(self):
+        self.found = 0
+
+    def device_discovered(self, address, device_class, rssi, name):
+        self.found += 1
+
+    def inquiry_complete(self):
+        pass
+
+
+def run(label, source, lookup_names):
+    discoverer = CountingDiscoverer()
+    stats = replay(discoverer, source, lookup_names=lookup_names)
+    print("{:<24} {:>8} {:>8} {:>10.1f} {:>12.0f} {:>12.0f}".format(
+        label, stats.events, discoverer.found, stats.elapsed * 1e3,
+        stats.events_per_second, discoverer.found / stats.elapsed))
+
+
+def main():
+    print("{:<24} {:>8} {:>8} {:>10} {:>12} {:>12}".format(
+        "source", "events", "devices", "time (ms)", "events/s", "devices/s"))
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            run(path, path, False)
+        return
+    # generate the events up front so only their processing is timed
+    run("extended inquiry", list(synthetic_inquiry(NDEVICES)), True)
+    run("inquiry with rssi",
+        list(synthetic_inquiry(NDEVICES, extended=False)), False)
+
+
+if __name__ == "__main__":
+    main()
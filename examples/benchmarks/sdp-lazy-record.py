@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""PyBluez benchmark sdp-lazy-record.py
+
+Compares bluetooth.sdp_parse_raw_record, which decodes every attribute of a
+raw SDP record, with bluetooth.LazySDPRecord, which only decodes the
+attributes that are looked up.  Each synthetic record has 24 attributes, and
+the benchmark reads the service name and protocol descriptor list, as a
+typical inventory job would.
+
+This benchmark is pure Python and does not need a Bluetooth adapter.
+"""
+
+import time
+import tracemalloc
+
+from bluetooth.btcommon import (LazySDPRecord, sdp_make_data_element,
+                                sdp_parse_raw_record, SERVICE_NAME_ATTRID,
+                                PROTOCOL_DESCRIPTOR_LIST_ATTRID)
+
+NRECORDS = 2000
+WANTED = (SERVICE_NAME_ATTRID, PROTOCOL_DESCRIPTOR_LIST_ATTRID)
+
+
+def make_record(i):
+    attrs = [
+        ("UInt16", 0x0000), ("UInt32", 0x10000 + i),
+        ("UInt16", 0x0001), ("ElemSeq", [("UUID", "1101")]),
+        ("UInt16", 0x0004), ("ElemSeq", [
+            ("ElemSeq", [("UUID", "0100")]),
+            ("ElemSeq", [("UUID", "0003"), ("UInt8", i % 30 + 1)])]),
+        ("UInt16", 0x0005), ("ElemSeq", [("UUID", "1002")]),
+        ("UInt16", 0x0009), ("ElemSeq", [
+            ("ElemSeq", [("UUID", "1101"), ("UInt16", 0x0102)])]),
+        ("UInt16", 0x0100), ("String", "Serial Port %d" % i),
+        ("UInt16", 0x0101), ("String", "COM port emulation " * 4),
+        ("UInt16", 0x0102), ("String", "PyBluez"),
+    ]
+    # vendor specific attributes that are rarely looked at
+    for attrid in range(0x0200, 0x0210):
+        attrs.append(("UInt16", attrid))
+        attrs.append(("ElemSeq", [
+            ("UUID", "00001101-0000-1000-8000-00805F9B34FB"),
+            ("UInt32", attrid), ("String", "vendor data %d" % attrid)]))
+    return sdp_make_data_element("ElemSeq", attrs)
+
+
+def eager(records):
+    out = []
+    for raw in records:
+        rec = sdp_parse_raw_record(raw)
+        out.append(tuple(rec.get(attrid) for attrid in WANTED))
+    return out
+
+
+def lazy(records):
+    out = []
+    for raw in records:
+        rec = LazySDPRecord(raw)
+        out.append(tuple(rec.get(attrid) for attrid in WANTED))
+    return out
+
+
+def keep_eager(records):
+    return [sdp_parse_raw_record(raw) for raw in records]
+
+
+def keep_lazy(records):
+    records = [LazySDPRecord(raw) for raw in records]
+    for rec in records:
+        for attrid in WANTED:
+            rec[attrid]
+    return records
+
+
+def timed(func, records, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(records)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory(func, records):
+    tracemalloc.start()
+    result = func(records)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def main():
+    records = [make_record(i) for i in range(NRECORDS)]
+    assert eager(records) == lazy(records)
+
+    print("{} records of {} bytes each, reading {} of {} attributes".format(
+        NRECORDS, len(records[0]), len(WANTED),
+        len(sdp_parse_raw_record(records[0]))))
+    print("{:>8} {:>12} {:>12}".format("parser", "time (ms)", "peak KB"))
+    for name, func, keep in (("eager", eager, keep_eager),
+                             ("lazy", lazy, keep_lazy)):
+        print("{:>8} {:>12.1f} {:>12.0f}".format(
+            name, timed(func, records) * 1e3,
+            peak_memory(keep, records) / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""PyBluez benchmark sdp-parse.py
+
+Measures how long bluetooth.sdp_parse_raw_record takes to decode synthetic,
+nested raw SDP records between 1 KB and 1 MB in size.  The decoder walks the
+record once, so the time per kilobyte should stay roughly constant as the
+records grow.
+
+This benchmark is pure Python and does not need a Bluetooth adapter.
+"""
+
+import time
+
+from bluetooth.btcommon import sdp_make_data_element, sdp_parse_raw_record
+
+
+def make_attribute_value(i):
+    """Returns a nested data element similar to a protocol descriptor list."""
+    return ("ElemSeq", [
+        ("ElemSeq", [("UUID", "0100"), ("UInt16", 0x1001 + i)]),
+        ("ElemSeq", [("UUID", "0003"), ("UInt8", i & 0xff)]),
+        ("ElemSeq", [
+            ("UUID", "00001101-0000-1000-8000-00805F9B34FB"),
+            ("String", "service %d" % i),
+            ("AltElemSeq", [("UInt32", i), ("SInt16", -(i % 0x7fff))]),
+        ]),
+    ])
+
+
+def make_record(size):
+    """Builds a raw SDP record of at least size bytes."""
+    attrs = []
+    attrid = 0
+    encoded = 0
+    while encoded < size:
+        value = make_attribute_value(attrid)
+        attrs.append(("UInt16", attrid))
+        attrs.append(value)
+        encoded += len(sdp_make_data_element(*value)) + 3
+        attrid += 1
+    return sdp_make_data_element("ElemSeq", attrs)
+
+
+def bench(data, min_time=0.5):
+    """Returns the best time, in seconds, taken to parse data."""
+    best = None
+    total = 0.0
+    runs = 0
+    while total < min_time or runs < 3:
+        start = time.perf_counter()
+        sdp_parse_raw_record(data)
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        runs += 1
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    print("{:>10} {:>8} {:>12} {:>12}".format(
+        "bytes", "attrs", "time (ms)", "us per KB"))
+    for size in (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20):
+        data = make_record(size)
+        nattrs = len(sdp_parse_raw_record(data))
+        elapsed = bench(data)
+        print("{:>10} {:>8} {:>12.3f} {:>12.2f}".format(
+            len(data), nattrs, elapsed * 1e3, elapsed * 1e6 / (len(data) / 1024)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""PyBluez benchmark sdp-pipelining.py
+
+Fetches the records of a bluetooth.emulator.VirtualSDPServer with 40
+service records and a 10 ms round trip through bluetooth.sdp.SDPClient, one
+ServiceAttributeRequest per record, with several numbers of requests in
+flight.  Then streams all records with one ServiceSearchAttributeRequest,
+for several values of MaximumAttributeByteCount, and reports when the first
+record arrives and when the last one does.
+
+This benchmark needs the _bluetooth extension but not a Bluetooth adapter.
+"""
+
+import time
+
+from bluetooth.btcommon import sdp_make_data_element
+from bluetooth.emulator import VirtualSDPServer
+from bluetooth.sdp import SDPClient
+
+NRECORDS = 40
+LATENCY = 0.01
+
+
+def record(index):
+    return sdp_make_data_element("ElemSeq", [
+        ("UInt16", 0x0001), ("ElemSeq", [("UUID", "1101")]),
+        ("UInt16", 0x0005), ("ElemSeq", [("UUID", "1002")]),
+        ("UInt16", 0x0100), ("String", "service %d" % index),
+        ("UInt16", 0x0101), ("String", "description " * 40),
+    ])
+
+
+def main():
+    server = VirtualSDPServer([record(i) for i in range(NRECORDS)],
+                              latency=LATENCY)
+    client = SDPClient(server.open())
+    handles = client.service_search("1002").result()
+
+    print("{:>10} {:>8} {:>10}".format("in flight", "records", "time (ms)"))
+    for max_pending in (1, 2, 4, 8, 16):
+        client.max_pending = max_pending
+        start = time.perf_counter()
+        records = client.get_records(handles)
+        print("{:>10} {:>8} {:>10.1f}".format(
+            max_pending, len(records), (time.perf_counter() - start) * 1e3))
+
+    print()
+    print("{:>10} {:>10} {:>12} {:>12}".format(
+        "max bytes", "responses", "first (ms)", "last (ms)"))
+    for max_bytes in (256, 1024, 4096, 0xffff):
+        client.max_attr_bytes = max_bytes
+        start = time.perf_counter()
+        first = None
+        request = client.service_search_attribute("1101")
+        for raw in request:
+            if first is None:
+                first = time.perf_counter() - start
+        last = time.perf_counter() - start
+        print("{:>10} {:>10} {:>12.1f} {:>12.1f}".format(
+            max_bytes, request.responses, first * 1e3, last * 1e3))
+
+    client.close()
+    server.close()
+
+
+if __name__ == "__main__":
+    main()
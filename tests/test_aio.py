@@ -0,0 +1,137 @@
+"""AsyncBluetoothSocket and BluetoothTransport, over socket pairs."""
+import asyncio
+import socket
+
+import pytest
+
+pytest.importorskip("bluetooth._bluetooth")
+
+from bluetooth.aio import (AsyncBluetoothSocket, create_connection,
+                           open_connection)
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+
+class Collector(asyncio.Protocol):
+    def __init__(self):
+        self.packets = []
+        self.eof = False
+        self.lost = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.packets.append(data)
+
+    def eof_received(self):
+        self.eof = True
+
+    def connection_lost(self, exc):
+        self.lost = True
+
+
+def test_socket_sendall_and_recv():
+    # more than fits in the socket buffers, so both sides have to wait
+    data = bytes(range(256)) * 4096
+
+    async def main():
+        a, b = socket.socketpair()
+        with AsyncBluetoothSocket(sock=a) as sa, \
+                AsyncBluetoothSocket(sock=b) as sb:
+            async def receive():
+                chunks = []
+                while sum(map(len, chunks)) < len(data):
+                    chunks.append(await sb.recv(65536))
+                return b"".join(chunks)
+
+            _, received = await asyncio.gather(sa.sendall(data), receive())
+            assert received == data
+
+            buf = bytearray(16)
+            assert await sb.send(b"ping") == 4
+            assert await sa.recv_into(buf) == 4
+            assert buf[:4] == b"ping"
+
+            sb.close()
+            assert await sa.recv(16) == b""
+
+    run(main())
+
+
+def test_socket_accept_and_connect(tmp_path):
+    path = str(tmp_path / "sock")
+
+    async def main():
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+        with AsyncBluetoothSocket(sock=listener) as server, \
+                AsyncBluetoothSocket(sock=socket.socket(socket.AF_UNIX)) \
+                as client:
+            (conn, addr), _ = await asyncio.gather(server.accept(),
+                                                   client.connect(path))
+            with conn:
+                assert isinstance(conn, AsyncBluetoothSocket)
+                await client.sendall(b"hello")
+                assert await conn.recv(16) == b"hello"
+
+    run(main())
+
+
+def test_transport_keeps_packets():
+    async def main():
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        transport, protocol = await create_connection(Collector, sock=a)
+        with b:
+            transport.write(b"one")
+            transport.write(b"two")
+            assert b.recv(16) == b"one"
+            assert b.recv(16) == b"two"
+
+            b.send(b"three")
+            b.send(b"four")
+            while len(protocol.packets) < 2:
+                await asyncio.sleep(0.01)
+            assert protocol.packets == [b"three", b"four"]
+            assert transport.get_extra_info("socket") is a
+
+        while not protocol.lost:
+            await asyncio.sleep(0.01)
+        assert protocol.eof
+        assert transport.is_closing()
+
+    run(main())
+
+
+def test_transport_arguments():
+    async def main():
+        with pytest.raises(ValueError):
+            await create_connection(Collector)
+        a, b = socket.socketpair()
+        with a, b:
+            with pytest.raises(ValueError):
+                await create_connection(Collector, ("00:11:22:33:44:55", 1),
+                                        sock=a)
+
+    run(main())
+
+
+def test_streams():
+    async def main():
+        a, b = socket.socketpair()
+        reader, writer = await open_connection(sock=AsyncBluetoothSocket(
+            sock=a))
+        with b:
+            writer.write(b"request\n")
+            await writer.drain()
+            assert b.recv(16) == b"request\n"
+            b.sendall(b"response\n")
+            assert await reader.readline() == b"response\n"
+        assert await reader.read() == b""
+        writer.close()
+        await writer.wait_closed()
+
+    run(main())
@@ -0,0 +1,212 @@
+"""Library paths that talk to an adapter, run against a VirtualController."""
+import errno
+import socket
+import struct
+import time
+
+import pytest
+
+_bt = pytest.importorskip("bluetooth._bluetooth")
+
+import bluetooth
+from bluetooth.emulator import VirtualController, VirtualHCISocket, population
+
+
+@pytest.fixture
+def devices():
+    return population(30, seed=1, nameless_fraction=0.5)
+
+
+@pytest.fixture
+def controller(devices):
+    controller = VirtualController(devices, time_scale=0.001, seed=1)
+    previous = bluetooth.set_hci_transport(controller.open)
+    yield controller
+    bluetooth.set_hci_transport(previous)
+    controller.close()
+
+
+def create_connections(sock, devices):
+    # the commands another program would send to connect to devices
+    for device in devices:
+        sock.send(struct.pack("<BHB6sHBBHB", _bt.HCI_COMMAND_PKT,
+                              _bt.cmd_opcode_pack(_bt.OGF_LINK_CTL,
+                                                  _bt.OCF_CREATE_CONN),
+                              13, _bt.str2ba(device.address), 0xcc18,
+                              1, 0, 0, 1))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class Discoverer(bluetooth.DeviceDiscoverer):
+    def pre_inquiry(self):
+        self.found = {}
+        self.done = False
+
+    def device_discovered(self, address, device_class, rssi, name):
+        self.found[address] = (device_class, name)
+
+    def inquiry_complete(self):
+        self.done = True
+
+
+def test_read_local_bdaddr(controller):
+    assert bluetooth.read_local_bdaddr() == [controller.address]
+
+
+def test_discover_devices(controller, devices):
+    found = bluetooth.discover_devices(duration=2, lookup_names=True,
+                                       lookup_class=True)
+    expected = {(d.address, d.name, d.device_class) for d in devices}
+    assert set(found) == expected
+
+
+def test_lookup_name(controller, devices):
+    assert bluetooth.lookup_name(devices[3].address, timeout=2) == \
+        devices[3].name
+    assert bluetooth.lookup_name("11:22:33:44:55:66", timeout=1) is None
+
+
+def test_device_discoverer(controller, devices):
+    discoverer = Discoverer(max_name_requests=3)
+    discoverer.find_devices(lookup_names=True, duration=2)
+    discoverer.process_inquiry()
+    assert discoverer.done
+    assert discoverer.found == {d.address: (d.device_class, d.name)
+                                for d in devices}
+
+
+def test_filters_from_the_extension(controller):
+    # the filter helpers of _bluetooth, applied by VirtualHCISocket
+    sock = controller.open()
+    try:
+        flt = _bt.hci_filter_new()
+        flt = _bt.hci_filter_set_ptype(flt, _bt.HCI_EVENT_PKT)
+        flt = _bt.hci_filter_set_event(flt, _bt.EVT_CMD_COMPLETE)
+        sock.setsockopt(_bt.SOL_HCI, _bt.HCI_FILTER, flt)
+        assert sock.getsockopt(_bt.SOL_HCI, _bt.HCI_FILTER, 14) == bytes(flt)
+    finally:
+        sock.close()
+
+
+def test_str_filter(controller):
+    # filters made by older versions of the extension are str
+    sock = controller.open()
+    try:
+        assert isinstance(sock, VirtualHCISocket)
+        flt = bytes(_bt.hci_filter_set_ptype(_bt.hci_filter_new(),
+                                             _bt.HCI_EVENT_PKT))
+        sock.setsockopt(_bt.SOL_HCI, _bt.HCI_FILTER, flt.decode("ascii"))
+        assert sock.getsockopt(_bt.SOL_HCI, _bt.HCI_FILTER, 14) == flt
+    finally:
+        sock.close()
+
+
+def test_hci_device(controller, devices):
+    with bluetooth.HCIDevice(timeout=1) as device:
+        assert device.read_local_bdaddr() == controller.address
+        assert device.read_clock()[1] == 0
+
+        # the handles are learnt from the Connection Complete events
+        with controller.open() as sock:
+            create_connections(sock, devices[:2])
+            wait_for(lambda: len(device.connections) == 2)
+        address = devices[0].address
+        assert device.conn_handle(address.lower()) == \
+            device.connections[address]
+
+        assert device.read_rssi(address) == devices[0].rssi
+        assert 0 <= device.read_link_quality(address) <= 255
+        clock, accuracy = device.read_clock(address)
+        assert clock >= 0 and accuracy >= 0
+        device.write_flush_timeout(address, 100)
+        assert device.read_flush_timeout(address) == 100
+
+        controller.drop_connection(address)
+        wait_for(lambda: address not in device.connections)
+        with pytest.raises(bluetooth.BluetoothError):
+            device.read_rssi(address)
+        assert device.read_rssi(devices[1].address) == devices[1].rssi
+
+    with pytest.raises(bluetooth.BluetoothError):
+        device.read_local_bdaddr()
+
+
+def test_command_scheduler(controller, devices):
+    controller.command_packets = 4
+    controller.latency = 0.005
+    devices = devices[:4]
+    handles = {}
+
+    def connection_complete(event, params):
+        status, handle, bdaddr = struct.unpack_from("<BH6s", params)
+        handles[_bt.ba2str(bdaddr)] = handle
+
+    with bluetooth.HCICommandScheduler(timeout=1) as scheduler:
+        scheduler.subscribe(_bt.EVT_CONN_COMPLETE, connection_complete)
+        for command in scheduler.submit_many([
+                (_bt.OGF_LINK_CTL, _bt.OCF_CREATE_CONN,
+                 struct.pack("<6sHBBHB", _bt.str2ba(d.address), 0xcc18, 1, 0,
+                             0, 1)) for d in devices]):
+            assert command.result(2) == b"\0"
+        wait_for(lambda: len(handles) == len(devices))
+        scheduler.unsubscribe(_bt.EVT_CONN_COMPLETE, connection_complete)
+
+        # more commands than the controller takes at once
+        commands = scheduler.submit_many(
+            [(_bt.OGF_STATUS_PARAM, _bt.OCF_READ_RSSI,
+              struct.pack("<H", handles[d.address]))
+             for i in range(5) for d in devices])
+        assert scheduler.in_flight <= 4
+        assert scheduler.max_queue_depth > 4
+        for command, device in zip(commands, devices * 5):
+            assert struct.unpack("<BHb", command.result(2)) == \
+                (0, handles[device.address], device.rssi)
+        assert scheduler.in_flight == 0
+        assert scheduler.queue_depth == 0
+        assert scheduler.credits == 4
+
+        stats = scheduler.stats()[_bt.cmd_opcode_pack(_bt.OGF_STATUS_PARAM,
+                                                      _bt.OCF_READ_RSSI)]
+        assert stats.count == 20
+        assert stats.timeouts == 0
+        assert 0.005 <= stats.mean_latency <= stats.max_latency
+
+    with pytest.raises(bluetooth.BluetoothError):
+        scheduler.submit(_bt.OGF_INFO_PARAM, _bt.OCF_READ_BD_ADDR)
+
+
+def test_command_scheduler_timeout():
+    # a controller that never answers
+    host, controller = socket.socketpair(socket.AF_UNIX,
+                                         socket.SOCK_SEQPACKET)
+    opcode = _bt.cmd_opcode_pack(_bt.OGF_INFO_PARAM, _bt.OCF_READ_BD_ADDR)
+    with controller:
+        scheduler = bluetooth.HCICommandScheduler(timeout=0.1, sock=host)
+        first, second = scheduler.submit_many(
+            [(_bt.OGF_INFO_PARAM, _bt.OCF_READ_BD_ADDR, b"")] * 2)
+        with pytest.raises(bluetooth.BluetoothError) as e:
+            first.result(2)
+        assert e.value.errno == errno.ETIMEDOUT
+        # the credit of the lost answer is given back, so the second
+        # command is sent too
+        with pytest.raises(bluetooth.BluetoothError):
+            second.result(2)
+        packet = struct.pack("<BHB", _bt.HCI_COMMAND_PKT, opcode, 0)
+        assert controller.recv(16) == packet
+        assert controller.recv(16) == packet
+
+        stats = scheduler.stats()[opcode]
+        assert stats.count == 0
+        assert stats.timeouts == 2
+
+        third = scheduler.submit(_bt.OGF_INFO_PARAM, _bt.OCF_READ_BD_ADDR)
+        scheduler.close()
+        with pytest.raises(bluetooth.BluetoothError) as e:
+            third.result(2)
+        assert e.value.errno == errno.ECONNRESET
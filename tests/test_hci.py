@@ -0,0 +1,88 @@
+"""Decoding inquiry result events with bluetooth.hci."""
+import pytest
+
+pytest.importorskip("bluetooth._bluetooth")
+
+from bluetooth.hci import (EVT_INQUIRY_RESULT, EVT_INQUIRY_RESULT_WITH_RSSI,
+                           EVT_EXTENDED_INQUIRY_RESULT, EIR_DATA_SIZE,
+                           ba2str, decode_inquiry_results)
+
+# The parameters of two Inquiry Result with RSSI events, as captured: the
+# number of responses, then each parameter of all responses in turn.
+WITH_RSSI = bytes.fromhex(
+    "02"
+    "1371da7d1a00" "34128b70f35c"     # 00:1A:7D:DA:71:13, 5C:F3:70:8B:12:34
+    "0101"                            # page scan repetition mode
+    "0200"                            # page scan period mode
+    "0c025a" "040424"                 # class of device
+    "3412" "ff7f"                     # clock offset
+    "c4ab")                           # rssi, -60 and -85
+
+INQUIRY_RESULT = bytes.fromhex(
+    "01"
+    "1371da7d1a00"
+    "01" "02" "00"                    # page scan modes
+    "0c025a"
+    "3412")
+
+# a complete local name and the Serial Port service class
+EIR = bytes.fromhex("0c09") + b"Nexus Phone" + bytes.fromhex("03030111")
+EXTENDED = bytes.fromhex(
+    "01"
+    "34128b70f35c"
+    "01" "00" "040424" "ff7f" "d3") + EIR + bytes(EIR_DATA_SIZE - len(EIR))
+
+
+def test_ba2str():
+    assert ba2str(bytes.fromhex("1371da7d1a00")) == "00:1A:7D:DA:71:13"
+
+
+def test_inquiry_result_with_rssi():
+    results = decode_inquiry_results(EVT_INQUIRY_RESULT_WITH_RSSI,
+                                     WITH_RSSI)
+    assert results.addresses == ["00:1A:7D:DA:71:13", "5C:F3:70:8B:12:34"]
+    assert results.classes == [0x5a020c, 0x240404]
+    assert results.pscan_rep_modes == [1, 1]
+    assert results.pscan_period_modes == [2, 0]
+    assert results.clock_offsets == [0x1234, 0x7fff]
+    assert results.rssi == [-60, -85]
+    assert results.eir is None
+
+
+def test_inquiry_result():
+    results = decode_inquiry_results(EVT_INQUIRY_RESULT,
+                                     bytearray(INQUIRY_RESULT))
+    assert results.addresses == ["00:1A:7D:DA:71:13"]
+    assert results.classes == [0x5a020c]
+    assert results.pscan_rep_modes == [1]
+    assert results.pscan_period_modes == [2]
+    assert results.clock_offsets == [0x1234]
+    assert results.rssi is None
+
+
+def test_extended_inquiry_result():
+    results = decode_inquiry_results(EVT_EXTENDED_INQUIRY_RESULT, EXTENDED)
+    assert results.addresses == ["5C:F3:70:8B:12:34"]
+    assert results.classes == [0x240404]
+    assert results.clock_offsets == [0x7fff]
+    assert results.rssi == [-45]
+    assert results.eir == [EIR + bytes(EIR_DATA_SIZE - len(EIR))]
+
+
+def test_numpy_columns():
+    numpy = pytest.importorskip("numpy")
+    results = decode_inquiry_results(EVT_INQUIRY_RESULT_WITH_RSSI,
+                                     WITH_RSSI, use_numpy=True)
+    assert isinstance(results.rssi, numpy.ndarray)
+    assert results.classes.tolist() == [0x5a020c, 0x240404]
+    assert results.clock_offsets.tolist() == [0x1234, 0x7fff]
+    assert results.rssi.tolist() == [-60, -85]
+
+
+def test_malformed_events():
+    with pytest.raises(ValueError):
+        decode_inquiry_results(EVT_INQUIRY_RESULT_WITH_RSSI, b"")
+    with pytest.raises(ValueError):
+        decode_inquiry_results(EVT_INQUIRY_RESULT_WITH_RSSI, WITH_RSSI[:-1])
+    with pytest.raises(ValueError):
+        decode_inquiry_results(0x0e, WITH_RSSI)
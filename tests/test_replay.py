@@ -0,0 +1,69 @@
+"""Replaying synthetic inquiries through DeviceDiscoverer."""
+import pytest
+
+pytest.importorskip("bluetooth._bluetooth")
+
+import bluetooth
+from bluetooth.replay import (ReplaySocket, replay, synthetic_address,
+                              synthetic_inquiry)
+
+
+class Discoverer(bluetooth.DeviceDiscoverer):
+    def pre_inquiry(self):
+        self.found = {}
+        self.eir = {}
+        self.done = False
+
+    def eir_received(self, address, eir):
+        self.eir[address] = eir
+
+    def device_discovered(self, address, device_class, rssi, name):
+        assert -95 <= rssi < -30
+        self.found[address] = name
+
+    def inquiry_complete(self):
+        self.done = True
+
+
+def test_extended_inquiry():
+    discoverer = Discoverer()
+    stats = replay(discoverer, synthetic_inquiry(50), lookup_names=True)
+    assert discoverer.done
+    assert discoverer.found == {synthetic_address(i): "device-%d" % i
+                                for i in range(50)}
+    assert set(discoverer.eir) == set(discoverer.found)
+    # names come from the extended inquiry results, none are requested
+    assert stats.commands == 1
+    assert stats.events == 52
+    assert stats.events_per_second > 0
+
+
+def test_inquiry_with_rssi():
+    discoverer = Discoverer()
+    stats = replay(discoverer, synthetic_inquiry(50, extended=False))
+    assert discoverer.done
+    assert discoverer.found == {synthetic_address(i): None
+                                for i in range(50)}
+    assert discoverer.eir == {}
+    # 18 responses per event
+    assert stats.events == 2 + 3
+
+
+def test_events_run_out():
+    discoverer = Discoverer()
+    events = list(synthetic_inquiry(10))[:-1]
+    stats = replay(discoverer, events)
+    assert not discoverer.done
+    assert len(discoverer.found) == 10
+    assert stats.events == len(events)
+
+
+def test_replay_socket():
+    events = list(synthetic_inquiry(2, interval=0.01))
+    sock = ReplaySocket([(None, False, b"\x01\x01\x04\x00")] + events,
+                        pacing=True, speed=10.0)
+    assert [sock.recv(300) for i in events] == [e[2] for e in events]
+    with pytest.raises(EOFError):
+        sock.recv(300)
+    sock.send(b"\x01\x02\x04\x00")
+    assert sock.sent == [b"\x01\x02\x04\x00"]
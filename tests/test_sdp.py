@@ -0,0 +1,107 @@
+"""SDPClient against a VirtualSDPServer."""
+import time
+
+import pytest
+
+pytest.importorskip("bluetooth._bluetooth")
+
+from bluetooth.btcommon import (BluetoothError, sdp_make_data_element,
+                                sdp_parse_raw_record)
+from bluetooth.emulator import VirtualSDPServer
+from bluetooth.sdp import SDPClient
+
+NRECORDS = 8
+LATENCY = 0.05
+
+
+def record(index):
+    return sdp_make_data_element("ElemSeq", [
+        ("UInt16", 0x0001), ("ElemSeq", [("UUID", "1101")]),
+        ("UInt16", 0x0005), ("ElemSeq", [("UUID", "1002")]),
+        ("UInt16", 0x0100), ("String", "service %d" % index),
+        ("UInt16", 0x0101), ("String", "description " * 40),
+    ])
+
+
+def name(raw):
+    return sdp_parse_raw_record(raw)[0x0100].decode()
+
+
+@pytest.fixture
+def server():
+    server = VirtualSDPServer([record(i) for i in range(NRECORDS)],
+                              latency=LATENCY)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def client(server):
+    client = SDPClient(server.open())
+    yield client
+    client.close()
+
+
+def test_service_search(client):
+    handles = client.service_search("1101").result()
+    assert len(handles) == NRECORDS
+    assert client.service_search("1105").result() == []
+    assert client.pending == 0
+
+
+def test_service_attribute(client):
+    handles = client.service_search("1002").result()
+    records = client.service_attribute(handles[2], [0x0000, 0x0100]).result()
+    assert len(records) == 1
+    assert sdp_parse_raw_record(records[0]) == {0x0000: handles[2],
+                                                0x0100: b"service 2"}
+
+
+def test_streaming(client):
+    client.max_attr_bytes = 256
+    request = client.service_search_attribute("1101")
+    names = []
+    for raw in request:
+        # records are handed out before the whole response has arrived
+        if not names:
+            assert not request.done
+        names.append(name(raw))
+    assert names == ["service %d" % i for i in range(NRECORDS)]
+    assert request.done
+    assert request.responses > NRECORDS
+
+
+def test_pipelining(server, client):
+    handles = client.service_search("1002").result()
+    requests = server.requests
+    client.max_pending = 4
+
+    start = time.monotonic()
+    pending = [client.service_attribute(h) for h in handles]
+    # four requests are sent at once, the rest wait for their answers
+    assert client.pending == NRECORDS
+    deadline = time.monotonic() + 5
+    while server.requests < requests + 4 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    time.sleep(LATENCY / 2)
+    assert server.requests == requests + 4
+
+    names = [name(r) for p in pending for r in p.result()]
+    elapsed = time.monotonic() - start
+    assert names == ["service %d" % i for i in range(NRECORDS)]
+    assert server.requests == requests + NRECORDS
+    # one request at a time would take NRECORDS round trips
+    assert elapsed < NRECORDS * LATENCY
+    assert client.get_records(handles[:2], [0x0100]) == [
+        sdp_make_data_element("ElemSeq", [("UInt16", 0x0100),
+                                          ("String", "service %d" % i)])
+        for i in range(2)]
+
+
+def test_errors(server, client):
+    with pytest.raises(BluetoothError):
+        client.service_attribute(0x1234).result()
+    request = client.service_search("1101")
+    server.close()
+    with pytest.raises(BluetoothError):
+        request.result()